@@ -1,21 +1,37 @@
-from flask import Flask, request, flash, url_for, send_file, session, redirect, Response, render_template_string
+import time
+_BOOT_STARTED = time.perf_counter()
+
+from flask import Flask, Blueprint, request, flash, url_for, send_file, session, redirect, Response, render_template_string, g, has_request_context, jsonify, stream_with_context
 from twilio import twiml
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.twiml.voice_response import VoiceResponse, Dial, Say, Play, Gather
-from twilio.rest import Client
-import os, sys, json, datetime, re, requests, redis, psycopg2, gspread, time
+import os, sys, json, datetime, re, requests, redis, base64, csv, io, zlib, gzip, hashlib, tempfile
 from flask_wtf import CSRFProtect
+from phone import Normalizer
+import schedule as hotline_schedule
+from markupsafe import Markup, escape
 from functools import wraps
-from sqlalchemy import desc
+from sqlalchemy import desc, tuple_, insert, event
+from sqlalchemy.orm import Session
+from sqlalchemy.dialects import postgresql, sqlite
 from dotenv import load_dotenv, find_dotenv
-from authlib.integrations.flask_client import OAuth
 import random
-import resend
+import threading
+import atexit
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry as HTTPRetry
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager
 from zoneinfo import ZoneInfo
 from twilio.http.http_client import TwilioHttpClient
 from twilio.base.exceptions import TwilioRestException
 from flask_sqlalchemy import SQLAlchemy
-import nexmo 
+from flask.cli import AppGroup
+import click
+from rq import Queue, Retry
+# twilio.rest and nexmo are imported on first use, see LazyClient
 
 ## load environment variables
 ADMIN_USER = os.getenv("ADMIN_USER", "admin")
@@ -24,10 +40,11 @@ ADMIN_PASS = os.getenv("ADMIN_PASS")  # set in Koyeb secrets
 TWILIO_ACCT = os.environ["TWILIO_ACCT"]
 TWILIO_SECRET = os.environ["TWILIO_SECRET"]
 
-RECIPIENT1 = os.environ["RECIPIENT1"] # gets the general and voter help inquiries
-RECIPIENT2 = os.environ["RECIPIENT2"] # gets the general and voter help inquiries
-RECIPIENT3 = os.environ["RECIPIENT3"] # gets the general and voter help inquiries
-RECIPIENT4 = os.environ["RECIPIENT4"] # gets the general and voter help inquiries
+# fallback roster, used only while the volunteer table is empty
+RECIPIENT1 = os.getenv("RECIPIENT1") # gets the general and voter help inquiries
+RECIPIENT2 = os.getenv("RECIPIENT2") # gets the general and voter help inquiries
+RECIPIENT3 = os.getenv("RECIPIENT3") # gets the general and voter help inquiries
+RECIPIENT4 = os.getenv("RECIPIENT4") # gets the general and voter help inquiries
 RECIPIENT_MEDIA = os.environ["RECIPIENT_MEDIA"] # gets media inquiries
 RECIPIENT_DEBUGGING = os.environ["RECIPIENT_DEBUGGING"] # gets debugging texts
 
@@ -43,9 +60,226 @@ CALLBACK_URL = os.environ['CALLBACK_URL']
 TEXTBOT_NAME = "DAF TEXT BOT"
 CALLBOT_NAME = "DAF CALL BOT"
 
+## OUTBOUND HTTP ##
+# Every provider gets one pooled keep-alive requests.Session per worker,
+# shared by all threads, with its own timeout and retry policy. Settings are
+# read from <PROVIDER>_HTTP_<SETTING> (e.g. TWILIO_HTTP_TIMEOUT), falling
+# back to HTTP_<SETTING> and then the defaults below. Only connection
+# failures are retried for POSTs, so a retry can never double-send an SMS.
+#
+# TWILIO_API_BASE / NEXMO_API_BASE / RESEND_API_URL point a provider's
+# traffic somewhere else, e.g. the local stubs in bench/stubs.py.
+TWILIO_API_BASE = os.getenv("TWILIO_API_BASE")
+NEXMO_API_BASE = os.getenv("NEXMO_API_BASE")
+RESEND_API_URL = os.getenv("RESEND_API_URL", "https://api.resend.com").rstrip('/')
+
+HTTP_DEFAULTS = {
+    'TIMEOUT': 20.0,          # seconds per request
+    'POOL_CONNECTIONS': 4,    # distinct hosts kept pooled
+    'POOL_MAXSIZE': 10,       # keep-alive connections per host
+    'RETRIES': 2,
+    'BACKOFF': 0.3,           # seconds, doubled per retry
+    'JITTER': 0.3,            # up to this many seconds added to each backoff
+}
+
+def http_setting(provider, name):
+    default = HTTP_DEFAULTS[name]
+    raw = os.getenv(f"{provider.upper()}_HTTP_{name}", os.getenv(f"HTTP_{name}"))
+    return type(default)(raw) if raw is not None else default
+
+class JitterRetry(HTTPRetry):
+    """urllib3 Retry with a random jitter added to every backoff."""
+
+    def __init__(self, *args, jitter=0.0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.jitter = jitter
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.jitter = self.jitter
+        return retry
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+        return backoff + random.uniform(0, self.jitter) if backoff else backoff
+
+class ProviderAdapter(HTTPAdapter):
+    """Pooled adapter that applies a default timeout and, optionally, sends
+    every request to `base` (keeping path and query)."""
+
+    def __init__(self, timeout, base=None, **kwargs):
+        super().__init__(**kwargs)
+        self.timeout = timeout
+        self.base = base.rstrip('/') if base else None
+
+    def send(self, request, timeout=None, **kwargs):
+        if self.base:
+            parts = urlsplit(request.url)
+            request.url = self.base + parts.path + (f"?{parts.query}" if parts.query else "")
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+http_sessions = {}
+
+def provider_session(provider, hosts=(), base=None):
+    """Build the shared session for `provider`; `hosts` are rerouted to `base` if set."""
+    retries = http_setting(provider, 'RETRIES')
+    adapter_kwargs = dict(
+        pool_connections=http_setting(provider, 'POOL_CONNECTIONS'),
+        pool_maxsize=http_setting(provider, 'POOL_MAXSIZE'),
+        max_retries=JitterRetry(
+            total=retries, connect=retries, read=retries, status=retries,
+            backoff_factor=http_setting(provider, 'BACKOFF'),
+            jitter=http_setting(provider, 'JITTER'),
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=HTTPRetry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False,
+        ),
+    )
+    timeout = http_setting(provider, 'TIMEOUT')
+    session = requests.Session()
+    adapter = ProviderAdapter(timeout, **adapter_kwargs)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if base:
+        for host in hosts:
+            session.mount(f"https://{host}", ProviderAdapter(timeout, base=base, **adapter_kwargs))
+    http_sessions[provider] = session
+    return session
+
+def http_pool_stats():
+    """{(provider, host): [requests, new connections]} for this worker's pools.
+
+    Every request beyond the connections opened reused a kept-alive one.
+    """
+    stats = {}
+    for provider, session in list(http_sessions.items()):
+        adapters = {id(a): a for a in session.adapters.values()}.values()
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                entry = stats.setdefault((provider, f"{pool.host}:{pool.port}"), [0, 0])
+                entry[0] += pool.num_requests
+                entry[1] += pool.num_connections
+    return stats
+
+## METRICS ##
+# Latency histograms for every route and every outbound call, exported in
+# Prometheus text format on /admin/metrics.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20)
+
+class Histogram:
+    def __init__(self, name, help, labelnames, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: (list(v[0]), v[1], v[2]) for k, v in self._series.items()}
+        for labels, (counts, total, count) in sorted(series.items()):
+            base = ",".join(f'{n}="{v}"' for n, v in zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                lines.append(f'{self.name}_bucket{{{base},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{base}}} {total}")
+            lines.append(f"{self.name}_count{{{base}}} {count}")
+        return "\n".join(lines)
+
+request_latency = Histogram('frdem_request_duration_seconds', "Time spent handling a request.",
+                            ('route', 'method', 'status'))
+outbound_latency = Histogram('frdem_outbound_duration_seconds', "Time spent waiting on a provider or the database.",
+                             ('target', 'operation', 'outcome'))
+
+def record_span(target, operation, seconds, outcome='ok'):
+    outbound_latency.observe(seconds, target, operation, outcome)
+    if has_request_context() and 'spans' in g:
+        g.spans.append((f"{target} {operation}", round(seconds * 1000, 2)))
+
+@contextmanager
+def timed(target, operation):
+    start = time.perf_counter()
+    outcome = 'ok'
+    try:
+        yield
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        record_span(target, operation, time.perf_counter() - start, outcome)
+
+class InstrumentedTwilioHttpClient(TwilioHttpClient):
+    """Times every Twilio REST call, labelled like `messages.create`."""
+
+    def request(self, method, url, *args, **kwargs):
+        m = re.search(r'/Accounts/[^/]+/(\w+)(/[^/.]+)?\.json', url)
+        if m:
+            resource, sid = m.group(1).lower(), m.group(2)
+            operation = f"{resource}.{'create' if method.upper() == 'POST' else 'fetch' if sid else 'list'}"
+        else:
+            operation = f"{method.lower()} {urlsplit(url).path}"
+        with timed('twilio', operation):
+            return super().request(method, url, *args, **kwargs)
+
+## STARTUP TIMINGS ##
+# seconds spent in each boot phase of this worker, reported once at startup
+# and exported on /admin/metrics
+boot_timings = {}
+
+class LazyClient:
+    """Proxy that builds a provider client on first use instead of at import.
+
+    Attribute access is forwarded to the real client, so call sites read
+    exactly as if the client had been built eagerly.
+    """
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    started = time.perf_counter()
+                    self._client = self._factory()
+                    boot_timings[f"client_{self._name}"] = time.perf_counter() - started
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
 # Setup Twilio client
-http_client = TwilioHttpClient(timeout=20)
-twilio_client = Client(TWILIO_ACCT, TWILIO_SECRET, http_client=http_client)
+def build_twilio_client():
+    from twilio.rest import Client
+    http_client = InstrumentedTwilioHttpClient(timeout=http_setting('twilio', 'TIMEOUT'))
+    http_client.session = provider_session('twilio', ('api.twilio.com',), TWILIO_API_BASE)
+    return Client(TWILIO_ACCT, TWILIO_SECRET, http_client=http_client)
+
+twilio_client = LazyClient('twilio', build_twilio_client)
 
 ## VOICE MESSAGE LOCATIONS ##
 ENGLISH_URL = os.environ['ENGLISH_URL']
@@ -59,18 +293,33 @@ FDR_URL = os.environ['FDR_URL']
 def france_now():
     return datetime.datetime.now(ZoneInfo("Europe/Paris")) 
 
+def paris_naive(ts):
+    """`ts` as naive Paris wall time, the way CommunicationLog.timestamp stores it.
+
+    Postgres would convert an aware value to its session TimeZone before
+    dropping the offset, so rows are normalized before they are written.
+    """
+    if ts is not None and ts.tzinfo is not None:
+        ts = ts.astimezone(ZoneInfo("Europe/Paris")).replace(tzinfo=None)
+    return ts
+
+def log_now():
+    return paris_naive(france_now())
+
 ## CALL HANDLING ##
 def is_business_hours():
-    return france_now().hour >= 10 and france_now().hour <= 21
+    return schedule.now().open
 
-def whomst_to_call(req, lang):
-    recipients = [RECIPIENT1, RECIPIENT2, RECIPIENT3, RECIPIENT4]
-    if req == '1': # voting, english or french
-        return random.choice(recipients)
-    elif req == '2': # general, english or french
-        return random.choice(recipients)
-    elif req == '3': # press inquiries, english or french
-        return RECIPIENT_MEDIA
+HELP_ROLES = {
+    '1': 'voter',    # voting, english or french
+    '2': 'general',  # general, english or french
+    '3': 'media',    # press inquiries, english or french
+}
+
+def whomst_to_call(req, lang, coverage=None):
+    role = HELP_ROLES.get(req)
+    if role:
+        return router.choose(role, (coverage or schedule.now()).on_duty)
 
 def get_help_type(choice):
     if choice == '1':
@@ -81,35 +330,28 @@ def get_help_type(choice):
         return 'media inquiry'
 
 ## CLEAN NUMBER ##
+# see phone.py; North American numbers are dialed from the US caller ID
+phone_numbers = Normalizer('FR', {'1': CALLER_ID_US}, CALLER_ID,
+                           cache_size=int(os.getenv("PHONE_CACHE_SIZE", "10000")))
+
 def clean_number(s):
-    sdigitsonly = re.sub('[^0-9]+', '', s)
-    return "+"+sdigitsonly
+    return phone_numbers.normalize(s).e164 or "+" + re.sub('[^0-9]+', '', s or '')
 
 def correct_number(s):
-    if len(s) == 11 and s[1] == '0': # likely misformatted French (no country code starts with 0, no US area code starts with 0)
-        return ("+33"+s[2:], CALLER_ID)
-    elif len(s) == 11 and int(s[1]) >= 2: # likely misformatted US (beginning with area code)
-        return ("+1"+s[1:], CALLER_ID_US)
-    elif len(s) == 12 and s[0:3] == '+33': # definite france
-        return (s, CALLER_ID)
-    elif len(s) == 12 and s[0:4] == '+330': # definite france
-        return ('+33'+s[4:], CALLER_ID)
-    elif len(s) == 12 and s[0:2] == '+1': # likely us
-        return (s, CALLER_ID_US)
-    elif len(s) >= 12 and len(s) <= 15:
-        return (s, CALLER_ID)
-    else:
-        return ('invalid', CALLER_ID)
+    """(E.164 number or 'invalid', caller ID to dial it from)"""
+    result = phone_numbers.normalize(s)
+    return (result.e164 or 'invalid', result.caller_id)
 
 
 ###################### SET UP FLASK APP #########################
 
 
 ## CONFIGURE APP ##
+# Extensions and routes are bound to the app in create_app() at the bottom of
+# this file; everything here is wired up against the blueprint.
 
-app = Flask(__name__)
-csrf = CSRFProtect(app)
-app.secret_key = SECRET_KEY
+csrf = CSRFProtect()
+bp = Blueprint('frdem', __name__, cli_group=None)
 
 
 # Configure Postgres
@@ -117,11 +359,23 @@ uri = os.getenv("DATABASE_URL")
 if uri and uri.startswith("postgres://"):
     uri = uri.replace("postgres://", "postgresql://", 1)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = uri
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db_pg = SQLAlchemy(app)
+# Under gevent workers (see gunicorn.conf.py) hundreds of requests share one
+# process, so the pool size, not the worker count, caps concurrent queries.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+
+db_pg = SQLAlchemy()
 
 class CommunicationLog(db_pg.Model):
+    # On Postgres the table is partitioned by month, see LOG PARTITIONS.
+    # id trails each index so keyset pagination on (timestamp, id) stays index-only
+    __table_args__ = (
+        db_pg.Index('ix_communication_log_timestamp', 'timestamp', 'id'),
+        db_pg.Index('ix_communication_log_provider_timestamp', 'provider', 'timestamp', 'id'),
+        db_pg.Index('ix_communication_log_from_num_timestamp', 'from_num', 'timestamp', 'id'),
+    )
+
     id = db_pg.Column(db_pg.Integer, primary_key=True)
     provider = db_pg.Column(db_pg.String(20))     # 'Twilio' or 'Nexmo'
     comm_type = db_pg.Column(db_pg.String(20))    # 'SMS' or 'Call'
@@ -130,41 +384,1709 @@ class CommunicationLog(db_pg.Model):
     to_num = db_pg.Column(db_pg.String(50))
     content = db_pg.Column(db_pg.Text)            # SMS text or Status
     recording_url = db_pg.Column(db_pg.Text)
-    timestamp = db_pg.Column(db_pg.DateTime, default=france_now)
+    timestamp = db_pg.Column(db_pg.DateTime, default=log_now)  # naive Paris time
+    provider_sid = db_pg.Column(db_pg.String(64), index=True)  # CallSid, message_uuid, ...
+    status = db_pg.Column(db_pg.String(20))       # provider call/message status
+    duration = db_pg.Column(db_pg.Integer)        # call length in seconds
+    help_type = db_pg.Column(db_pg.String(30))    # IVR choice, see get_help_type()
+
+class TrafficRollup(db_pg.Model):
+    """Hourly counts of CommunicationLog rows, kept up to date as rows are written."""
+    hour = db_pg.Column(db_pg.DateTime, primary_key=True)  # Paris local time, truncated
+    provider = db_pg.Column(db_pg.String(20), primary_key=True)
+    comm_type = db_pg.Column(db_pg.String(20), primary_key=True)
+    direction = db_pg.Column(db_pg.String(20), primary_key=True)
+    help_type = db_pg.Column(db_pg.String(30), primary_key=True)  # '' when not an IVR call
+    count = db_pg.Column(db_pg.Integer, nullable=False, default=0)
+    voicemails = db_pg.Column(db_pg.Integer, nullable=False, default=0)
+
+class Volunteer(db_pg.Model):
+    id = db_pg.Column(db_pg.Integer, primary_key=True)
+    name = db_pg.Column(db_pg.String(100))
+    number = db_pg.Column(db_pg.String(50), unique=True, nullable=False)
+    roles = db_pg.Column(db_pg.String(100), default='voter,general')  # comma-separated HELP_ROLES values
+    active = db_pg.Column(db_pg.Boolean, default=True, nullable=False)
+    added = db_pg.Column(db_pg.DateTime, default=france_now)
+
+class ScheduleRule(db_pg.Model):
+    """Opening hours, closures and volunteer shifts; see schedule.py."""
+    id = db_pg.Column(db_pg.Integer, primary_key=True)
+    kind = db_pg.Column(db_pg.String(10), nullable=False)  # open, closed, shift
+    days = db_pg.Column(db_pg.String(40), default='')      # 'mon-fri', 'sat,sun'; empty is every day
+    start = db_pg.Column(db_pg.Time, nullable=False)
+    end = db_pg.Column(db_pg.Time, nullable=False)
+    date_from = db_pg.Column(db_pg.Date)
+    date_to = db_pg.Column(db_pg.Date)
+    number = db_pg.Column(db_pg.String(50))                # volunteer on a shift
+    note = db_pg.Column(db_pg.String(200))
+
+class WebhookReceipt(db_pg.Model):
+    """One row per provider event we've logged; the primary key rejects replays."""
+    key = db_pg.Column(db_pg.String(120), primary_key=True)  # e.g. nexmo-sms:<message_uuid>
+    received = db_pg.Column(db_pg.DateTime(timezone=True), default=france_now, index=True)
+
+class CallerListEntry(db_pg.Model):
+    """Numbers that are always refused ('block') or never rate limited ('allow')."""
+    number = db_pg.Column(db_pg.String(32), primary_key=True)  # digits only, see caller_key()
+    kind = db_pg.Column(db_pg.String(10), nullable=False)
+    note = db_pg.Column(db_pg.String(200))
+    added = db_pg.Column(db_pg.DateTime(timezone=True), default=france_now)
+
+class Broadcast(db_pg.Model):
+    """A bulk SMS send; its recipients are BroadcastRecipient rows."""
+    id = db_pg.Column(db_pg.Integer, primary_key=True)
+    name = db_pg.Column(db_pg.String(100), nullable=False)
+    body = db_pg.Column(db_pg.Text, nullable=False)
+    status = db_pg.Column(db_pg.String(20), nullable=False, default='draft')  # draft, sending, paused, done
+    created = db_pg.Column(db_pg.DateTime(timezone=True), default=france_now)
 
-# Initialize database
-with app.app_context():
+class BroadcastRecipient(db_pg.Model):
+    id = db_pg.Column(db_pg.Integer, primary_key=True)
+    broadcast_id = db_pg.Column(db_pg.Integer, db_pg.ForeignKey('broadcast.id'), nullable=False)
+    number = db_pg.Column(db_pg.String(20), nullable=False)  # E.164
+    caller_id = db_pg.Column(db_pg.String(20))               # Twilio sender, from correct_number()
+    # pending, sending, sent, delivered, failed, unknown (was in flight when a worker died)
+    status = db_pg.Column(db_pg.String(20), nullable=False, default='pending')
+    attempts = db_pg.Column(db_pg.Integer, nullable=False, default=0)
+    provider = db_pg.Column(db_pg.String(20))
+    provider_sid = db_pg.Column(db_pg.String(64), index=True)
+    error = db_pg.Column(db_pg.String(200))
+    updated = db_pg.Column(db_pg.DateTime(timezone=True), default=france_now, onupdate=france_now)
+    __table_args__ = (
+        db_pg.Index('ix_broadcast_recipient_status', 'broadcast_id', 'status', 'id'),
+        db_pg.UniqueConstraint('broadcast_id', 'number'),
+    )
+
+class SyncState(db_pg.Model):
+    """High-water marks for background jobs that mirror provider data."""
+    key = db_pg.Column(db_pg.String(50), primary_key=True)
+    value = db_pg.Column(db_pg.Text)
+    updated = db_pg.Column(db_pg.DateTime, default=france_now, onupdate=france_now)
+
+@event.listens_for(Session, 'before_commit')
+def _commit_started(session):
+    session.info['commit_started'] = time.perf_counter()
+
+@event.listens_for(Session, 'after_commit')
+def _commit_finished(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        record_span('postgres', 'commit', time.perf_counter() - started)
+
+@event.listens_for(Session, 'after_rollback')
+def _commit_failed(session):
+    started = session.info.pop('commit_started', None)
+    if started is not None:
+        record_span('postgres', 'commit', time.perf_counter() - started, 'error')
+
+# create_all() only creates missing tables, so columns added to existing
+# tables are listed here and applied idempotently
+SCHEMA_UPGRADES = [
+    "ALTER TABLE communication_log ADD COLUMN IF NOT EXISTS provider_sid VARCHAR(64)",
+    "ALTER TABLE communication_log ADD COLUMN IF NOT EXISTS status VARCHAR(20)",
+    "ALTER TABLE communication_log ADD COLUMN IF NOT EXISTS duration INTEGER",
+    "ALTER TABLE communication_log ADD COLUMN IF NOT EXISTS help_type VARCHAR(30)",
+    "ALTER TABLE sync_state ALTER COLUMN value TYPE TEXT",
+    # full-text search over SMS bodies and transcriptions, see /admin/search
+    "ALTER TABLE communication_log ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('french', coalesce(content, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(content, '')), 'B')) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_communication_log_search ON communication_log USING gin (search_vector)",
+    "CREATE INDEX IF NOT EXISTS ix_communication_log_provider_sid ON communication_log (provider_sid)",
+    "CREATE INDEX IF NOT EXISTS ix_communication_log_timestamp ON communication_log (timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS ix_communication_log_provider_timestamp ON communication_log (provider, timestamp, id)",
+    "CREATE INDEX IF NOT EXISTS ix_communication_log_from_num_timestamp ON communication_log (from_num, timestamp, id)",
+]
+
+## LOG PARTITIONS ##
+# On Postgres communication_log is range-partitioned by month on timestamp
+# (communication_log_pYYYYMM, plus communication_log_default for anything
+# outside them), so old months can be archived by dropping a partition
+# instead of deleting rows. The primary key is (id, timestamp) because a
+# partitioned table's unique keys must include the partition key. New
+# databases start partitioned; `flask partition-log` converts an old one.
+LOG_PARTITIONS_AHEAD = int(os.getenv("LOG_PARTITIONS_AHEAD", "2"))  # months created in advance
+LOG_COLUMNS = ('id', 'provider', 'comm_type', 'direction', 'from_num', 'to_num', 'content',
+               'recording_url', 'timestamp', 'provider_sid', 'status', 'duration', 'help_type')
+
+PARTITIONED_LOG_DDL = """
+CREATE TABLE IF NOT EXISTS communication_log (
+    id SERIAL,
+    provider VARCHAR(20),
+    comm_type VARCHAR(20),
+    direction VARCHAR(20),
+    from_num VARCHAR(50),
+    to_num VARCHAR(50),
+    content TEXT,
+    recording_url TEXT,
+    timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT (now() AT TIME ZONE 'Europe/Paris'),
+    provider_sid VARCHAR(64),
+    status VARCHAR(20),
+    duration INTEGER,
+    help_type VARCHAR(30),
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp)
+"""
+
+def month_start(moment):
+    return datetime.datetime(moment.year, moment.month, 1)
+
+def next_month(month):
+    return datetime.datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+def log_partition_name(month):
+    return f"communication_log_p{month:%Y%m}"
+
+def log_is_partitioned(conn):
+    return conn.exec_driver_sql(
+        "SELECT relkind FROM pg_class WHERE oid = to_regclass('communication_log')").scalar() == 'p'
+
+def log_partitions(conn):
+    """{month: partition name} for the monthly partitions currently attached."""
+    names = conn.exec_driver_sql(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'communication_log'::regclass").scalars()
+    return {datetime.datetime.strptime(m.group(1), '%Y%m'): name
+            for name in names if (m := re.fullmatch(r'communication_log_p(\d{6})', name))}
+
+def default_partition_months(conn, before=None):
+    """Months that have rows sitting in communication_log_default."""
+    query = "SELECT DISTINCT date_trunc('month', timestamp) FROM communication_log_default"
+    if before:
+        query += f" WHERE timestamp < '{before:%Y-%m-%d}'"
+    return sorted(conn.exec_driver_sql(query).scalars())
+
+def create_log_partition(conn, month):
+    """Create `month`'s partition, first moving out any rows the default partition holds for it."""
+    name = log_partition_name(month)
+    if conn.exec_driver_sql(f"SELECT to_regclass('{name}')").scalar() is not None:
+        return
+    bounds = f"timestamp >= '{month:%Y-%m-%d}' AND timestamp < '{next_month(month):%Y-%m-%d}'"
+    columns = ', '.join(LOG_COLUMNS)
+    # Postgres refuses a new partition while the default holds rows in its range
+    conn.exec_driver_sql("LOCK TABLE communication_log_default IN EXCLUSIVE MODE")
+    moved = conn.exec_driver_sql(f"SELECT count(*) FROM communication_log_default WHERE {bounds}").scalar()
+    if moved:
+        conn.exec_driver_sql(f"CREATE TEMP TABLE log_default_rows ON COMMIT DROP AS "
+                             f"SELECT {columns} FROM communication_log_default WHERE {bounds}")
+        conn.exec_driver_sql(f"DELETE FROM communication_log_default WHERE {bounds}")
+    conn.exec_driver_sql(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF communication_log "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month(month):%Y-%m-%d}')")
+    if moved:
+        conn.exec_driver_sql(f"INSERT INTO communication_log ({columns}) SELECT {columns} FROM log_default_rows")
+        conn.exec_driver_sql("DROP TABLE log_default_rows")
+        print(f"Moved {moved} row(s) from communication_log_default to {name}")
+
+def create_log_partitions(conn, first=None):
+    """Create monthly partitions from `first` to LOG_PARTITIONS_AHEAD months ahead.
+
+    `first` defaults to the oldest row or the first Twilio sync's backfill
+    window, whichever is earlier. Rows already in the default partition
+    get their month's partition too.
+    """
+    conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS communication_log_default PARTITION OF communication_log DEFAULT")
+    if first is None:
+        oldest = conn.exec_driver_sql("SELECT min(timestamp) FROM communication_log").scalar()
+        first = france_now().replace(tzinfo=None) - datetime.timedelta(days=TWILIO_SYNC_BACKFILL_DAYS)
+        first = min(first, oldest) if oldest else first
+    month, last = month_start(first), month_start(france_now())
+    for _ in range(LOG_PARTITIONS_AHEAD):
+        last = next_month(last)
+    months = []
+    while month <= last:
+        months.append(month)
+        month = next_month(month)
+    for month in sorted(set(months) | set(default_partition_months(conn))):
+        create_log_partition(conn, month)
+
+def ensure_schema():
+    if db_pg.engine.dialect.name == 'postgresql':
+        with db_pg.engine.begin() as conn:
+            if conn.exec_driver_sql("SELECT to_regclass('communication_log')").scalar() is None:
+                conn.exec_driver_sql(PARTITIONED_LOG_DDL)
     db_pg.create_all()
+    if db_pg.engine.dialect.name != 'postgresql':
+        return
+    with db_pg.engine.begin() as conn:
+        for stmt in SCHEMA_UPGRADES:
+            conn.exec_driver_sql(stmt)
+        if log_is_partitioned(conn):
+            create_log_partitions(conn)
+
+@bp.cli.command("partition-log")
+def partition_log_command():
+    """Convert an unpartitioned communication_log to monthly partitions (one-off, locks the table)."""
+    if db_pg.engine.dialect.name != 'postgresql':
+        print("Partitioning needs Postgres")
+        return
+    started = time.perf_counter()
+    columns = ', '.join(LOG_COLUMNS)
+    select = columns.replace('timestamp', "coalesce(timestamp, now() AT TIME ZONE 'Europe/Paris')")
+    with db_pg.engine.begin() as conn:
+        if log_is_partitioned(conn):
+            print("communication_log is already partitioned")
+            return
+        conn.exec_driver_sql("LOCK TABLE communication_log IN ACCESS EXCLUSIVE MODE")
+        conn.exec_driver_sql("ALTER TABLE communication_log RENAME TO communication_log_old")
+        # free the constraint, index and sequence names for the new table
+        conn.exec_driver_sql("ALTER TABLE communication_log_old RENAME CONSTRAINT communication_log_pkey TO communication_log_old_pkey")
+        for name in conn.exec_driver_sql(
+                "SELECT indexname FROM pg_indexes WHERE tablename = 'communication_log_old'").scalars().all():
+            if name.startswith('ix_communication_log'):
+                conn.exec_driver_sql(f'ALTER INDEX "{name}" RENAME TO "{name}_old"')
+        conn.exec_driver_sql("ALTER SEQUENCE communication_log_id_seq RENAME TO communication_log_old_id_seq")
+        conn.exec_driver_sql(PARTITIONED_LOG_DDL)
+        for stmt in SCHEMA_UPGRADES:
+            conn.exec_driver_sql(stmt)
+        create_log_partitions(conn, conn.exec_driver_sql("SELECT min(timestamp) FROM communication_log_old").scalar())
+        copied = conn.exec_driver_sql(
+            f"INSERT INTO communication_log ({columns}) "
+            f"SELECT {select} FROM communication_log_old").rowcount
+        conn.exec_driver_sql("SELECT setval('communication_log_id_seq', (SELECT coalesce(max(id), 0) + 1 FROM communication_log), false)")
+        conn.exec_driver_sql("DROP TABLE communication_log_old")
+    print(f"Partitioned {copied} row(s) by month ({time.perf_counter() - started:.1f}s)")
+
+@bp.cli.command("init-db")
+def init_db_command():
+    """Create missing tables, columns and indexes (run once per deploy)."""
+    started = time.perf_counter()
+    ensure_schema()
+    print(f"Schema up to date ({time.perf_counter() - started:.2f}s)")
+
+## REDIS / JOB QUEUES ##
+REDIS_URL = os.getenv("REDIS_URL")
+redis_conn = redis.from_url(REDIS_URL) if REDIS_URL else None
+sync_queue = Queue('sync', connection=redis_conn) if redis_conn else None
+
+###################### LOG WRITE-BEHIND ######################
+# Webhooks hand CommunicationLog rows to log_buffer instead of committing one
+# transaction per event; a background thread bulk-inserts them once
+# LOG_BUFFER_SIZE rows are waiting or LOG_BUFFER_INTERVAL seconds have passed.
+# With LOG_BUFFER_DURABLE=1 rows are staged in Redis first, so they survive
+# a worker crash; otherwise they are flushed at interpreter exit. Durable rows
+# without a webhook receipt get a random one, so rows replayed after a crash
+# between the commit and clearing the in-flight list are skipped, not doubled.
+
+LOG_BUFFER_SIZE = int(os.getenv("LOG_BUFFER_SIZE", "100"))
+LOG_BUFFER_INTERVAL = float(os.getenv("LOG_BUFFER_INTERVAL", "2"))
+LOG_BUFFER_MAX = int(os.getenv("LOG_BUFFER_MAX", "10000"))  # in-memory rows held before dropping
+LOG_BUFFER_DURABLE = os.getenv("LOG_BUFFER_DURABLE", "0") == "1" and redis_conn is not None
+LOG_BUFFER_KEY = 'logbuf:pending'
+
+# atomically move up to ARGV[1] pending rows onto this worker's in-flight list
+_CLAIM_ROWS = """
+local rows = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #rows > 0 then
+    redis.call('LTRIM', KEYS[1], #rows, -1)
+    redis.call('RPUSH', KEYS[2], unpack(rows))
+end
+return rows
+"""
 
-###################### EMAIL OUR ACCOUNT ######################
+def write_log_rows(rows):
+    """Bulk-insert CommunicationLog rows (dicts) in one transaction.
 
-def send_email(f, t, subject, html):
-    try: 
-        resend.api_key = os.environ.get('RESEND_API_KEY')
-        r = resend.Emails.send({
+    Rows may carry a `receipt` key (see webhook_key); a row whose receipt is
+    already in WebhookReceipt is a provider retry and is skipped.
+    """
+    rows = claim_receipts(rows)
+    if not rows:
+        db_pg.session.commit()
+        return
+    for row in rows:
+        row['timestamp'] = paris_naive(row.get('timestamp')) or log_now()
+    db_pg.session.execute(insert(CommunicationLog), rows)
+    bump_rollups(rollup_counts(rows))
+    db_pg.session.commit()
+
+def claim_receipts(rows):
+    """Record the rows' webhook receipts; return the rows not seen before, minus `receipt`."""
+    keys = list(dict.fromkeys(r['receipt'] for r in rows if r.get('receipt')))
+    fresh = set()
+    if keys:
+        now = france_now()
+        stmt = (_dialect_insert(WebhookReceipt).values([{'key': k, 'received': now} for k in keys])
+                .on_conflict_do_nothing().returning(WebhookReceipt.key))
+        fresh = set(db_pg.session.execute(stmt).scalars())
+    kept = []
+    for row in rows:
+        key = row.get('receipt')
+        if key is not None and key not in fresh:
+            continue
+        fresh.discard(key)  # only the first row for a key
+        kept.append({k: v for k, v in row.items() if k != 'receipt'})
+    return kept
+
+## TRAFFIC ROLLUPS ##
+# TrafficRollup holds per-hour counts by provider, comm_type, direction and
+# help type. Every code path that inserts CommunicationLog rows bumps it in
+# the same transaction, so the stats pages never scan the log itself.
+
+def _rollup_hour(ts):
+    return (paris_naive(ts) or log_now()).replace(minute=0, second=0, microsecond=0)
+
+def rollup_key(row):
+    return (_rollup_hour(row.get('timestamp')), row.get('provider') or '', row.get('comm_type') or '',
+            row.get('direction') or '', row.get('help_type') or '')
+
+def rollup_counts(rows):
+    """{rollup key: [rows, voicemails]} for CommunicationLog row dicts."""
+    counts = {}
+    for row in rows:
+        entry = counts.setdefault(rollup_key(row), [0, 0])
+        entry[0] += 1
+        if row.get('comm_type') == 'Call' and row.get('recording_url'):
+            entry[1] += 1
+    return counts
+
+def _dialect_insert(model):
+    dialect = postgresql if db_pg.engine.dialect.name == 'postgresql' else sqlite
+    return dialect.insert(model)
+
+def bump_rollups(counts):
+    """Add `counts` (see rollup_counts) to TrafficRollup; caller commits."""
+    if not counts:
+        return
+    # sorted so concurrent writers lock rollup rows in the same order
+    values = [dict(zip(('hour', 'provider', 'comm_type', 'direction', 'help_type'), key),
+                   count=n, voicemails=vm) for key, (n, vm) in sorted(counts.items())]
+    stmt = _dialect_insert(TrafficRollup).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['hour', 'provider', 'comm_type', 'direction', 'help_type'],
+        set_={'count': TrafficRollup.count + stmt.excluded.count,
+              'voicemails': TrafficRollup.voicemails + stmt.excluded.voicemails})
+    db_pg.session.execute(stmt)
+
+def log_rollup_counts():
+    """(rows scanned, rollup_counts) recomputed from every CommunicationLog row."""
+    counts = {}
+    columns = ('timestamp', 'provider', 'comm_type', 'direction', 'help_type', 'recording_url')
+    rows = db_pg.session.query(*[getattr(CommunicationLog, c) for c in columns]).yield_per(EXPORT_BATCH)
+    total = 0
+    for row in rows:
+        for key, (n, vm) in rollup_counts([dict(zip(columns, row))]).items():
+            entry = counts.setdefault(key, [0, 0])
+            entry[0] += n
+            entry[1] += vm
+        total += 1
+    return total, counts
+
+@bp.cli.command("backfill-rollups")
+def backfill_rollups_command():
+    """Rebuild TrafficRollup from every CommunicationLog row."""
+    if db_pg.engine.dialect.name == 'postgresql':
+        # writers wait until we commit, so no increment is lost or counted twice
+        db_pg.session.execute(db_pg.text("LOCK TABLE traffic_rollup IN EXCLUSIVE MODE"))
+    db_pg.session.query(TrafficRollup).delete()
+    total, counts = log_rollup_counts()
+    keys = sorted(counts)
+    for i in range(0, len(keys), 1000):
+        bump_rollups({k: counts[k] for k in keys[i:i + 1000]})
+    db_pg.session.commit()
+    print(f"Rolled up {total} row(s) into {len(counts)} hourly bucket(s)")
+
+@bp.cli.command("check-rollups")
+def check_rollups_command():
+    """Compare the incrementally kept TrafficRollup with a backfill of the log."""
+    if db_pg.engine.dialect.name == 'postgresql':
+        # a consistent snapshot of both tables
+        db_pg.session.execute(db_pg.text("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"))
+    total, expected = log_rollup_counts()
+    kept = {(r.hour, r.provider, r.comm_type, r.direction, r.help_type): [r.count, r.voicemails]
+            for r in db_pg.session.query(TrafficRollup)}
+    db_pg.session.rollback()
+    wrong = sorted(k for k in expected.keys() | kept.keys() if expected.get(k) != kept.get(k))
+    for key in wrong[:20]:
+        print(f"{key[0]:%Y-%m-%d %H:00} {'/'.join(key[1:])}: rollup {kept.get(key)}, log {expected.get(key)}")
+    if wrong:
+        raise SystemExit(f"{len(wrong)} of {len(expected)} hourly bucket(s) disagree with the log")
+    print(f"Rollups match the log: {total} row(s), {len(expected)} hourly bucket(s)")
+
+class LogBuffer:
+    def __init__(self, size, interval, max_rows, durable):
+        self.size = size
+        self.interval = interval
+        self.max_rows = max_rows
+        self.durable = durable
+        self.stats = {'buffered': 0, 'flushed': 0, 'dropped': 0}
+        self._rows = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = None
+        if durable:
+            self._claim = redis_conn.register_script(_CLAIM_ROWS)
+
+    @property
+    def inflight_key(self):
+        return f"logbuf:inflight:{os.uname().nodename}:{os.getpid()}"
+
+    def add(self, **row):
+        row['timestamp'] = paris_naive(row.get('timestamp')) or log_now()
+        if self.durable:
+            if not row.get('receipt'):
+                row['receipt'] = f"logbuf:{os.urandom(12).hex()}"
+            try:
+                pending = redis_conn.rpush(LOG_BUFFER_KEY, json.dumps(row, default=str))
+            except redis.exceptions.RedisError as e:
+                print(f"Log buffer Redis push failed, dropping row: {e}")
+                self._count('dropped')
+                return
+            self._count('buffered')
+        else:
+            with self._lock:
+                if len(self._rows) >= self.max_rows:
+                    self.stats['dropped'] += 1
+                    return
+                self._rows.append(row)
+                pending = len(self._rows)
+                self.stats['buffered'] += 1
+        self._ensure_thread()
+        if pending >= self.size:
+            self._wake.set()
+
+    def _count(self, stat, n=1):
+        # request threads and the flusher both update stats
+        with self._lock:
+            self.stats[stat] += n
+
+    def _ensure_thread(self):
+        # started lazily so each forked gunicorn worker gets its own flusher
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="log-buffer", daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Log buffer flush failed: {e}")
+
+    def _take(self):
+        if self.durable:
+            raw = self._claim(keys=[LOG_BUFFER_KEY, self.inflight_key], args=[self.size])
+            rows = [json.loads(r) for r in raw]
+            for row in rows:
+                row['timestamp'] = datetime.datetime.fromisoformat(row['timestamp'])
+            return rows
+        with self._lock:
+            rows, self._rows = self._rows[:self.size], self._rows[self.size:]
+            return rows
+
+    def _restore(self, rows):
+        if self.durable:
+            # rows stay on the in-flight list; hand them back for the next flush
+            while redis_conn.lmove(self.inflight_key, LOG_BUFFER_KEY, 'RIGHT', 'LEFT'):
+                pass
+            return
+        with self._lock:
+            room = self.max_rows - len(self._rows)
+            self.stats['dropped'] += max(0, len(rows) - room)
+            self._rows[:0] = rows[:max(0, room)]
+
+    def flush(self):
+        """Write everything buffered so far; returns the number of rows written."""
+        written = 0
+        with self._flush_lock, app.app_context():
+            while rows := self._take():
+                try:
+                    write_log_rows(rows)
+                except Exception:
+                    db_pg.session.rollback()
+                    self._restore(rows)
+                    raise
+                if self.durable:
+                    redis_conn.delete(self.inflight_key)
+                self._count('flushed', len(rows))
+                written += len(rows)
+        return written
+
+log_buffer = LogBuffer(LOG_BUFFER_SIZE, LOG_BUFFER_INTERVAL, LOG_BUFFER_MAX, LOG_BUFFER_DURABLE)
+
+@atexit.register
+def _flush_log_buffer_at_exit():
+    try:
+        log_buffer.flush()
+    except Exception as e:
+        print(f"Log buffer flush at exit failed: {e}")
+
+@bp.cli.command("flush-log-buffer")
+def flush_log_buffer_command():
+    """Write staged rows, including those left in flight by dead workers."""
+    if LOG_BUFFER_DURABLE:
+        for key in redis_conn.scan_iter('logbuf:inflight:*'):
+            while redis_conn.lmove(key, LOG_BUFFER_KEY, 'RIGHT', 'LEFT'):
+                pass
+    print(f"Flushed {log_buffer.flush()} row(s)")
+
+
+###################### EMAIL OUR ACCOUNT ######################
+# Emails and staff SMS are queued on the rq 'notify' queue so webhooks never
+# wait on Resend or Twilio. Failed deliveries are retried with exponential
+# backoff; once retries run out the job lands on the NOTIFY_DEAD_LETTER list
+# and the debugging number gets a text. Without REDIS_URL delivery is inline.
+
+NOTIFY_MAX_RETRIES = int(os.getenv("NOTIFY_MAX_RETRIES", "5"))
+NOTIFY_BACKOFF_BASE = int(os.getenv("NOTIFY_BACKOFF_BASE", "5"))  # seconds, doubled each retry
+NOTIFY_DEAD_LETTER = 'notify:dead'
+notify_queue = Queue('notify', connection=redis_conn) if redis_conn else None
+
+resend_http = LazyClient('resend', lambda: provider_session('resend'))
+
+def deliver_email(f, t, subject, html):
+    # straight to the Resend REST API so the pooled session is reused
+    with timed('resend', 'emails.send'):
+        r = resend_http.post(f"{RESEND_API_URL}/emails", json={
             "from": f,
-             "to": t, 
-             "subject": subject,
-             "html": html
-        })
+            "to": t,
+            "subject": subject,
+            "html": html
+        }, headers={"Authorization": f"Bearer {os.environ.get('RESEND_API_KEY')}"})
+        r.raise_for_status()
+
+def deliver_sms(body, to, from_=CALLER_ID):
+    twilio_client.messages.create(body=body, from_=from_, to=to)
+
+def _debug_sms(subject):
+    try:
+        deliver_sms(f"[DEBUG] {subject}", RECIPIENT_DEBUGGING)
     except Exception as e:
+        print(e, type(e))
 
-        twilio_client.messages.create(
-            body=f"[DEBUG] {subject}",
-            from_=CALLER_ID,          
-            to=RECIPIENT_DEBUGGING
-        )
+def notification_failed(job, connection, type, value, traceback):
+    """rq failure callback: dead-letter the job once its retries are used up."""
+    if job.retries_left:
+        return
+    connection.rpush(NOTIFY_DEAD_LETTER, json.dumps({
+        "func": job.func_name,
+        "args": job.args,
+        "error": repr(value),
+        "failed_at": france_now().isoformat(),
+    }))
+    if job.func_name.endswith('deliver_email'):
+        _debug_sms(job.args[2])
+
+def _enqueue_notification(func, *args):
+    if notify_queue is None:
+        return False
+    retry = Retry(max=NOTIFY_MAX_RETRIES,
+                  interval=[NOTIFY_BACKOFF_BASE * 2 ** i for i in range(NOTIFY_MAX_RETRIES)])
+    try:
+        with timed('redis', 'notify.enqueue'):
+            notify_queue.enqueue(func, *args, retry=retry, on_failure=notification_failed)
+        return True
+    except redis.exceptions.RedisError as e:
+        print(f"Notification enqueue failed, sending inline: {e}")
+        return False
 
+def send_email(f, t, subject, html):
+    if _enqueue_notification(deliver_email, f, t, subject, html):
+        return
+    try:
+        deliver_email(f, t, subject, html)
+    except Exception as e:
+        _debug_sms(subject)
         print(e, type(e))
         print(e.args)
 
+def send_sms(body, to, from_=CALLER_ID):
+    if _enqueue_notification(deliver_sms, body, to, from_):
+        return
+    try:
+        deliver_sms(body, to, from_)
+    except Exception as e:
+        print(e, type(e))
+
+## STAFF DIGESTS ##
+# Staff alerts (incoming SMS, voicemails) go out one email per event while
+# traffic is normal. Once more than DIGEST_THRESHOLD arrive within a
+# DIGEST_WINDOW-second window, further events are held and sent as a single
+# digest at the end of the window, grouped by sender, so a burst costs one
+# Resend call per window instead of one per event. With Redis the count and
+# the held events are shared by all workers and an rq job sends the digest;
+# otherwise each worker keeps its own and a timer thread sends it.
+# SMS forwarded to the volunteer on shift are coalesced the same way, into
+# one text per volunteer per window.
+
+DIGEST_THRESHOLD = int(os.getenv("DIGEST_THRESHOLD", "10"))  # events per window sent individually
+DIGEST_WINDOW = int(os.getenv("DIGEST_WINDOW", "60"))  # seconds
+DIGEST_KEY = 'notify:digest'
+SHIFT_DIGEST_KEY = 'notify:shift'
+SHIFT_SMS_MAX = 1600  # Twilio's limit for one message body
+coalescers = {}  # redis key -> DigestCoalescer, for the send_digest job
+
+class DigestCoalescer:
+    def __init__(self, threshold, window, conn=None, key=DIGEST_KEY, deliver=None):
+        self.threshold = threshold
+        self.window = window
+        self.conn = conn
+        self.key = key
+        self.deliver = deliver  # called with the held events
+        self.stats = {'immediate': 0, 'held': 0, 'digests': 0}
+        self._events = []
+        self._window_id = None
+        self._window_count = 0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def _count(self):
+        """Events so far in the current window, this one included."""
+        window_id = int(time.time() // self.window)
+        if self.conn is not None:
+            pipe = self.conn.pipeline()
+            pipe.incr(f"{self.key}:rate:{window_id}")
+            pipe.expire(f"{self.key}:rate:{window_id}", self.window * 2)
+            return pipe.execute()[0]
+        with self._lock:
+            if self._window_id != window_id:
+                self._window_id, self._window_count = window_id, 0
+            self._window_count += 1
+            return self._window_count
+
+    def hold(self, event):
+        """Stage `event` for the next digest if we're over the rate; False means send it now."""
+        try:
+            if self._count() <= self.threshold:
+                self.stats['immediate'] += 1
+                return False
+            if self.conn is not None:
+                self.conn.rpush(self.key, json.dumps(event))
+                if self.conn.set(f"{self.key}:scheduled", 1, nx=True, ex=self.window * 2):
+                    notify_queue.enqueue_in(datetime.timedelta(seconds=self.window), send_digest, self.key)
+            else:
+                with self._lock:
+                    self._events.append(event)
+                    if self._timer is None:
+                        self._timer = threading.Timer(self.window, self._flush_quietly)
+                        self._timer.daemon = True
+                        self._timer.start()
+        except redis.exceptions.RedisError as e:
+            print(f"Digest staging failed, sending now: {e}")
+            return False
+        self.stats['held'] += 1
+        return True
+
+    def _take(self):
+        if self.conn is not None:
+            # clear the flag first so an event arriving now schedules the next digest
+            self.conn.delete(f"{self.key}:scheduled")
+            pipe = self.conn.pipeline()
+            pipe.lrange(self.key, 0, -1)
+            pipe.delete(self.key)
+            return [json.loads(raw) for raw in pipe.execute()[0]]
+        with self._lock:
+            events, self._events, self._timer = self._events, [], None
+            return events
+
+    def flush(self):
+        """Send one digest of everything held; returns the number of events in it."""
+        events = self._take()
+        if events:
+            self.deliver(events)
+            self.stats['digests'] += 1
+        return len(events)
+
+    def _flush_quietly(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Digest flush failed: {e}")
+
+def email_digest(events):
+    send_email(FROM_EMAIL, RECIPIENT_EMAILS, *render_digest(events))
+
+def text_shift_digests(events):
+    """One SMS per volunteer with the messages held for them."""
+    by_volunteer = {}
+    for e in events:
+        by_volunteer.setdefault(e['to'], []).append(e)
+    for to, items in by_volunteer.items():
+        lines = [f"{len(items)} SMS since {items[0]['at'][11:16]}:"]
+        lines += [f"{e['sender']}: {e['body']}" for e in items]
+        send_sms("\n".join(lines)[:SHIFT_SMS_MAX], to)
+
+digests = DigestCoalescer(DIGEST_THRESHOLD, DIGEST_WINDOW, redis_conn, DIGEST_KEY, email_digest)
+shift_digests = DigestCoalescer(DIGEST_THRESHOLD, DIGEST_WINDOW, redis_conn, SHIFT_DIGEST_KEY, text_shift_digests)
+coalescers.update({c.key: c for c in (digests, shift_digests)})
+
+def send_digest(key=DIGEST_KEY):
+    """rq job: send the events held under `key`."""
+    coalescers[key].flush()
+
+def render_digest(events):
+    """(subject, html) for a digest of `events`, grouped by sender."""
+    kinds = Counter(e['kind'] for e in events)
+    by_sender = {}
+    for e in events:
+        by_sender.setdefault(e['sender'], []).append(e)
+    summary = ", ".join(f"{n} {kind}" for kind, n in kinds.most_common())
+    parts = [f"<h1>{len(events)} events from {len(by_sender)} senders</h1><p>{summary}</p>"]
+    for sender, items in sorted(by_sender.items(), key=lambda kv: -len(kv[1])):
+        parts.append(f"<h2>{sender} ({len(items)})</h2>")
+        for e in items:
+            parts.append(f"<div style='border-left:3px solid #ccc; padding-left:8px'>"
+                         f"<p><b>{e['at']}</b> {e['subject']}</p>{e['html']}</div>")
+    return f"Digest: {summary} since {events[0]['at'][:16]}", "".join(parts)
+
+def notify_staff(kind, sender, subject, html):
+    """Email RECIPIENT_EMAILS about an event, or hold it for the digest during a burst."""
+    event = {'kind': kind, 'sender': sender, 'subject': subject, 'html': html, 'at': france_now().isoformat()}
+    if not digests.hold(event):
+        send_email(FROM_EMAIL, RECIPIENT_EMAILS, subject, html)
+
+@bp.cli.command("send-digest")
+def send_digest_command():
+    """Send the pending digests now instead of waiting for the window to close."""
+    print(f"Sent {sum(c.flush() for c in coalescers.values())} held event(s)")
+
+@bp.cli.command("notify-retry-dead")
+def notify_retry_dead_command():
+    """Re-queue every dead-lettered notification."""
+    count = 0
+    while (raw := redis_conn.lpop(NOTIFY_DEAD_LETTER)) is not None:
+        entry = json.loads(raw)
+        func = deliver_email if entry["func"].endswith('deliver_email') else deliver_sms
+        _enqueue_notification(func, *entry["args"])
+        count += 1
+    print(f"Re-queued {count} notification(s)")
+
+
+###################### TWILIO SYNC ######################
+# Mirrors Twilio calls, recordings and transcriptions into CommunicationLog so
+# the admin pages can be served from Postgres. Run it once with
+# `flask sync-twilio`; with REDIS_URL set it keeps rescheduling itself on the
+# 'sync' queue (`rq worker --with-scheduler sync`).
+
+TWILIO_SYNC_INTERVAL = int(os.getenv("TWILIO_SYNC_INTERVAL", "60"))          # seconds between runs
+TWILIO_SYNC_OVERLAP = int(os.getenv("TWILIO_SYNC_OVERLAP", "30"))            # minutes re-read each run
+TWILIO_SYNC_BACKFILL_DAYS = int(os.getenv("TWILIO_SYNC_BACKFILL_DAYS", "7"))  # first run only
+TWILIO_SYNC_PAGE_SIZE = int(os.getenv("TWILIO_SYNC_PAGE_SIZE", "200"))
+TWILIO_SYNC_KEY = 'twilio'
+
+def _twilio_direction(direction):
+    return 'Inbound' if direction == 'inbound' else 'Outbound'
+
+def _upsert_twilio_rows(rows):
+    """Insert or update CommunicationLog rows keyed by Twilio call SID.
+
+    Rows carrying only recording/transcription fields (calls older than the
+    sync window) update an existing row and are never inserted.
+    """
+    sids = list(rows)
+    existing = {}
+    for i in range(0, len(sids), 500):
+        chunk = sids[i:i + 500]
+        for sid, log_id, old in (db_pg.session.query(CommunicationLog.provider_sid, CommunicationLog.id,
+                                                     CommunicationLog)
+                                 .filter(CommunicationLog.provider == 'Twilio',
+                                         CommunicationLog.provider_sid.in_(chunk))):
+            existing[sid] = (log_id, old)
+
+    inserts, updates, new_voicemails = [], [], {}
+    for sid, row in rows.items():
+        if sid in existing:
+            # don't blank out fields this run didn't see
+            log_id, old = existing[sid]
+            update = {k: v for k, v in row.items() if v is not None}
+            update.pop('help_type', None)  # already counted under the inserted value
+            update['id'] = log_id
+            updates.append(update)
+            if update.get('recording_url') and not old.recording_url:
+                key = rollup_key({c: getattr(old, c) for c in ('timestamp', 'provider', 'comm_type',
+                                                               'direction', 'help_type')})
+                new_voicemails.setdefault(key, [0, 0])[1] += 1
+        elif 'comm_type' in row:
+            inserts.append(row)
+
+    if inserts:
+        db_pg.session.bulk_insert_mappings(CommunicationLog, inserts)
+        bump_rollups(rollup_counts(inserts))
+    if updates:
+        db_pg.session.bulk_update_mappings(CommunicationLog, updates)
+        bump_rollups(new_voicemails)
+    return len(inserts), len(updates)
+
+def sync_twilio():
+    """One incremental pass over Twilio calls/recordings/transcriptions."""
+    lock = redis_conn.lock('lock:twilio-sync', timeout=600, blocking=False) if redis_conn else None
+    if lock and not lock.acquire():
+        print("Twilio sync already running, skipping")
+        return
+    try:
+        with app.app_context():
+            state = db_pg.session.get(SyncState, TWILIO_SYNC_KEY)
+            if state and state.value:
+                since = datetime.datetime.fromisoformat(state.value)
+            else:
+                since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=TWILIO_SYNC_BACKFILL_DAYS)
+            # re-read a window so in-progress calls and late recordings get picked up
+            window_start = since - datetime.timedelta(minutes=TWILIO_SYNC_OVERLAP)
+            high_water = since
+
+            rows = {}
+            for c in twilio_client.calls.stream(start_time_after=window_start, page_size=TWILIO_SYNC_PAGE_SIZE):
+                rows[c.sid] = {
+                    "provider": 'Twilio',
+                    "comm_type": 'Call',
+                    "direction": _twilio_direction(c.direction),
+                    "from_num": c.from_formatted or c.from_,
+                    "to_num": c.to,
+                    "status": c.status,
+                    "duration": int(c.duration) if c.duration else None,
+                    "content": f"Call {c.status}",
+                    "timestamp": paris_naive(c.start_time or c.date_created),
+                    "provider_sid": c.sid,
+                    # the IVR choice is only known from the live call's state
+                    "help_type": call_state.get(getattr(c, 'parent_call_sid', None) or c.sid).get('help_type'),
+                }
+                if c.start_time and c.start_time > high_water:
+                    high_water = c.start_time
+
+            recording_calls = {}
+            for rec in twilio_client.recordings.stream(date_created_after=window_start, page_size=TWILIO_SYNC_PAGE_SIZE):
+                if not rec.call_sid:
+                    continue
+                recording_calls[rec.sid] = rec.call_sid
+                row = rows.setdefault(rec.call_sid, {"provider_sid": rec.call_sid})
+                row["recording_url"] = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCT}/Recordings/{rec.sid}.mp3"
+
+            # transcriptions can't be filtered by date; they come newest first
+            for t in twilio_client.transcriptions.stream(page_size=TWILIO_SYNC_PAGE_SIZE):
+                if t.date_created and t.date_created < window_start:
+                    break
+                call_sid = recording_calls.get(t.recording_sid)
+                if call_sid and t.transcription_text:
+                    rows[call_sid]["content"] = t.transcription_text
+
+            inserted, updated = _upsert_twilio_rows(rows)
+
+            if state is None:
+                state = SyncState(key=TWILIO_SYNC_KEY)
+                db_pg.session.add(state)
+            state.value = high_water.isoformat()
+            db_pg.session.commit()
+            print(f"Twilio sync: {inserted} inserted, {updated} updated, high-water {state.value}")
+    finally:
+        if lock:
+            lock.release()
+        if sync_queue is not None:
+            # fixed job id, so repeated runs never stack up parallel chains
+            sync_queue.enqueue_in(datetime.timedelta(seconds=TWILIO_SYNC_INTERVAL), sync_twilio,
+                                  job_id='twilio-sync-next')
+
+@bp.cli.command("sync-twilio")
+def sync_twilio_command():
+    """Mirror recent Twilio calls into CommunicationLog."""
+    sync_twilio()
+
+
+###################### SHEETS MIRROR ######################
+# Appends new CommunicationLog rows to the response team's Google Sheet.
+# Rows go out in id order behind a SyncState high-water mark, one
+# append_rows call per batch. Ids are handed out at insert, not at commit,
+# so a lower id can commit after a higher one was mirrored. Ids skipped
+# below the mark are kept as gaps and checked again on every run for
+# SHEETS_GAP_TTL seconds; rolled-back inserts leave gaps that just expire. If Sheets answers 429 (60 writes/minute/user),
+# we back off with jitter and grow the batch so the backlog clears in fewer
+# calls. Payload errors and timeouts shrink the batch instead. Run once
+# with `flask mirror-sheets`; with REDIS_URL it reschedules itself on the
+# 'sync' queue like the Twilio sync.
+
+SHEETS_MIRROR_KEY = os.getenv("SHEETS_MIRROR_KEY")  # spreadsheet key from its URL; unset = mirror off
+SHEETS_MIRROR_WORKSHEET = os.getenv("SHEETS_MIRROR_WORKSHEET", "Log")
+SHEETS_MIRROR_INTERVAL = int(os.getenv("SHEETS_MIRROR_INTERVAL", "30"))  # seconds between runs
+SHEETS_BATCH_MIN = int(os.getenv("SHEETS_BATCH_MIN", "50"))
+SHEETS_BATCH_MAX = int(os.getenv("SHEETS_BATCH_MAX", "2000"))
+SHEETS_MAX_CALLS = int(os.getenv("SHEETS_MAX_CALLS", "30"))  # append calls per run, under the per-minute quota
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", "5"))
+SHEETS_BACKOFF_BASE = float(os.getenv("SHEETS_BACKOFF_BASE", "2"))  # seconds, doubled each retry
+SHEETS_GAP_TTL = int(os.getenv("SHEETS_GAP_TTL", "900"))  # longer than any log-writing transaction
+SHEETS_MAX_GAPS = 1000
+SHEETS_MIRROR_STATE = 'sheets'
+
+def build_sheets_worksheet():
+    import gspread
+    credentials = json.loads(os.environ['GOOGLE_SERVICE_ACCOUNT_JSON'])
+    spreadsheet = gspread.service_account_from_dict(credentials).open_by_key(SHEETS_MIRROR_KEY)
+    try:
+        return spreadsheet.worksheet(SHEETS_MIRROR_WORKSHEET)
+    except gspread.exceptions.WorksheetNotFound:
+        return spreadsheet.add_worksheet(SHEETS_MIRROR_WORKSHEET, rows=1000, cols=len(EXPORT_COLUMNS))
+
+sheets_worksheet = LazyClient('sheets', build_sheets_worksheet)
+
+class SheetsBatcher:
+    def __init__(self, size=SHEETS_BATCH_MIN * 4):
+        self.size = max(SHEETS_BATCH_MIN, min(SHEETS_BATCH_MAX, size))
+        self.stats = {'calls': 0, 'rows': 0, 'throttled': 0}
+
+    def append(self, worksheet, values):
+        """append_rows with backoff; adjusts self.size for the next batch."""
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            try:
+                with timed('sheets', 'values.append'):
+                    self.stats['calls'] += 1
+                    worksheet.append_rows(values, value_input_option='RAW')
+                self.stats['rows'] += len(values)
+                return
+            except Exception as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                if status == 429:
+                    # quota is counted in requests, so fewer, larger requests catch up sooner
+                    self.stats['throttled'] += 1
+                    self.size = min(SHEETS_BATCH_MAX, self.size * 2)
+                elif status in (413, 500, 502, 503, 504) or isinstance(e, requests.exceptions.Timeout):
+                    self.size = max(SHEETS_BATCH_MIN, self.size // 2)
+                else:
+                    raise
+                if attempt == SHEETS_MAX_RETRIES:
+                    raise
+                time.sleep(SHEETS_BACKOFF_BASE * 2 ** attempt + random.uniform(0, 1))
+
+sheets_batcher = SheetsBatcher()
+
+def sheet_values(row):
+    record = export_row(row)
+    return ['' if record[c] is None else record[c] for c in EXPORT_COLUMNS]
+
+def load_mirror_state(value):
+    """(high-water id, {skipped id: epoch first seen}) from the SyncState value."""
+    if not value:
+        return 0, {}
+    if value.isdigit():  # written before gaps were tracked
+        return int(value), {}
+    state = json.loads(value)
+    return state['id'], {int(k): t for k, t in state['gaps'].items()}
+
+def dump_mirror_state(high_water, gaps):
+    newest = sorted(gaps)[-SHEETS_MAX_GAPS:]
+    return json.dumps({'id': high_water, 'gaps': {str(i): gaps[i] for i in newest}})
+
+def mirror_to_sheets():
+    """Append CommunicationLog rows newer than the high-water mark to the sheet."""
+    if not SHEETS_MIRROR_KEY:
+        print("SHEETS_MIRROR_KEY not set, Sheets mirror off")
+        return
+    lock = redis_conn.lock('lock:sheets-mirror', timeout=600, blocking=False) if redis_conn else None
+    if lock and not lock.acquire():
+        print("Sheets mirror already running, skipping")
+        return
+    try:
+        with app.app_context():
+            state = db_pg.session.get(SyncState, SHEETS_MIRROR_STATE)
+            if state is None:
+                state = SyncState(key=SHEETS_MIRROR_STATE, value='0')
+                db_pg.session.add(state)
+            high_water, gaps = load_mirror_state(state.value)
+            now = time.time()
+            gaps = {i: t for i, t in gaps.items() if now - t < SHEETS_GAP_TTL}
+            header = []
+            if high_water == 0 and not sheets_worksheet.row_values(1):
+                header = [list(EXPORT_COLUMNS)]
+
+            mirrored = 0
+            for _ in range(SHEETS_MAX_CALLS):
+                pending = CommunicationLog.id > high_water
+                if gaps:
+                    pending = db_pg.or_(pending, CommunicationLog.id.in_(list(gaps)))
+                rows = (db_pg.session.query(*[getattr(CommunicationLog, c) for c in EXPORT_COLUMNS])
+                        .filter(pending).order_by(CommunicationLog.id).limit(sheets_batcher.size).all())
+                if not rows:
+                    break
+                sheets_batcher.append(sheets_worksheet, header + [sheet_values(r) for r in rows])
+                header = []
+                for row in rows:
+                    row_id = row[0]  # EXPORT_COLUMNS starts with id
+                    gaps.pop(row_id, None)
+                    if row_id > high_water:
+                        skipped = range(max(high_water + 1, row_id - SHEETS_MAX_GAPS), row_id)
+                        gaps.update((i, now) for i in skipped)
+                        high_water = row_id
+                state.value = dump_mirror_state(high_water, gaps)
+                db_pg.session.commit()
+                mirrored += len(rows)
+            print(f"Sheets mirror: {mirrored} row(s) appended, high-water id {high_water}, "
+                  f"{len(gaps)} gap(s) pending, next batch {sheets_batcher.size}")
+    finally:
+        if lock:
+            lock.release()
+        if sync_queue is not None:
+            sync_queue.enqueue_in(datetime.timedelta(seconds=SHEETS_MIRROR_INTERVAL), mirror_to_sheets,
+                                  job_id='sheets-mirror-next')
+
+@bp.cli.command("mirror-sheets")
+def mirror_sheets_command():
+    """Append new CommunicationLog rows to the response team's sheet."""
+    mirror_to_sheets()
+
+
+###################### CALL STATE ######################
+# What we know about a call in progress (language, help type, who was dialed)
+# keyed by Twilio CallSid or Nexmo conversation UUID. Twilio doesn't reliably
+# replay cookies between webhooks, so this replaces the Flask session. State
+# lives in a Redis hash per call when REDIS_URL is set, so every worker sees
+# it; otherwise in a process-local LRU. Either way entries expire after
+# CALL_STATE_TTL seconds.
+
+CALL_STATE_TTL = int(os.getenv("CALL_STATE_TTL", "21600"))
+CALL_STATE_MAX = int(os.getenv("CALL_STATE_MAX", "10000"))
+
+class CallStateStore:
+    def __init__(self, ttl, maxsize, conn=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.conn = conn
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, call_id):
+        """Return a copy of the call's state ({} if unknown or expired)."""
+        if not call_id:
+            return {}
+        if self.conn is not None:
+            try:
+                raw = self.conn.hgetall(f"call:{call_id}")
+                return {k.decode(): v.decode() for k, v in raw.items()}
+            except redis.exceptions.RedisError as e:
+                print(f"Call state lookup failed: {e}")
+                return {}
+        with self._lock:
+            hit = self._local.get(call_id)
+            if hit is None:
+                return {}
+            expires, state = hit
+            if expires < time.monotonic():
+                del self._local[call_id]
+                return {}
+            self._local.move_to_end(call_id)
+            return dict(state)
+
+    def update(self, call_id, **fields):
+        if not call_id:
+            return
+        now = france_now().isoformat()
+        fields = {k: str(v) for k, v in fields.items() if v is not None}
+        fields['updated'] = now
+        if self.conn is not None:
+            key = f"call:{call_id}"
+            try:
+                pipe = self.conn.pipeline()
+                pipe.hsetnx(key, 'created', now)
+                pipe.hset(key, mapping=fields)
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+            except redis.exceptions.RedisError as e:
+                print(f"Call state update failed: {e}")
+            return
+        with self._lock:
+            _, state = self._local.pop(call_id, (None, {'created': now}))
+            state.update(fields)
+            self._local[call_id] = (time.monotonic() + self.ttl, state)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+
+call_state = CallStateStore(CALL_STATE_TTL, CALL_STATE_MAX, redis_conn)
+
+
+###################### WEBHOOK IDEMPOTENCY ######################
+# Twilio and Nexmo retry a webhook that times out, so the same event can
+# arrive several times. Each handler claims the event's provider ID in a
+# seen-set first (a Redis SET NX, or a process-local TTL map without Redis)
+# and answers a replay straight away without emailing or logging again. The
+# WebhookReceipt primary key backs this up for the log rows themselves, for
+# replays that outlive WEBHOOK_SEEN_TTL or land on another worker.
+
+WEBHOOK_SEEN_TTL = int(os.getenv("WEBHOOK_SEEN_TTL", "86400"))
+WEBHOOK_SEEN_MAX = int(os.getenv("WEBHOOK_SEEN_MAX", "50000"))
+WEBHOOK_RECEIPT_DAYS = int(os.getenv("WEBHOOK_RECEIPT_DAYS", "30"))
+
+class SeenSet:
+    def __init__(self, ttl, maxsize, conn=None):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.conn = conn
+        self.duplicates = {}
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, key):
+        """True the first time `key` is seen within the TTL, False for a replay."""
+        if self.conn is not None:
+            try:
+                return bool(self.conn.set(f"webhook:{key}", 1, nx=True, ex=self.ttl))
+            except redis.exceptions.RedisError as e:
+                print(f"Webhook seen-set check failed: {e}")
+                return True  # WebhookReceipt still keeps the log clean
+        now = time.monotonic()
+        with self._lock:
+            expires = self._local.get(key)
+            if expires is not None and expires > now:
+                return False
+            self._local[key] = now + self.ttl
+            self._local.move_to_end(key)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+            return True
+
+    def release(self, key):
+        """Forget `key` so the provider's retry is processed again."""
+        if self.conn is not None:
+            try:
+                self.conn.delete(f"webhook:{key}")
+            except redis.exceptions.RedisError as e:
+                print(f"Webhook seen-set release failed: {e}")
+            return
+        with self._lock:
+            self._local.pop(key, None)
+
+webhook_seen = SeenSet(WEBHOOK_SEEN_TTL, WEBHOOK_SEEN_MAX, redis_conn)
+
+def webhook_key(kind, event_id):
+    return f"{kind}:{event_id}" if event_id else None
+
+def idempotent(kind, event_id, replay_response):
+    """Run the webhook once per provider event ID; replays get `replay_response()`.
+
+    `event_id(request)` extracts the ID; the claimed key is left in g.webhook_key
+    for the handler to pass to log_buffer.add(receipt=...).
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            key = webhook_key(kind, event_id(request))
+            g.webhook_key = key
+            if key and not webhook_seen.claim(key):
+                webhook_seen.duplicates[kind] = webhook_seen.duplicates.get(kind, 0) + 1
+                return replay_response()
+            try:
+                return f(*args, **kwargs)
+            except Exception:
+                if key:
+                    webhook_seen.release(key)
+                raise
+        return decorated
+    return decorator
+
+@bp.cli.command("prune-webhook-receipts")
+@click.option("--days", default=WEBHOOK_RECEIPT_DAYS, show_default=True)
+def prune_webhook_receipts_command(days):
+    """Delete receipts older than any provider would still retry."""
+    cutoff = france_now() - datetime.timedelta(days=days)
+    deleted = WebhookReceipt.query.filter(WebhookReceipt.received < cutoff).delete()
+    db_pg.session.commit()
+    print(f"Deleted {deleted} webhook receipt(s)")
+
+
+###################### CALLER RATE LIMITING ######################
+# Every inbound call or SMS costs us outbound work (staff SMS, dials, emails,
+# a log row), so each caller gets a token bucket per route before any of that
+# happens. A throttled or blocklisted caller gets a canned TwiML/NCCO answer
+# and nothing else. Buckets live in Redis (shared by all workers) when
+# REDIS_URL is set, otherwise per worker. Limits are "<requests>/<seconds>":
+# the bucket holds <requests> tokens and refills over <seconds>.
+#
+# The blocklist/allowlist is the CallerListEntry table, held in memory as a
+# dict and reloaded every CALLER_LIST_TTL seconds; manage it with
+# `flask callers block|allow|remove|list`.
+
+RATE_LIMITS = {
+    'call': os.getenv("RATE_LIMIT_CALL", "6/3600"),
+    'sms': os.getenv("RATE_LIMIT_SMS", "10/3600"),
+}
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+CALLER_LIST_TTL = int(os.getenv("CALLER_LIST_TTL", "30"))
+
+# refill the bucket for the time elapsed, then try to take one token
+_TAKE_TOKEN = """
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local capacity, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return allowed
+"""
+
+def parse_rate(spec):
+    """'6/3600' -> (capacity 6, refill 6/3600 tokens per second)."""
+    count, seconds = spec.split('/')
+    return float(count), float(count) / float(seconds)
+
+def caller_key(number):
+    """Provider-neutral form of a phone number: Twilio sends +33..., Nexmo 33..."""
+    e164 = phone_numbers.normalize(number).e164
+    if e164:
+        return e164[1:]
+    digits = re.sub(r'\D', '', number or '')
+    return digits[2:] if digits.startswith('00') else digits
+
+class TokenBuckets:
+    def __init__(self, limits, maxsize, conn=None):
+        self.limits = {group: parse_rate(spec) for group, spec in limits.items()}
+        self.maxsize = maxsize
+        self.conn = conn
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+        if conn is not None:
+            self._take = conn.register_script(_TAKE_TOKEN)
+
+    def allow(self, group, key):
+        capacity, rate = self.limits[group]
+        now = time.time()
+        if self.conn is not None:
+            try:
+                ttl = int(capacity / rate) + 60  # a full bucket needs no state
+                return bool(self._take(keys=[f"ratelimit:{key}"], args=[capacity, rate, now, ttl]))
+            except redis.exceptions.RedisError as e:
+                print(f"Rate limit check failed, allowing: {e}")
+                return True
+        with self._lock:
+            tokens, ts = self._local.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + max(0.0, now - ts) * rate)
+            allowed = tokens >= 1
+            self._local[key] = (tokens - 1 if allowed else tokens, now)
+            while len(self._local) > self.maxsize:
+                self._local.popitem(last=False)
+            return allowed
+
+class CallerLists:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def kind(self, number):
+        """'block', 'allow' or None for `number`."""
+        if time.monotonic() >= self._expires:
+            self.reload()
+        return self._entries.get(caller_key(number))
+
+    def reload(self):
+        with self._lock:
+            try:
+                with app.app_context():
+                    self._entries = dict(db_pg.session.query(CallerListEntry.number, CallerListEntry.kind))
+            except Exception as e:
+                print(f"Caller list load failed: {e}")  # keep the last good copy
+            self._expires = time.monotonic() + self.ttl
+
+rate_buckets = TokenBuckets(RATE_LIMITS, RATE_LIMIT_MAX_KEYS, redis_conn)
+caller_lists = CallerLists(CALLER_LIST_TTL)
+throttle_stats = {}
+
+def rate_limited(group, caller, throttled_response):
+    """Shed `caller(request)` with `throttled_response()` if blocklisted or over the `group` limit.
+
+    Buckets are per caller and per route, so a caller stuck at the IVR menu
+    doesn't use up their SMS allowance.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            number = caller(request)
+            if number:
+                kind = caller_lists.kind(number)
+                if kind == 'block' or (kind != 'allow' and
+                                       not rate_buckets.allow(group, f"{request.path}:{caller_key(number)}")):
+                    stat = (request.path, 'blocked' if kind == 'block' else 'rate')
+                    throttle_stats[stat] = throttle_stats.get(stat, 0) + 1
+                    return throttled_response()
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+def _twilio_caller(req):
+    return req.values.get('From')
+
+def _nexmo_caller(req):
+    data = req.get_json(silent=True) or {}
+    return data.get('from') or data.get('msisdn') or req.args.get('from') or req.args.get('msisdn')
+
+callers_cli = AppGroup('callers', help="Manage the caller blocklist and allowlist.")
+
+@callers_cli.command("list")
+def callers_list():
+    for entry in CallerListEntry.query.order_by(CallerListEntry.kind, CallerListEntry.number):
+        print(f"{entry.kind}\t{entry.number}\t{entry.note or ''}")
+
+def _save_caller(number, kind, note):
+    entry = db_pg.session.get(CallerListEntry, caller_key(number)) or CallerListEntry(number=caller_key(number))
+    entry.kind, entry.note = kind, note
+    db_pg.session.add(entry)
+    db_pg.session.commit()
+    print(f"{kind.capitalize()}ed {entry.number} (workers pick this up within {CALLER_LIST_TTL}s)")
+
+@callers_cli.command("block")
+@click.argument("number")
+@click.option("--note")
+def callers_block(number, note):
+    _save_caller(number, 'block', note)
+
+@callers_cli.command("allow")
+@click.argument("number")
+@click.option("--note")
+def callers_allow(number, note):
+    _save_caller(number, 'allow', note)
+
+@callers_cli.command("remove")
+@click.argument("number")
+def callers_remove(number):
+    CallerListEntry.query.filter_by(number=caller_key(number)).delete()
+    db_pg.session.commit()
+    print(f"Removed {caller_key(number)}")
+
+bp.cli.add_command(callers_cli)
+
+
+###################### SCHEDULE ######################
+# When the hotline is open and who is on shift, from ScheduleRule rows (see
+# schedule.py). The rules are compiled over SCHEDULE_DAYS days into a sorted
+# segment index and reloaded every SCHEDULE_TTL seconds. The coverage answer
+# is reused for the rest of the minute. Calls and SMS both route through
+# schedule.now(). Without any 'open' rule the line keeps SCHEDULE_DEFAULT_HOURS
+# every day. Without any 'shift' rule every active volunteer counts as on duty.
+
+SCHEDULE_TZ = ZoneInfo("Europe/Paris")
+SCHEDULE_DEFAULT_HOURS = os.getenv("SCHEDULE_DEFAULT_HOURS", "10:00-22:00")
+SCHEDULE_TTL = int(os.getenv("SCHEDULE_TTL", "60"))
+SCHEDULE_DAYS = 8
+
+def schedule_rules():
+    rules = [hotline_schedule.Rule(r.kind, hotline_schedule.parse_days(r.days), r.start, r.end,
+                                   r.date_from, r.date_to, r.number)
+             for r in ScheduleRule.query.order_by(ScheduleRule.id)]
+    if not any(r.kind == 'open' for r in rules):
+        rules.append(hotline_schedule.Rule('open', frozenset(), *hotline_schedule.parse_window(SCHEDULE_DEFAULT_HOURS)))
+    return rules
+
+class Schedule:
+    def __init__(self, load=schedule_rules):
+        self.load = load
+        self._compiled = None
+        self._expires = 0
+        self._current = (None, None)  # (minute, Coverage)
+        self._lock = threading.Lock()
+
+    def compiled(self, ts=None):
+        ts = time.time() if ts is None else ts
+        compiled = self._compiled
+        if compiled is not None and time.monotonic() < self._expires and compiled.covers(ts):
+            return compiled
+        with self._lock:
+            if self._compiled is not compiled:
+                return self._compiled  # another thread just rebuilt it
+            try:
+                with app.app_context():
+                    rules = self.load()
+            except Exception as e:
+                print(f"Schedule load failed: {e}")
+                if compiled is not None and compiled.covers(ts):
+                    return compiled
+                rules = [hotline_schedule.Rule('open', frozenset(), *hotline_schedule.parse_window(SCHEDULE_DEFAULT_HOURS))]
+            # start a day back so shifts running past midnight are included
+            first_day = datetime.datetime.fromtimestamp(ts, SCHEDULE_TZ).date() - datetime.timedelta(days=1)
+            self._compiled = hotline_schedule.compile_schedule(rules, first_day, SCHEDULE_DAYS, SCHEDULE_TZ)
+            self._expires = time.monotonic() + SCHEDULE_TTL
+            self._current = (None, None)
+            return self._compiled
+
+    def now(self):
+        """Coverage for the current minute."""
+        ts = time.time()
+        minute = int(ts // 60)
+        cached_minute, coverage = self._current
+        if minute == cached_minute and ts < coverage.until:
+            return coverage
+        coverage = self.compiled(ts).at(ts)
+        self._current = (minute, coverage)
+        return coverage
+
+    def invalidate(self):
+        self._expires = 0
+        self._current = (None, None)
+
+schedule = Schedule()
+
+schedule_cli = AppGroup('schedule', help="Manage opening hours, closures and volunteer shifts.")
+
+@schedule_cli.command("list")
+def schedule_list():
+    for r in ScheduleRule.query.order_by(ScheduleRule.id):
+        dates = f" {r.date_from or ''}..{r.date_to or ''}" if r.date_from or r.date_to else ''
+        print(f"{r.id}\t{r.kind}\t{r.days or 'daily'}{dates}\t{r.start:%H:%M}-{'24:00' if r.end == datetime.time(0) else f'{r.end:%H:%M}'}\t{r.number or ''}\t{r.note or ''}")
+
+@schedule_cli.command("add")
+@click.argument("kind", type=click.Choice(hotline_schedule.KINDS))
+@click.argument("window")
+@click.option("--days", default='', help="e.g. mon-fri or sat,sun; every day if omitted")
+@click.option("--from", "date_from", type=click.DateTime(['%Y-%m-%d']), help="first date the rule applies")
+@click.option("--to", "date_to", type=click.DateTime(['%Y-%m-%d']), help="last date the rule applies")
+@click.option("--number", help="volunteer on the shift")
+@click.option("--note")
+def schedule_add(kind, window, days, date_from, date_to, number, note):
+    """Add a rule; WINDOW is HH:MM-HH:MM in Paris time."""
+    try:
+        start, end = hotline_schedule.parse_window(window)
+        days = hotline_schedule.format_days(hotline_schedule.parse_days(days)) if days else ''
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    if kind == 'shift':
+        number = phone_numbers.normalize(number).e164
+        if not number:
+            raise click.BadParameter("a shift needs a valid --number")
+    rule = ScheduleRule(kind=kind, days=days, start=start, end=end, number=number, note=note,
+                        date_from=date_from and date_from.date(), date_to=date_to and date_to.date())
+    db_pg.session.add(rule)
+    db_pg.session.commit()
+    print(f"Added rule {rule.id}")
+
+@schedule_cli.command("remove")
+@click.argument("rule_id", type=int)
+def schedule_remove(rule_id):
+    ScheduleRule.query.filter_by(id=rule_id).delete()
+    db_pg.session.commit()
+    print(f"Removed rule {rule_id}")
+
+@schedule_cli.command("show")
+@click.option("--days", default=2, help="how many days ahead to print")
+def schedule_show(days):
+    """Print when coverage changes over the next few days."""
+    now = time.time()
+    for ts, coverage in schedule.compiled(now).changes():
+        if now - 86400 < ts < now + days * 86400:
+            duty = '' if coverage.on_duty is None else ' ' + (', '.join(sorted(coverage.on_duty)) or 'nobody on shift')
+            print(f"{datetime.datetime.fromtimestamp(ts, SCHEDULE_TZ):%a %Y-%m-%d %H:%M}\t{'open' if coverage.open else 'closed'}{duty}")
+
+bp.cli.add_command(schedule_cli)
+
+
+###################### VOLUNTEER ROUTING ######################
+# Picks which volunteer to dial. The roster comes from the Volunteer table
+# (cached for ROUTING_ROSTER_TTL seconds); per-volunteer load lives in a Redis
+# hash route:<number> (in-flight dials, last dial time, no-answer rate) so
+# every worker sees the same picture. Strategies:
+#   least_busy  - fewest in-flight dials, then lowest no-answer rate, then
+#                 longest since last dialed
+#   round_robin - rotate through idle volunteers via a shared counter
+
+ROUTING_STRATEGY = os.getenv("ROUTING_STRATEGY", "least_busy")
+ROUTING_ROSTER_TTL = int(os.getenv("ROUTING_ROSTER_TTL", "60"))
+ROUTING_INFLIGHT_TTL = int(os.getenv("ROUTING_INFLIGHT_TTL", "900"))  # forget dials Twilio never reported back
+ROUTING_NO_ANSWER_WEIGHT = float(os.getenv("ROUTING_NO_ANSWER_WEIGHT", "0.2"))  # EWMA weight of the latest outcome
+ROUTING_STATE_TTL = 7 * 24 * 3600
+
+# decrement in-flight and fold the outcome into the no-answer moving average
+_FINISH_DIAL = """
+local inflight = tonumber(redis.call('HGET', KEYS[1], 'inflight') or '0')
+if inflight > 0 then redis.call('HINCRBY', KEYS[1], 'inflight', -1) end
+local rate = tonumber(redis.call('HGET', KEYS[1], 'no_answer') or '0')
+local w = tonumber(ARGV[2])
+redis.call('HSET', KEYS[1], 'no_answer', rate * (1 - w) + tonumber(ARGV[1]) * w)
+redis.call('HINCRBY', KEYS[1], 'attempts', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+class VolunteerRouter:
+    def __init__(self, conn=None, strategy=ROUTING_STRATEGY):
+        self.conn = conn
+        self.strategy = strategy
+        self._roster = None
+        self._roster_expires = 0
+        self._local = {}   # number -> state dict when there is no Redis
+        self._rr = {}
+        self._lock = threading.Lock()
+        if conn is not None:
+            self._finish = conn.register_script(_FINISH_DIAL)
+
+    def roster(self):
+        """{role: [numbers]} for active volunteers, falling back to RECIPIENT* env vars."""
+        if self._roster is not None and time.monotonic() < self._roster_expires:
+            return self._roster
+        roster = {}
+        try:
+            with app.app_context():
+                for v in Volunteer.query.filter_by(active=True).order_by(Volunteer.id):
+                    for role in (v.roles or '').split(','):
+                        roster.setdefault(role.strip(), []).append(v.number)
+        except Exception as e:
+            print(f"Volunteer roster load failed: {e}")
+            if self._roster is not None:
+                return self._roster
+        if not roster:
+            pool = [n for n in (RECIPIENT1, RECIPIENT2, RECIPIENT3, RECIPIENT4) if n]
+            roster = {'voter': pool, 'general': pool}
+        roster.setdefault('media', [RECIPIENT_MEDIA])
+        self._roster = roster
+        self._roster_expires = time.monotonic() + ROUTING_ROSTER_TTL
+        return roster
+
+    def _states(self, numbers):
+        if self.conn is not None:
+            try:
+                pipe = self.conn.pipeline(transaction=False)
+                for n in numbers:
+                    pipe.hgetall(f"route:{n}")
+                raw = pipe.execute()
+                return [{k.decode(): v.decode() for k, v in h.items()} for h in raw]
+            except redis.exceptions.RedisError as e:
+                print(f"Routing state lookup failed: {e}")
+                return [{} for _ in numbers]
+        with self._lock:
+            return [dict(self._local.get(n, {})) for n in numbers]
+
+    @staticmethod
+    def _inflight(state, now):
+        # a dial Twilio never called back about shouldn't pin a volunteer forever
+        if now - float(state.get('last_dialed', 0)) > ROUTING_INFLIGHT_TTL:
+            return 0
+        return int(state.get('inflight', 0))
+
+    def choose(self, role, on_duty=None):
+        """Pick a volunteer for `role`; `on_duty` limits it to those on shift."""
+        roster = self.roster()
+        numbers = roster.get(role) or roster.get('general') or []
+        if on_duty is not None:
+            numbers = ([n for n in roster.get(role, []) if n in on_duty]
+                       or [n for n in roster.get('general', []) if n in on_duty])
+        if not numbers:
+            return None
+        if len(numbers) == 1:
+            return numbers[0]
+        now = time.time()
+        states = self._states(numbers)
+        if self.strategy == 'round_robin':
+            idle = [n for n, st in zip(numbers, states) if self._inflight(st, now) == 0] or numbers
+            return idle[self._next_index(role) % len(idle)]
+        return min(zip(numbers, states), key=lambda ns: (
+            self._inflight(ns[1], now),
+            round(float(ns[1].get('no_answer', 0)), 1),
+            float(ns[1].get('last_dialed', 0)),
+        ))[0]
+
+    def _next_index(self, role):
+        if self.conn is not None:
+            try:
+                return self.conn.incr(f"route:rr:{role}")
+            except redis.exceptions.RedisError:
+                pass
+        with self._lock:
+            self._rr[role] = self._rr.get(role, 0) + 1
+            return self._rr[role]
+
+    def begin(self, number):
+        """Record that we are about to dial `number`."""
+        now = time.time()
+        if self.conn is not None:
+            try:
+                pipe = self.conn.pipeline(transaction=False)
+                pipe.hincrby(f"route:{number}", 'inflight', 1)
+                pipe.hset(f"route:{number}", 'last_dialed', now)
+                pipe.expire(f"route:{number}", ROUTING_STATE_TTL)
+                pipe.execute()
+            except redis.exceptions.RedisError as e:
+                print(f"Routing state update failed: {e}")
+            return
+        with self._lock:
+            state = self._local.setdefault(number, {})
+            state['inflight'] = self._inflight(state, now) + 1
+            state['last_dialed'] = now
+
+    def finish(self, number, answered):
+        """Record the outcome of a dial started with begin()."""
+        missed = 0 if answered else 1
+        if self.conn is not None:
+            try:
+                self._finish(keys=[f"route:{number}"], args=[missed, ROUTING_NO_ANSWER_WEIGHT, ROUTING_STATE_TTL])
+            except redis.exceptions.RedisError as e:
+                print(f"Routing state update failed: {e}")
+            return
+        with self._lock:
+            state = self._local.setdefault(number, {})
+            state['inflight'] = max(0, int(state.get('inflight', 0)) - 1)
+            rate = float(state.get('no_answer', 0))
+            state['no_answer'] = rate * (1 - ROUTING_NO_ANSWER_WEIGHT) + missed * ROUTING_NO_ANSWER_WEIGHT
+            state['attempts'] = int(state.get('attempts', 0)) + 1
+
+router = VolunteerRouter(redis_conn)
+
+def choose_recipient(role='general'):
+    return router.choose(role, schedule.now().on_duty)
+
+volunteers_cli = AppGroup('volunteers', help="Manage the volunteer roster used for call routing.")
+
+@volunteers_cli.command("list")
+def volunteers_list():
+    for v in Volunteer.query.order_by(Volunteer.id):
+        print(f"{v.id}\t{v.number}\t{v.name or ''}\t{v.roles}\t{'active' if v.active else 'inactive'}")
+
+@volunteers_cli.command("add")
+@click.argument("number")
+@click.option("--name")
+@click.option("--roles", default="voter,general", help="Comma-separated: voter, general, media.")
+def volunteers_add(number, name, roles):
+    number = correct_number(number)[0]
+    if number == 'invalid':
+        raise click.BadParameter("not a phone number", param_hint="NUMBER")
+    volunteer = Volunteer.query.filter_by(number=number).first() or Volunteer(number=number)
+    volunteer.name, volunteer.roles, volunteer.active = name, roles, True
+    db_pg.session.add(volunteer)
+    db_pg.session.commit()
+    print(f"Saved {number} ({roles})")
+
+@volunteers_cli.command("import")
+@click.argument("csv_file", type=click.File('r', encoding='utf-8-sig'))
+@click.option("--roles", default="voter,general", help="Used when the file has no roles column.")
+def volunteers_import(csv_file, roles):
+    """Add or update volunteers from a CSV with number[, name, roles] columns."""
+    records = [r for r in csv.DictReader(csv_file) if r.get('number')]
+    normalized = phone_numbers.normalize_many([r['number'] for r in records])
+    existing = {v.number: v for v in Volunteer.query}
+    saved, skipped = set(), []
+    for record, result in zip(records, normalized):
+        if not result.e164:
+            skipped.append(record['number'])
+            continue
+        volunteer = existing.get(result.e164) or Volunteer(number=result.e164)
+        existing[result.e164] = volunteer
+        volunteer.name = record.get('name') or volunteer.name
+        volunteer.roles = record.get('roles') or roles
+        volunteer.active = True
+        db_pg.session.add(volunteer)
+        saved.add(result.e164)
+    db_pg.session.commit()
+    print(f"Saved {len(saved)} volunteer(s)" + (f"; skipped invalid numbers: {', '.join(skipped)}" if skipped else ""))
+
+@volunteers_cli.command("remove")
+@click.argument("number")
+def volunteers_remove(number):
+    number = clean_number(number)
+    Volunteer.query.filter_by(number=number).update({'active': False})
+    db_pg.session.commit()
+    print(f"Deactivated {number}")
+
+bp.cli.add_command(volunteers_cli)
+
 
 ###################### ROUTES #########################
 
 
 ## RECEIVE SMS ##
-@app.route("/receive_sms", methods=['GET', 'POST'])
+@bp.route("/receive_sms", methods=['GET', 'POST'])
 @csrf.exempt
+@idempotent('twilio-sms', lambda r: r.values.get('MessageSid'), lambda: str(MessagingResponse()))
+@rate_limited('sms', _twilio_caller, lambda: str(MessagingResponse()))
 def receive_sms():
     ## GET INCOMING INFO ##
     msg = request.form['Body'] # THE TEXT ITSELF
@@ -173,113 +2095,189 @@ def receive_sms():
     now = france_now()
     subject = f"Incoming SMS from {number} @ {now.isoformat()}"
     html = f"<p>To: {to}</p><p>From: {number}</p><p>Body: {msg}</p>"
-    send_email(FROM_EMAIL, RECIPIENT_EMAILS, subject, html)
+    notify_staff('SMS', number, subject, html)
+    forward_to_shift(number, msg)
     return str(MessagingResponse())
 
-## RECEIVE CALL ##
-@app.route("/receive_call", methods=['GET', 'POST'])
-@csrf.exempt
-def receive_call():
-    print("RECEIVE_CALL")
-    # Start our TwiML response
-    resp = VoiceResponse()
+def forward_to_shift(sender, body):
+    """Text an inbound SMS to a volunteer on shift, when shifts are scheduled.
 
+    During a burst the forwards are held and each volunteer gets one text
+    per DIGEST_WINDOW, like the staff digest.
+    """
+    coverage = schedule.now()
+    if not coverage.open or coverage.on_duty is None:
+        return
+    to = router.choose('general', coverage.on_duty)
+    if not to:
+        return
+    event = {'to': to, 'sender': sender, 'body': body, 'at': france_now().isoformat()}
+    if not shift_digests.hold(event):
+        send_sms(f"SMS from {sender}: {body}"[:320], to)
+
+## PREBUILT TWIML ##
+# The IVR prompts only depend on the language and the prompt URLs, which are
+# read from the environment once at startup, so each variant is serialized
+# once per worker and served as bytes. Builders return a VoiceResponse;
+# prebuilt_twiml() is the only place that serializes them.
+_twiml_cache = {}
+
+def twiml_response(body):
+    return Response(body, mimetype='text/xml')
+
+def prebuilt_twiml(builder, *args):
+    """Serve builder(*args) as XML, building it at most once per worker."""
+    key = (builder.__name__,) + args
+    body = _twiml_cache.get(key)
+    if body is None:
+        body = _twiml_cache[key] = str(builder(*args)).encode('utf-8')
+    return twiml_response(body)
+
+def build_intro():
+    resp = VoiceResponse()
     # Read a message aloud to the caller
     g = Gather(num_digits=1, action='/intro') # looking for one digit
     g.play(INTRO_URL, loop=1)
     resp.append(g)
     resp.redirect('/intro')
-    return str(resp)
+    return resp
 
-@app.route("/intro", methods=['GET', 'POST'])
-@csrf.exempt
-def receive_language_digits():
-    print("GOT HERE  - language digits")
+def build_language_menu(language):
     resp = VoiceResponse()
-    if 'Digits' in request.values.to_dict(flat=False):
-        choice = request.values.to_dict(flat=False)['Digits'][0]
-        if choice == "2":
-            session['language'] = 'french'
-            g = Gather(num_digits=1, action='/route')
-            g.play(FRENCH_URL, loop=3)
-            resp.append(g)
-            resp.redirect('/route')
-            return str(resp)
-    session['language'] = 'english'
     g = Gather(num_digits=1, action='/route')
-    g.play(ENGLISH_URL, loop=3)
+    g.play(FRENCH_URL if language == 'french' else ENGLISH_URL, loop=3)
     resp.append(g)
     resp.redirect('/route')
-    return str(resp)
+    return resp
+
+def build_retry_menu():
+    resp = VoiceResponse()
+    resp.say("I'm sorry, I didn't quite get that.")
+    resp.redirect("/route")
+    return resp
 
-@app.route("/route", methods=["GET", "POST"])
+def build_voicemail(language):
+    resp = VoiceResponse()
+    if language == 'english':
+        resp.play(VOICEMAIL_ENGLISH_URL)
+    elif language == 'french':
+        resp.play(VOICEMAIL_FRENCH_URL)
+    resp.record(max_length="60", transcribe=True, action="/postscript", transcribe_callback="/send_transcription")
+    resp.redirect("/postscript")
+    return resp
+
+def build_reject():
+    # refused before answering: Twilio doesn't bill the call
+    resp = VoiceResponse()
+    resp.reject(reason='busy')
+    return resp
+
+def build_hangup():
+    resp = VoiceResponse()
+    resp.hangup()
+    return resp
+
+def build_postscript():
+    resp = VoiceResponse()
+    resp.say("Thanks for your message.")
+    resp.play(FDR_URL)
+    resp.hangup()
+    return resp
+
+## RECEIVE CALL ##
+@bp.route("/receive_call", methods=['GET', 'POST'])
 @csrf.exempt
+@rate_limited('call', _twilio_caller, lambda: prebuilt_twiml(build_reject))
+def receive_call():
+    print("RECEIVE_CALL")
+    return prebuilt_twiml(build_intro)
+
+@bp.route("/intro", methods=['GET', 'POST'])
+@csrf.exempt
+def receive_language_digits():
+    print("GOT HERE  - language digits")
+    language = 'french' if request.values.get('Digits') == "2" else 'english'
+    call_state.update(request.values.get('CallSid'), language=language, caller=request.values.get('From'))
+    return prebuilt_twiml(build_language_menu, language)
+
+@bp.route("/route", methods=["GET", "POST"])
+@csrf.exempt
+@rate_limited('call', _twilio_caller, lambda: prebuilt_twiml(build_hangup))
 def french_route():
-    resp = VoiceResponse()
-    if not is_business_hours():
-        resp.redirect('/end_call')
-        return str(resp)
+    coverage = schedule.now()
+    call_sid = request.values.get('CallSid')
+    if not coverage.open:
+        return prebuilt_twiml(build_voicemail, call_state.get(call_sid).get('language', 'english'))
     choice = request.values.get('Digits')
 
     if choice in ['1', '2', '3']:
-        language = session.get('language', 'english')
-        to_call = whomst_to_call(choice, language)
+        language = call_state.get(call_sid).get('language', 'english')
+        to_call = whomst_to_call(choice, language, coverage)
         help_type = get_help_type(choice)
+        if to_call is None:
+            # nobody on shift for this: straight to voicemail instead of a dial that can't be answered
+            call_state.update(call_sid, help_type=help_type)
+            return prebuilt_twiml(build_voicemail, language)
         incoming_caller_id = request.values.get('From')
         message_body = f"Caller {incoming_caller_id} with {help_type} (in {language})."
-        message = twilio_client.messages.create(body=message_body, from_=CALLER_ID, to=to_call)
+        send_sms(message_body, to_call)
+        router.begin(to_call)
+        call_state.update(call_sid, help_type=help_type, recipient=to_call, dialed=france_now().isoformat())
+        resp = VoiceResponse()
         resp.dial(to_call, timeout=12, action="/end_call")
-        return str(resp)
-    resp.say("I'm sorry, I didn't quite get that.")
-    resp.redirect("/route")
-    return str(resp)
+        return twiml_response(str(resp))
+    return prebuilt_twiml(build_retry_menu)
 
-@app.route("/end_call", methods=["GET", "POST"])
+@bp.route("/end_call", methods=["GET", "POST"])
 @csrf.exempt
 def end_call_french():
-    resp = VoiceResponse()
-    language = session.get('language', 'english')
-    if language == 'english':
-        resp.play(VOICEMAIL_ENGLISH_URL)
-    elif language == 'french':
-        resp.play(VOICEMAIL_FRENCH_URL)
-    resp.record(max_length="60", transcribe=True, action="/postscript", transcribe_callback="/send_transcription")
-    resp.redirect("/postscript")
-    return str(resp)
+    state = call_state.get(request.values.get('CallSid'))
+    dial_status = request.values.get('DialCallStatus')
+    if dial_status and state.get('recipient'):
+        # we're the <Dial> action: report how the volunteer leg went
+        router.finish(state['recipient'], answered=dial_status == 'completed')
+    return prebuilt_twiml(build_voicemail, state.get('language', 'english'))
 
 
-@app.route('/postscript', methods=['GET', 'POST'])
+@bp.route('/postscript', methods=['GET', 'POST'])
 @csrf.exempt
 def end_call():
     print("END CALL")
     """Thanks a caller for their recording and hangs up"""
-    resp = VoiceResponse()
-    resp.say("Thanks for your message.")
-    resp.play(FDR_URL)
-    resp.hangup()
-    return str(resp)
+    call_state.update(request.values.get('CallSid'), recording_url=request.values.get('RecordingUrl'))
+    return prebuilt_twiml(build_postscript)
 
-@app.route("/send_transcription", methods=["POST"])
+@bp.route("/send_transcription", methods=["POST"])
 @csrf.exempt
+@idempotent('twilio-transcription', lambda r: r.form.get('TranscriptionSid'), lambda: ("OK", 200))
 def send_transcription():
     """ Creates a client object and returns the transcription text to an SMS message"""
     
     transcription_text = request.form.get('TranscriptionText')
     url_recording = request.form.get('RecordingUrl')
     from_number = request.form.get('From')
+    state = call_state.get(request.form.get('CallSid'))
 
     if not transcription_text:
         print("Transcription not ready or failed.")
         return "OK", 200
 
+    context = ""
+    if state:
+        context = (f"<p>Language: {state.get('language', '—')} | "
+                   f"Request: {state.get('help_type', 'none chosen')} | "
+                   f"Dialed: {state.get('recipient', 'nobody')}</p>")
+
     message_body = f'''<h1>NEW VOICEMAIL TO DA FRANCE</h1>
                        <br>
                        <p>MACHINE TRANSCRIPTION: {transcription_text}</p>
+                       {context}
                        <br>
                        <a href="{url_recording}">LISTEN TO RECORDING</a>'''
 
+    prefetch_recording(url_recording)
     try:
-        send_email(FROM_EMAIL, RECIPIENT_EMAILS, f'NEW DAF VOICEMAIL FROM {from_number}', message_body)
+        notify_staff('voicemail', from_number, f'NEW DAF VOICEMAIL FROM {from_number}', message_body)
     except Exception as e:
         print(e, type(e))
         print(e.args)
@@ -309,6 +2307,94 @@ def requires_auth(f):
     return wrapper
 
 
+METRICS_SLOW_MS = float(os.getenv("METRICS_SLOW_MS", "1000"))
+METRICS_TRACE_SAMPLE = float(os.getenv("METRICS_TRACE_SAMPLE", "0"))  # share of slow requests traced, 0 = off
+slow_traces = deque(maxlen=int(os.getenv("METRICS_TRACE_KEEP", "200")))
+
+@bp.before_app_request
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+    g.spans = []
+
+@bp.after_app_request
+def _record_request_latency(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    request_latency.observe(elapsed, route, request.method, str(response.status_code))
+    if elapsed * 1000 >= METRICS_SLOW_MS and METRICS_TRACE_SAMPLE and random.random() < METRICS_TRACE_SAMPLE:
+        slow_traces.append({
+            "at": france_now().isoformat(),
+            "route": route,
+            "method": request.method,
+            "status": response.status_code,
+            "ms": round(elapsed * 1000, 2),
+            "spans": g.spans,
+        })
+    return response
+
+def render_metrics():
+    lines = [request_latency.render(), outbound_latency.render(),
+             "# HELP frdem_log_buffer_rows_total CommunicationLog rows through the write-behind buffer.",
+             "# TYPE frdem_log_buffer_rows_total counter"]
+    for state, value in log_buffer.stats.items():
+        lines.append(f'frdem_log_buffer_rows_total{{state="{state}"}} {value}')
+    lines += ["# HELP frdem_http_pool_requests_total Outbound HTTP requests per provider connection pool.",
+              "# TYPE frdem_http_pool_requests_total counter"]
+    pool_stats = http_pool_stats()
+    for (provider, host), (reqs, _) in sorted(pool_stats.items()):
+        lines.append(f'frdem_http_pool_requests_total{{provider="{provider}",host="{host}"}} {reqs}')
+    lines += ["# HELP frdem_http_pool_connections_total Connections opened per provider pool (pool misses).",
+              "# TYPE frdem_http_pool_connections_total counter"]
+    for (provider, host), (_, conns) in sorted(pool_stats.items()):
+        lines.append(f'frdem_http_pool_connections_total{{provider="{provider}",host="{host}"}} {conns}')
+    lines += ["# HELP frdem_staff_alerts_total Staff alert emails sent right away, held for a digest, and digests sent.",
+              "# TYPE frdem_staff_alerts_total counter"]
+    for mode, value in digests.stats.items():
+        lines.append(f'frdem_staff_alerts_total{{mode="{mode}"}} {value}')
+    lines += ["# HELP frdem_shift_forwards_total SMS forwarded to the volunteer on shift right away, held, and digests sent.",
+              "# TYPE frdem_shift_forwards_total counter"]
+    for mode, value in shift_digests.stats.items():
+        lines.append(f'frdem_shift_forwards_total{{mode="{mode}"}} {value}')
+    lines += ["# HELP frdem_webhook_replays_total Provider webhook retries answered without reprocessing.",
+              "# TYPE frdem_webhook_replays_total counter"]
+    for kind, value in sorted(webhook_seen.duplicates.items()):
+        lines.append(f'frdem_webhook_replays_total{{kind="{kind}"}} {value}')
+    lines += ["# HELP frdem_recording_cache_total Recording cache lookups and evictions in this worker.",
+              "# TYPE frdem_recording_cache_total counter"]
+    for outcome, value in recordings.stats.items():
+        lines.append(f'frdem_recording_cache_total{{outcome="{outcome}"}} {value}')
+    lines += ["# HELP frdem_caller_throttled_total Webhooks answered with a canned response instead of being handled.",
+              "# TYPE frdem_caller_throttled_total counter"]
+    for (route, reason), value in sorted(throttle_stats.items()):
+        lines.append(f'frdem_caller_throttled_total{{route="{route}",reason="{reason}"}} {value}')
+    lines += ["# HELP frdem_sheets_mirror_total Sheets append calls, rows appended and quota (429) responses.",
+              "# TYPE frdem_sheets_mirror_total counter"]
+    for name, value in sheets_batcher.stats.items():
+        lines.append(f'frdem_sheets_mirror_total{{kind="{name}"}} {value}')
+    lines += ["# HELP frdem_broadcast_messages_total Broadcast SMS outcomes per provider in this worker.",
+              "# TYPE frdem_broadcast_messages_total counter"]
+    for (provider, status), value in sorted(broadcast_stats.items()):
+        lines.append(f'frdem_broadcast_messages_total{{provider="{provider}",status="{status}"}} {value}')
+    lines += ["# HELP frdem_boot_seconds Time this worker spent in each startup phase.",
+              "# TYPE frdem_boot_seconds gauge"]
+    for phase, seconds in boot_timings.items():
+        lines.append(f'frdem_boot_seconds{{phase="{phase}"}} {seconds}')
+    return "\n".join(lines) + "\n"
+
+@bp.route("/admin/metrics")
+@requires_auth
+def admin_metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@bp.route("/admin/metrics/traces")
+@requires_auth
+def admin_metrics_traces():
+    return jsonify(list(slow_traces))
+
+
 TEMPLATE = """
 <!doctype html>
 <html lang="en">
@@ -340,9 +2426,11 @@ audio { width: 100%; margin-top: 0.5rem; }
         </div>
         <div>
           <div><label>Voicemail / Recording:</label>
-            {% if row.recording_url %}
-              <div><audio controls src="{{ row.recording_url }}"></audio></div>
-              <div><a href="{{ row.recording_url }}" target="_blank" rel="noopener">Open recording</a></div>
+            {% if row.loading %}
+              <div>… Still loading</div>
+            {% elif row.recording_url %}
+              <div><audio controls preload="none" src="{{ recording_src(row.recording_url) }}"></audio></div>
+              <div><a href="{{ recording_src(row.recording_url) }}" target="_blank" rel="noopener">Open recording</a></div>
             {% else %}
               <div>— No recording found</div>
             {% endif %}
@@ -395,54 +2483,304 @@ def get_from_number(call) -> str:
             return props[k]
     return 'Unknown'
 
-@app.route("/admin/calls")
+## RECORDING CACHE ##
+# The admin pages play recordings through /admin/recording, which serves
+# them from a size-bounded on-disk LRU (least recently played evicted first)
+# with Range, ETag and Cache-Control support, so seeking and replays never
+# go back to the provider. Voicemail webhooks prefetch the file in the
+# background. Only Twilio and Nexmo/Vonage API hosts are ever fetched.
+
+RECORDING_CACHE_DIR = os.getenv("RECORDING_CACHE_DIR", os.path.join(tempfile.gettempdir(), "frdem-recordings"))
+RECORDING_CACHE_MB = int(os.getenv("RECORDING_CACHE_MB", "500"))
+RECORDING_MAX_AGE = int(os.getenv("RECORDING_MAX_AGE", "604800"))  # recordings never change
+
+def recording_source(url):
+    """'twilio' or 'nexmo' for a recording URL we may fetch, else None."""
+    host = urlsplit(url or '').hostname or ''
+    if host == 'api.twilio.com':
+        return 'twilio'
+    if host.endswith('.nexmo.com') or host.endswith('.vonage.com'):
+        return 'nexmo'
+    return None
+
+def normalize_recording_url(url):
+    # Twilio's RecordingUrl has no extension (WAV); the admin pages use .mp3
+    if recording_source(url) == 'twilio' and '/Recordings/' in url and not url.endswith(('.mp3', '.wav')):
+        return url + '.mp3'
+    return url
+
+class RecordingCache:
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+
+    def key(self, url):
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def path(self, url):
+        return os.path.join(self.directory, self.key(url) + '.mp3')
+
+    def get(self, url):
+        """Path of the cached file, or None. Marks it recently used."""
+        path = self.path(url)
+        try:
+            # atime is the LRU clock; mtime is left alone for Last-Modified
+            os.utime(path, (time.time(), os.stat(path).st_mtime))
+        except FileNotFoundError:
+            self.stats['misses'] += 1
+            return None
+        self.stats['hits'] += 1
+        return path
+
+    def fetch(self, url):
+        """Download `url` into the cache and return its path."""
+        source = recording_source(url)
+        if source is None:
+            raise ValueError(f"not a provider recording URL: {url}")
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as out, timed(source, 'recordings.get'):
+                if source == 'twilio':
+                    r = twilio_client.http_client.session.get(url, auth=(TWILIO_ACCT, TWILIO_SECRET), stream=True)
+                else:
+                    # nexmo's get_recording() builds b"Bearer " + token, which fails on PyJWT 2 (str tokens)
+                    token = client.generate_application_jwt()
+                    token = token.decode() if isinstance(token, bytes) else token
+                    r = client.session.get(url, headers={'Authorization': f'Bearer {token}'}, stream=True)
+                r.raise_for_status()
+                for chunk in r.iter_content(64 * 1024):
+                    out.write(chunk)
+            os.replace(tmp, self.path(url))  # atomic, so readers never see a partial file
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+        return self.path(url)
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.mp3'):
+                    st = entry.stat()
+                    entries.append((st.st_atime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    self.stats['evicted'] += 1
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+recordings = RecordingCache(RECORDING_CACHE_DIR, RECORDING_CACHE_MB * 1024 * 1024)
+recording_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="recording-prefetch")
+
+def _prefetch(url):
+    try:
+        if not recordings.get(url):
+            recordings.fetch(url)
+    except Exception as e:
+        print(f"Recording prefetch failed for {url}: {e}")
+
+def prefetch_recording(url):
+    """Warm the cache for a new voicemail without holding up the webhook."""
+    url = normalize_recording_url(url)
+    if recording_source(url):
+        recording_pool.submit(_prefetch, url)
+
+@bp.app_template_global()
+def recording_src(url):
+    """<audio> src for a provider recording: the caching proxy when we can fetch it."""
+    url = normalize_recording_url(url)
+    return url_for('frdem.admin_recording', url=url) if recording_source(url) else url
+
+@bp.route("/admin/recording")
+@requires_auth
+def admin_recording():
+    url = normalize_recording_url(request.args.get('url', ''))
+    if not recording_source(url):
+        return Response("Not a Twilio or Nexmo recording URL", 400)
+    try:
+        path = recordings.get(url) or recordings.fetch(url)
+    except Exception as e:
+        print(f"Recording fetch failed for {url}: {e}")
+        return Response("Recording unavailable", 502)
+    # conditional=True answers Range and If-None-Match; whole-file responses go
+    # through wsgi.file_wrapper, which gunicorn serves with sendfile()
+    response = send_file(path, mimetype='audio/mpeg', conditional=True,
+                         etag=recordings.key(url), max_age=RECORDING_MAX_AGE)
+    response.cache_control.public = False  # behind admin auth
+    response.cache_control.private = True
+    return response
+
+## CALL LOOKUP CACHE ##
+# recordings/transcriptions for finished calls never change, so they are cached
+# by call SID and recording SID and looked up in parallel on a bounded pool
+ADMIN_CALLS_WORKERS = int(os.getenv("ADMIN_CALLS_WORKERS", "8"))
+ADMIN_CALLS_BUDGET = float(os.getenv("ADMIN_CALLS_BUDGET", "8"))         # seconds per page view
+ADMIN_CALLS_CACHE_TTL = int(os.getenv("ADMIN_CALLS_CACHE_TTL", "86400"))  # finished calls
+ADMIN_CALLS_RETRY_TTL = int(os.getenv("ADMIN_CALLS_RETRY_TTL", "60"))     # calls that may still change
+FINISHED_CALL_STATUSES = {'completed', 'busy', 'failed', 'no-answer', 'canceled'}
+
+_MISSING = object()
+
+class TTLCache:
+    """Thread-safe dict whose entries expire after a per-entry TTL."""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, default=_MISSING):
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return default
+            expires, value = hit
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            if len(self._data) >= self.maxsize:
+                now = time.monotonic()
+                for k in [k for k, (exp, _) in self._data.items() if exp < now]:
+                    del self._data[k]
+                if len(self._data) >= self.maxsize:
+                    # still full: drop the entry closest to expiry
+                    del self._data[min(self._data, key=lambda k: self._data[k][0])]
+            self._data[key] = (time.monotonic() + ttl, value)
+
+lookup_pool = ThreadPoolExecutor(max_workers=ADMIN_CALLS_WORKERS, thread_name_prefix="twilio-lookup")
+media_cache = TTLCache()
+
+def _lookup_transcription(rec_sid):
+    """Return (text, url) for a recording's transcription, cached by recording SID."""
+    key = ('transcription', rec_sid)
+    cached = media_cache.get(key)
+    if cached is not _MISSING:
+        return cached
+
+    trans = twilio_client.transcriptions.list(recording_sid=rec_sid, limit=1)
+    if not trans:
+        # transcriptions land a minute or so after the recording
+        media_cache.set(key, (None, None), ADMIN_CALLS_RETRY_TTL)
+        return None, None
+    t = trans[0]
+    result = (t.transcription_text,
+              f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCT}/Transcriptions/{t.sid}.json")
+    ttl = ADMIN_CALLS_CACHE_TTL if t.status in ('completed', 'failed') else ADMIN_CALLS_RETRY_TTL
+    media_cache.set(key, result, ttl)
+    return result
+
+def _lookup_call_media(call_sid, status, end_time):
+    """Return the recording/transcription fields for one call, cached by call SID."""
+    key = ('call', call_sid)
+    cached = media_cache.get(key)
+    if cached is not _MISSING:
+        return cached
+
+    media = {"recording_url": None, "transcription_text": None, "transcription_url": None}
+    try:
+        recs = twilio_client.recordings.list(call_sid=call_sid, limit=1)
+        if recs:
+            rec = recs[0]
+            media["recording_url"] = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCT}/Recordings/{rec.sid}.mp3"
+            try:
+                media["transcription_text"], media["transcription_url"] = _lookup_transcription(rec.sid)
+            except Exception:
+                pass
+    except Exception:
+        return media  # don't cache failures
+
+    # a finished call can still get its recording a few minutes after hanging up
+    settled = status in FINISHED_CALL_STATUSES and (
+        media["recording_url"] or (end_time and
+            datetime.datetime.now(datetime.timezone.utc) - end_time > datetime.timedelta(minutes=10)))
+    if settled and (media["transcription_text"] or not media["recording_url"]):
+        media_cache.set(key, media, ADMIN_CALLS_CACHE_TTL)
+    else:
+        media_cache.set(key, media, ADMIN_CALLS_RETRY_TTL)
+    return media
+
+ADMIN_CALLS_SOURCE = os.getenv("ADMIN_CALLS_SOURCE", "live")  # 'db' once the Twilio sync is running
+
+def _synced_calls(limit=30):
+    """Rows for the admin calls page from the Twilio mirror in Postgres."""
+    logs = (CommunicationLog.query
+            .filter(CommunicationLog.provider == 'Twilio', CommunicationLog.comm_type == 'Call')
+            .order_by(CommunicationLog.timestamp.desc())
+            .limit(limit).all())
+    return [{
+        "sid": log.provider_sid,
+        "start_time": log.timestamp,
+        "from_": log.from_num,
+        "to": log.to_num,
+        "status": log.status,
+        "duration": log.duration,
+        "recording_url": log.recording_url,
+        "transcription_text": None if log.content == f"Call {log.status}" else log.content,
+        "transcription_url": None,
+        "loading": False,
+    } for log in logs]
+
+@bp.route("/admin/calls")
 @requires_auth
 def admin_calls():
     items = []
     error_msg = None
+    deadline = time.monotonic() + ADMIN_CALLS_BUDGET
+
+    if request.args.get('source', ADMIN_CALLS_SOURCE) == 'db':
+        html = TEMPLATE.replace("Data fetched live from Twilio REST API", "Data mirrored from Twilio into Postgres", 1)
+        return render_template_string(html, items=_synced_calls())
 
     try:
         calls = twilio_client.calls.list(limit=30)
 
+        pending = {}
         for c in calls:
             #if c.direction != 'inbound':
             #    continue
 
             from_number = c.from_formatted if hasattr(c, 'from_formatted') and c.from_formatted else c.from_
-            
-            recording_url = None
-            transcription_text = None
-            transcription_url = None
-
-            try:
-                recs = twilio_client.recordings.list(call_sid=c.sid, limit=1)
-                if recs:
-                    rec = recs[0]
-                    recording_url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCT}/Recordings/{rec.sid}.mp3"
-
-                    # 2. Look for Transcriptions
-                    try:
-                        trans = twilio_client.transcriptions.list(recording_sid=rec.sid, limit=1)
-                        if trans:
-                            t = trans[0]
-                            transcription_text = t.transcription_text
-                            transcription_url = f"https://api.twilio.com/2010-04-01/Accounts/{TWILIO_ACCT}/Transcriptions/{t.sid}.json"
-                    except Exception:
-                        pass
-            except Exception:
-                pass
 
-            items.append({
+            row = {
                 "sid": c.sid,
                 "start_time": c.start_time,
                 "from_": from_number,
                 "to": c.to,
                 "status": c.status,
                 "duration": c.duration,
-                "recording_url": recording_url,
-                "transcription_text": transcription_text,
-                "transcription_url": transcription_url,
-            })
+                "recording_url": None,
+                "transcription_text": None,
+                "transcription_url": None,
+                "loading": False,
+            }
+            cached = media_cache.get(('call', c.sid))
+            if cached is not _MISSING:
+                row.update(cached)
+            else:
+                pending[lookup_pool.submit(_lookup_call_media, c.sid, c.status, c.end_time)] = row
+            items.append(row)
+
+        done, not_done = wait(pending, timeout=max(0, deadline - time.monotonic()))
+        for fut in done:
+            pending[fut].update(fut.result())
+        for fut in not_done:
+            # keeps running in the pool and lands in the cache for the next view
+            pending[fut]["loading"] = True
+        if not_done:
+            error_msg = f"{len(not_done)} call(s) still loading from Twilio; refresh to see them."
 
     except TwilioRestException as e:
         error_msg = f"Twilio error: {e.msg}"
@@ -470,94 +2808,596 @@ NEXMO_API_SECRET = os.getenv("NEXMO_API_SECRET")
 
 # Initialize the Nexmo client using the string directly
 # Note: The library is smart enough to handle the string if it looks like a key
-client = nexmo.Client(
-    application_id=NEXMO_APPLICATION_ID,
-    private_key=NEXMO_PRIVATE_KEY,
-)
-
-@app.route("/new-recording", methods=["POST"])
-def new_recording():
-    data = request.json
-    recording_url = data.get('recording_url')
-    
-    # Map the Nexmo data to our unified Postgres table
-    new_log = CommunicationLog(
-        provider='Nexmo',
-        comm_type='Call',
-        direction='Inbound',
-        from_num='Inbound Nexmo Call', 
-        content='Voicemail Recording Available',
-        recording_url=recording_url
+def build_nexmo_client():
+    import nexmo
+    nexmo_client = nexmo.Client(
+        application_id=NEXMO_APPLICATION_ID,
+        private_key=NEXMO_PRIVATE_KEY,
     )
-    
-    try:
-        db_pg.session.add(new_log)
-        db_pg.session.commit()
-    except Exception as e:
-        print(f"Postgres save failed: {e}")
-        db_pg.session.rollback()
+    nexmo_client.session = provider_session('nexmo', ('rest.nexmo.com', 'api.nexmo.com'), NEXMO_API_BASE)
+    return nexmo_client
 
-    # Note: Ensure you've defined your email sending logic here
-    # and replaced those old 'malicious.technology' URLs!
-    
-    return "", 204
+client = LazyClient('nexmo', build_nexmo_client)
+
+# the SMS API authenticates with key/secret rather than the voice application
+def build_nexmo_sms_client():
+    import nexmo
+    sms_client = nexmo.Client(key=NEXMO_API_KEY, secret=NEXMO_API_SECRET)
+    sms_client.session = provider_session('nexmo', ('rest.nexmo.com', 'api.nexmo.com'), NEXMO_API_BASE)
+    return sms_client
+
+smsclient = LazyClient('nexmo-sms', build_nexmo_sms_client)
 
 # 3. FAST ADMIN ROUTE (Querying Postgres instead of Twilio API)
-@app.route("/admin/history")
+HISTORY_PAGE_SIZE = 50
+HISTORY_FILTERS = {
+    'provider': CommunicationLog.provider,
+    'comm_type': CommunicationLog.comm_type,
+    'direction': CommunicationLog.direction,
+    'number': CommunicationLog.from_num,
+}
+
+def encode_cursor(log):
+    raw = f"{log.timestamp.isoformat()}|{log.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    """Return (timestamp, id) from a history cursor, or None if it is malformed."""
+    try:
+        ts, log_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        return datetime.datetime.fromisoformat(ts), int(log_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def history_query(args):
+    """CommunicationLog query for the history filters in `args`, newest first."""
+    query = CommunicationLog.query
+    for name, column in HISTORY_FILTERS.items():
+        if args.get(name):
+            query = query.filter(column == args[name])
+    return query.order_by(CommunicationLog.timestamp.desc(), CommunicationLog.id.desc())
+
+@bp.route("/admin/history")
 @requires_auth
 def admin_history():
-    # Fetch latest 50 events from BOTH providers at once
-    logs = CommunicationLog.query.order_by(CommunicationLog.timestamp.desc()).limit(50).all()
-    
+    # Keyset pagination: each page continues strictly after the last
+    # (timestamp, id) of the previous one, so deep pages cost the same as the first
+    query = history_query(request.args)
+    position = decode_cursor(request.args.get('cursor', ''))
+    if position:
+        query = query.filter(tuple_(CommunicationLog.timestamp, CommunicationLog.id) < position)
+    logs = query.limit(HISTORY_PAGE_SIZE + 1).all()
+
+    next_url = None
+    if len(logs) > HISTORY_PAGE_SIZE:
+        logs = logs[:HISTORY_PAGE_SIZE]
+        params = {k: request.args[k] for k in HISTORY_FILTERS if request.args.get(k)}
+        next_url = url_for('.admin_history', cursor=encode_cursor(logs[-1]), **params)
+
     # Using a simple template to show both
     return render_template_string("""
         <h1>Unified History (Postgres)</h1>
+        <form method="get">
+            <select name="provider">
+                <option value="">Any provider</option>
+                {% for p in ['Twilio', 'Nexmo'] %}<option {{ 'selected' if args.provider == p }}>{{ p }}</option>{% endfor %}
+            </select>
+            <select name="comm_type">
+                <option value="">Any type</option>
+                {% for t in ['SMS', 'Call'] %}<option {{ 'selected' if args.comm_type == t }}>{{ t }}</option>{% endfor %}
+            </select>
+            <select name="direction">
+                <option value="">Any direction</option>
+                {% for d in ['Inbound', 'Outbound'] %}<option {{ 'selected' if args.direction == d }}>{{ d }}</option>{% endfor %}
+            </select>
+            <input name="number" placeholder="From number" value="{{ args.number or '' }}">
+            <button type="submit">Filter</button>
+        </form>
         {% for log in logs %}
             <div style="border:1px solid #ccc; margin:10px; padding:10px; border-left: 5px solid {{ 'blue' if log.provider == 'Twilio' else 'green' }};">
                 <strong>{{ log.provider }} {{ log.comm_type }}</strong> - {{ log.timestamp }}<br>
                 From: {{ log.from_num }} | Content: {{ log.content }}<br>
                 {% if log.recording_url %}
-                    <audio controls src="{{ log.recording_url }}"></audio>
+                    <audio controls preload="none" src="{{ recording_src(log.recording_url) }}"></audio>
                 {% endif %}
             </div>
         {% endfor %}
-    """, logs=logs)
-# Create the tables (Run this once)
-with app.app_context():
-    db_pg.create_all()
-
-@app.route("/new-recording", methods=["POST"])
-def new_recording():
-    data = request.json
-    recording_id = data.get('recording_uuid')
-    recording_url = data.get('recording_url')
-    
-    # In Postgres, we don't need a separate "Recordings" table if we 
-    # just want to log the event.
-    new_log = CommunicationLog(
-        provider='Nexmo',
-        comm_type='Call',
-        direction='Inbound',
-        from_num='Check Logs', # You can look this up via conversation_uuid if needed
-        content='New Voicemail Recorded',
-        recording_url=recording_url
-    )
-    
+        {% if next_url %}<a href="{{ next_url }}">Older &rarr;</a>{% endif %}
+    """, logs=logs, args=request.args, next_url=next_url)
+
+## EXPORT ##
+# Streams CommunicationLog as CSV or NDJSON (optionally gzipped) straight from
+# a server-side cursor, so memory stays flat however many rows match.
+EXPORT_COLUMNS = ('id', 'timestamp', 'provider', 'comm_type', 'direction', 'from_num', 'to_num',
+                  'status', 'duration', 'provider_sid', 'content', 'recording_url')
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "1000"))
+
+def export_query(since=None, until=None, provider=None, direction=None, columns=EXPORT_COLUMNS):
+    """Rows in [since, until) as plain tuples of `columns`, oldest first."""
+    query = db_pg.session.query(*[getattr(CommunicationLog, c) for c in columns])
+    if since:
+        query = query.filter(CommunicationLog.timestamp >= since)
+    if until:
+        query = query.filter(CommunicationLog.timestamp < until)
+    if provider:
+        query = query.filter(CommunicationLog.provider == provider)
+    if direction:
+        query = query.filter(CommunicationLog.direction == direction)
+    return query.order_by(CommunicationLog.timestamp, CommunicationLog.id)
+
+def export_row(row, columns=EXPORT_COLUMNS):
+    record = dict(zip(columns, row))
+    if record['timestamp']:
+        record['timestamp'] = record['timestamp'].isoformat()
+    return record
+
+def iter_export(rows, fmt='csv', compress=False, columns=EXPORT_COLUMNS):
+    """Yield `rows` (tuples of `columns`) serialized in EXPORT_BATCH-sized chunks."""
+    compressor = zlib.compressobj(wbits=31) if compress else None  # 31 = gzip container
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, columns) if fmt == 'csv' else None
+    if writer:
+        writer.writeheader()
+
+    def drain():
+        data = buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+        return compressor.compress(data) if compressor else data
+
+    for n, row in enumerate(rows, 1):
+        record = export_row(row, columns)
+        if writer:
+            writer.writerow(record)
+        else:
+            buf.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if n % EXPORT_BATCH == 0:
+            chunk = drain()
+            if chunk:
+                yield chunk
+    chunk = drain()
+    if compressor:
+        chunk += compressor.flush()
+    if chunk:
+        yield chunk
+
+def parse_export_args(args):
+    """(since, until) from ISO date/datetime query args; raises ValueError."""
+    since = datetime.datetime.fromisoformat(args['since']) if args.get('since') else None
+    until = datetime.datetime.fromisoformat(args['until']) if args.get('until') else None
+    return since, until
+
+@bp.route("/admin/export")
+@requires_auth
+def admin_export():
+    """/admin/export?since=2024-09-01&until=2024-11-06&provider=Twilio&direction=Inbound&format=ndjson&gzip=1"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return Response("format must be csv or ndjson", 400)
+    try:
+        since, until = parse_export_args(request.args)
+    except ValueError:
+        return Response("since/until must be ISO dates, e.g. 2024-11-05 or 2024-11-05T18:00", 400)
+    compress = request.args.get('gzip') == '1'
+
+    rows = export_query(since, until, request.args.get('provider'), request.args.get('direction')).yield_per(EXPORT_BATCH)
+    filename = f"communication_log.{fmt}" + (".gz" if compress else "")
+    mimetype = 'application/gzip' if compress else 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(iter_export(rows, fmt, compress)), mimetype=mimetype,
+                    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@bp.cli.command("export-log")
+@click.option("--since", help="ISO date/datetime, inclusive.")
+@click.option("--until", help="ISO date/datetime, exclusive.")
+@click.option("--provider")
+@click.option("--direction")
+@click.option("--format", "fmt", type=click.Choice(['csv', 'ndjson']), default='csv')
+@click.option("--gzip", "compress", is_flag=True)
+@click.option("--output", type=click.Path(dir_okay=False), help="Defaults to stdout.")
+def export_log_command(since, until, provider, direction, fmt, compress, output):
+    """Stream CommunicationLog rows to a file or stdout."""
+    since, until = parse_export_args({'since': since, 'until': until})
+    rows = export_query(since, until, provider, direction).yield_per(EXPORT_BATCH)
+    out = open(output, 'wb') if output else click.get_binary_stream('stdout')
     try:
-        db_pg.session.add(new_log)
+        for chunk in iter_export(rows, fmt, compress):
+            out.write(chunk)
+    finally:
+        if output:
+            out.close()
+
+## LOG ARCHIVE ##
+# Months older than LOG_RETENTION_MONTHS leave the hot table. Each month is
+# written to LOG_ARCHIVE_DIR as gzipped NDJSON, in the /admin/export format
+# plus help_type. The rows are then dropped: on Postgres the month's partition
+# is detached and dropped, elsewhere the rows are deleted. If the row count
+# changed while the file was written, the month is left for the next run.
+# TrafficRollup keeps the hourly stats for archived months. /admin/archive
+# and `flask log-archive` read the files back; nothing writes to them again.
+LOG_RETENTION_MONTHS = int(os.getenv("LOG_RETENTION_MONTHS", "12"))
+LOG_ARCHIVE_DIR = os.getenv("LOG_ARCHIVE_DIR", "archive")
+LOG_MAINTENANCE_INTERVAL = 24 * 3600
+ARCHIVE_COLUMNS = EXPORT_COLUMNS + ('help_type',)
+ARCHIVE_PAGE = 200
+
+def archive_path(month):
+    return os.path.join(LOG_ARCHIVE_DIR, f"communication_log-{month:%Y-%m}.ndjson.gz")
+
+def archive_months():
+    """Archived months, oldest first."""
+    if not os.path.isdir(LOG_ARCHIVE_DIR):
+        return []
+    return sorted(datetime.datetime.strptime(m.group(1), '%Y-%m') for name in os.listdir(LOG_ARCHIVE_DIR)
+                  if (m := re.fullmatch(r'communication_log-(\d{4}-\d{2})\.ndjson\.gz', name)))
+
+def archive_cutoff():
+    cutoff = month_start(france_now())
+    for _ in range(LOG_RETENTION_MONTHS):
+        cutoff = month_start(cutoff - datetime.timedelta(days=1))
+    return cutoff
+
+def archive_log_month(month):
+    """Write `month` to its archive file, then drop it from communication_log; returns the row count."""
+    until = next_month(month)
+    os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+    written = 0
+
+    def counted(rows):
+        nonlocal written
+        for row in rows:
+            written += 1
+            yield row
+
+    partitioned = db_pg.engine.dialect.name == 'postgresql' and log_is_partitioned(db_pg.session.connection())
+    fd, tmp = tempfile.mkstemp(dir=LOG_ARCHIVE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            rows = export_query(month, until, columns=ARCHIVE_COLUMNS).yield_per(EXPORT_BATCH)
+            for chunk in iter_export(counted(rows), 'ndjson', compress=True, columns=ARCHIVE_COLUMNS):
+                out.write(chunk)
+            out.flush()
+            os.fsync(out.fileno())
+        # a row written to this month since the read fails the count check and rolls back
+        if partitioned:
+            name = log_partition_name(month)
+            db_pg.session.execute(db_pg.text(f"ALTER TABLE communication_log DETACH PARTITION {name}"))
+            removed = db_pg.session.execute(db_pg.text(f"SELECT count(*) FROM {name}")).scalar()
+            db_pg.session.execute(db_pg.text(f"DROP TABLE {name}"))
+        else:
+            removed = CommunicationLog.query.filter(CommunicationLog.timestamp >= month,
+                                                    CommunicationLog.timestamp < until).delete()
+        if removed != written:
+            raise RuntimeError(f"{month:%Y-%m}: archived {written} row(s) but {removed} were in the table")
+        if written:
+            os.replace(tmp, archive_path(month))
+        else:
+            os.remove(tmp)  # an empty partition is just dropped
         db_pg.session.commit()
-    except Exception as e:
-        print(f"Postgres save failed: {e}")
+    except Exception:
         db_pg.session.rollback()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return written
+
+def archive_old_log():
+    """Archive every month before archive_cutoff(); returns {month: rows} for the months with rows."""
+    cutoff = archive_cutoff()
+    if db_pg.engine.dialect.name == 'postgresql' and log_is_partitioned(db_pg.session.connection()):
+        conn = db_pg.session.connection()
+        # expired rows that landed in the default partition get a monthly one, so they archive too
+        for month in default_partition_months(conn, before=cutoff):
+            create_log_partition(conn, month)
+        months = sorted(m for m in log_partitions(conn) if m < cutoff)
+    else:
+        # only months that have rows, jumping from each to the next oldest row
+        months = []
+        oldest = db_pg.func.min(CommunicationLog.timestamp)
+        first = db_pg.session.query(oldest).filter(CommunicationLog.timestamp < cutoff).scalar()
+        while first is not None:
+            months.append(month_start(first))
+            first = (db_pg.session.query(oldest)
+                     .filter(CommunicationLog.timestamp >= next_month(months[-1]), CommunicationLog.timestamp < cutoff)
+                     .scalar())
+    db_pg.session.commit()
+    archived = {}
+    for month in months:
+        try:
+            rows = archive_log_month(month)
+        except Exception as e:
+            print(f"Log archive of {month:%Y-%m} failed: {e}")
+            continue
+        if rows:
+            archived[month] = rows
+    return archived
+
+def maintain_log():
+    """Create upcoming partitions and archive expired months, then reschedule."""
+    lock = redis_conn.lock('lock:log-maintenance', timeout=600, blocking=False) if redis_conn else None
+    if lock and not lock.acquire():
+        return
+    try:
+        with app.app_context():
+            if db_pg.engine.dialect.name == 'postgresql':
+                with db_pg.engine.begin() as conn:
+                    if log_is_partitioned(conn):
+                        create_log_partitions(conn)
+            for month, rows in archive_old_log().items():
+                print(f"Archived {rows} row(s) from {month:%Y-%m} to {archive_path(month)}")
+    finally:
+        if lock:
+            lock.release()
+        if sync_queue is not None:
+            sync_queue.enqueue_in(datetime.timedelta(seconds=LOG_MAINTENANCE_INTERVAL), maintain_log,
+                                  job_id='log-maintenance-next')
+
+@bp.cli.command("maintain-log")
+def maintain_log_command():
+    """Create upcoming log partitions and archive months past LOG_RETENTION_MONTHS."""
+    maintain_log()
+
+def search_archive(month, number=None, text=None, offset=0, limit=ARCHIVE_PAGE):
+    """Archived rows of `month` from or to `number` and/or containing `text`, oldest first."""
+    key = caller_key(number) if number else None
+    text = (text or '').casefold()
+    matched = []
+    with gzip.open(archive_path(month), 'rt', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if key and key not in (caller_key(record['from_num']), caller_key(record['to_num'])):
+                continue
+            if text and text not in (record['content'] or '').casefold():
+                continue
+            if offset:
+                offset -= 1
+                continue
+            matched.append(record)
+            if len(matched) >= limit:
+                break
+    return matched
+
+@bp.route("/admin/archive")
+@requires_auth
+def admin_archive():
+    """/admin/archive?month=2024-11&number=0612345678&q=procuration&offset=0; format=ndjson downloads the month."""
+    months = archive_months()
+    try:
+        month = datetime.datetime.strptime(request.args['month'], '%Y-%m') if request.args.get('month') else None
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return Response("month must look like 2024-11", 400)
+    if month is not None and month not in months:
+        return Response("That month isn't archived", 404)
+    if month is not None and request.args.get('format') == 'ndjson':
+        return send_file(os.path.abspath(archive_path(month)), mimetype='application/gzip', as_attachment=True,
+                         download_name=os.path.basename(archive_path(month)))
+    records = search_archive(month, request.args.get('number'), request.args.get('q'), offset) if month else []
+    next_url = (url_for('.admin_archive', **dict(request.args.to_dict(), offset=offset + ARCHIVE_PAGE))
+                if len(records) == ARCHIVE_PAGE else None)
+    return render_template_string("""
+        <h1>Archived log</h1>
+        <form method="get">
+            <select name="month">
+                {% for m in months|reverse %}<option {{ 'selected' if m == month }}>{{ m.strftime('%Y-%m') }}</option>{% endfor %}
+            </select>
+            <input name="number" value="{{ args.number or '' }}" placeholder="number">
+            <input name="q" value="{{ args.q or '' }}" placeholder="text">
+            <button type="submit">Look up</button>
+            {% if month %}<a href="{{ url_for('.admin_archive', month=month.strftime('%Y-%m'), format='ndjson') }}">download month</a>{% endif %}
+        </form>
+        {% if not months %}<p>Nothing archived yet.</p>{% endif %}
+        {% if month and not records %}<p>No matches.</p>{% endif %}
+        {% for r in records %}
+            <div style="border:1px solid #ccc; margin:10px; padding:10px;">
+                <strong>{{ r.provider }} {{ r.comm_type }} {{ r.direction }}</strong> - {{ r.timestamp }} - From: {{ r.from_num }} To: {{ r.to_num }}<br>
+                {{ r.content or '' }}
+                {% if r.recording_url %}<br><a href="{{ r.recording_url }}">recording</a>{% endif %}
+            </div>
+        {% endfor %}
+        {% if next_url %}<a href="{{ next_url }}">More &rarr;</a>{% endif %}
+    """, months=months, month=month, records=records, args=request.args, next_url=next_url)
+
+archive_cli = AppGroup('log-archive', help="Read archived CommunicationLog months.")
+
+@archive_cli.command("list")
+def archive_list():
+    for month in archive_months():
+        print(f"{month:%Y-%m}\t{os.path.getsize(archive_path(month))} bytes\t{archive_path(month)}")
+
+@archive_cli.command("search")
+@click.argument("month")
+@click.option("--number")
+@click.option("--text")
+@click.option("--limit", default=ARCHIVE_PAGE)
+def archive_search(month, number, text, limit):
+    """Print matching rows of MONTH (YYYY-MM) as NDJSON."""
+    for record in search_archive(datetime.datetime.strptime(month, '%Y-%m'), number, text, limit=limit):
+        print(json.dumps(record, ensure_ascii=False))
+
+bp.cli.add_command(archive_cli)
+
+## TRAFFIC STATS ##
+STATS_DEFAULT_DAYS = 7
+
+def stats_summary(since, until):
+    """Totals and hourly series from TrafficRollup for [since, until)."""
+    window = (TrafficRollup.hour >= since, TrafficRollup.hour < until)
+    count, voicemails = db_pg.func.sum(TrafficRollup.count), db_pg.func.sum(TrafficRollup.voicemails)
+    dims = (TrafficRollup.provider, TrafficRollup.comm_type, TrafficRollup.direction, TrafficRollup.help_type)
+    totals = [{'provider': p, 'comm_type': t, 'direction': d, 'help_type': h or None,
+               'count': int(n), 'voicemails': int(vm)}
+              for p, t, d, h, n, vm in db_pg.session.query(*dims, count, voicemails)
+              .filter(*window).group_by(*dims).order_by(*dims)]
+
+    series, by_hour_of_day = {}, [{'hour': h, 'calls': 0, 'sms': 0, 'voicemails': 0} for h in range(24)]
+    for hour, comm_type, n, vm in (db_pg.session.query(TrafficRollup.hour, TrafficRollup.comm_type, count, voicemails)
+                                   .filter(*window).group_by(TrafficRollup.hour, TrafficRollup.comm_type)
+                                   .order_by(TrafficRollup.hour)):
+        field = 'calls' if comm_type == 'Call' else 'sms' if comm_type == 'SMS' else None
+        for bucket in (series.setdefault(hour, {'hour': hour.isoformat(), 'calls': 0, 'sms': 0, 'voicemails': 0}),
+                       by_hour_of_day[hour.hour]):
+            if field:
+                bucket[field] += int(n)
+            bucket['voicemails'] += int(vm)
+    return {'since': since.isoformat(), 'until': until.isoformat(), 'totals': totals,
+            'hourly': list(series.values()), 'by_hour_of_day': by_hour_of_day}
+
+def stats_window(args):
+    """(since, until) for the stats views, defaulting to the last STATS_DEFAULT_DAYS days."""
+    since, until = parse_export_args(args)
+    until = until or _rollup_hour(france_now()) + datetime.timedelta(hours=1)
+    since = since or until - datetime.timedelta(days=STATS_DEFAULT_DAYS)
+    return since, until
+
+@bp.route("/admin/stats.json")
+@requires_auth
+def admin_stats_json():
+    """/admin/stats.json?since=2024-11-01&until=2024-11-06 (Paris local time)"""
+    try:
+        since, until = stats_window(request.args)
+    except ValueError:
+        return Response("since/until must be ISO dates, e.g. 2024-11-05 or 2024-11-05T18:00", 400)
+    return jsonify(stats_summary(since, until))
 
-    # Continue with your existing Email/SendGrid logic...
-    # (Just make sure to update those malicious.technology URLs!)
-    
-    return "", 204
+@bp.route("/admin/stats")
+@requires_auth
+def admin_stats():
+    try:
+        since, until = stats_window(request.args)
+    except ValueError:
+        return Response("since/until must be ISO dates, e.g. 2024-11-05 or 2024-11-05T18:00", 400)
+    summary = stats_summary(since, until)
+    return render_template_string("""
+        <h1>Traffic</h1>
+        <form method="get">
+            <input name="since" value="{{ s.since[:16] }}"> to <input name="until" value="{{ s.until[:16] }}">
+            <button type="submit">Show</button>
+            <a href="{{ url_for('.admin_stats_json', **args) }}">JSON</a>
+        </form>
+        <h2>Totals</h2>
+        <table border="1" cellpadding="4">
+            <tr><th>Provider</th><th>Type</th><th>Direction</th><th>Help type</th><th>Count</th><th>Voicemails</th></tr>
+            {% for t in s.totals %}
+            <tr><td>{{ t.provider }}</td><td>{{ t.comm_type }}</td><td>{{ t.direction }}</td>
+                <td>{{ t.help_type or '-' }}</td><td>{{ t.count }}</td><td>{{ t.voicemails }}</td></tr>
+            {% endfor %}
+        </table>
+        <h2>By hour of day</h2>
+        <table border="1" cellpadding="4">
+            <tr><th>Hour</th><th>Calls</th><th>SMS</th><th>Voicemails</th></tr>
+            {% for h in s.by_hour_of_day %}
+            <tr><td>{{ '%02d:00' % h.hour }}</td><td>{{ h.calls }}</td><td>{{ h.sms }}</td><td>{{ h.voicemails }}</td></tr>
+            {% endfor %}
+        </table>
+    """, s=summary, args=request.args)
+
+## SEARCH ##
+# On Postgres, content is indexed by the generated search_vector column
+# (French and English stemming, GIN index; see SCHEMA_UPGRADES), so a query
+# only touches matching rows. Other databases fall back to a substring scan.
+SEARCH_PAGE_SIZE = 25
+SEARCH_MAX_PAGE = 40
+_MARK_START, _MARK_STOP = '\x02', '\x03'  # ts_headline markers, swapped for <mark> after escaping
+
+def search_vector():
+    return db_pg.literal_column('communication_log.search_vector')
+
+def search_tsquery(q):
+    return db_pg.func.websearch_to_tsquery('french', q).op('||')(db_pg.func.websearch_to_tsquery('english', q))
+
+def search_query(q, args):
+    """(query for (CommunicationLog, rank) matching `q`, best first; postgres?)"""
+    postgres = db_pg.engine.dialect.name == 'postgresql'
+    if postgres:
+        tsquery = search_tsquery(q)
+        rank = db_pg.func.ts_rank_cd(search_vector(), tsquery)
+        query = db_pg.session.query(CommunicationLog, rank).filter(search_vector().op('@@')(tsquery))
+    else:
+        rank = db_pg.literal(0.0)
+        query = db_pg.session.query(CommunicationLog, rank)
+        for word in q.split():
+            query = query.filter(CommunicationLog.content.ilike(f"%{word}%"))
+    for name, column in HISTORY_FILTERS.items():
+        if args.get(name):
+            query = query.filter(column == args[name])
+    since, until = parse_export_args(args)
+    if since:
+        query = query.filter(CommunicationLog.timestamp >= since)
+    if until:
+        query = query.filter(CommunicationLog.timestamp < until)
+    if args.get('order') == 'recent' or not postgres:
+        return query.order_by(CommunicationLog.timestamp.desc(), CommunicationLog.id.desc()), postgres
+    return query.order_by(rank.desc(), CommunicationLog.timestamp.desc(), CommunicationLog.id.desc()), postgres
+
+def search_snippets(q, ids, postgres):
+    """{id: Markup snippet} with the matched words wrapped in <mark>."""
+    if not ids:
+        return {}
+    if postgres:
+        options = f"StartSel={_MARK_START}, StopSel={_MARK_STOP}, MaxFragments=2, MaxWords=25, MinWords=8"
+        headline = db_pg.func.ts_headline('french', CommunicationLog.content, search_tsquery(q), options)
+        raw = dict(db_pg.session.query(CommunicationLog.id, headline).filter(CommunicationLog.id.in_(ids)))
+    else:
+        words = [w for w in q.split() if w]
+        pattern = re.compile("|".join(re.escape(w) for w in words), re.I) if words else None
+        raw = {}
+        for log_id, content in db_pg.session.query(CommunicationLog.id, CommunicationLog.content).filter(CommunicationLog.id.in_(ids)):
+            content = content or ''
+            raw[log_id] = pattern.sub(lambda m: _MARK_START + m.group(0) + _MARK_STOP, content) if pattern else content
+    return {log_id: Markup(str(escape(text or '')).replace(_MARK_START, '<mark>').replace(_MARK_STOP, '</mark>'))
+            for log_id, text in raw.items()}
+
+@bp.route("/admin/search")
+@requires_auth
+def admin_search():
+    """/admin/search?q=bulletin+Lyon&since=2024-11-01&provider=Twilio&order=recent&page=2"""
+    q = request.args.get('q', '').strip()
+    page = min(max(request.args.get('page', 1, type=int), 1), SEARCH_MAX_PAGE)
+    results, snippets, next_url = [], {}, None
+    if q:
+        try:
+            query, postgres = search_query(q, request.args)
+        except ValueError:
+            return Response("since/until must be ISO dates, e.g. 2024-11-05 or 2024-11-05T18:00", 400)
+        results = query.offset((page - 1) * SEARCH_PAGE_SIZE).limit(SEARCH_PAGE_SIZE + 1).all()
+        if len(results) > SEARCH_PAGE_SIZE and page < SEARCH_MAX_PAGE:
+            params = {k: v for k, v in request.args.items() if k != 'page'}
+            next_url = url_for('.admin_search', page=page + 1, **params)
+        results = results[:SEARCH_PAGE_SIZE]
+        # snippets only for the page being shown; ts_headline re-parses each document
+        snippets = search_snippets(q, [log.id for log, _ in results], postgres)
 
+    return render_template_string("""
+        <h1>Search</h1>
+        <form method="get">
+            <input name="q" value="{{ args.q or '' }}" placeholder="bulletin Lyon, &quot;procuration&quot;, -test" size="40">
+            <select name="provider">
+                <option value="">Any provider</option>
+                {% for p in ['Twilio', 'Nexmo'] %}<option {{ 'selected' if args.provider == p }}>{{ p }}</option>{% endfor %}
+            </select>
+            <select name="comm_type">
+                <option value="">Any type</option>
+                {% for t in ['SMS', 'Call'] %}<option {{ 'selected' if args.comm_type == t }}>{{ t }}</option>{% endfor %}
+            </select>
+            <input name="since" value="{{ args.since or '' }}" placeholder="since 2024-11-01" size="12">
+            <input name="until" value="{{ args.until or '' }}" placeholder="until" size="12">
+            <label><input type="checkbox" name="order" value="recent" {{ 'checked' if args.order == 'recent' }}> newest first</label>
+            <button type="submit">Search</button>
+        </form>
+        {% if args.q and not results %}<p>No matches.</p>{% endif %}
+        {% for log, rank in results %}
+            <div style="border:1px solid #ccc; margin:10px; padding:10px; border-left: 5px solid {{ 'blue' if log.provider == 'Twilio' else 'green' }};">
+                <strong>{{ log.provider }} {{ log.comm_type }}</strong> - {{ log.timestamp }} - From: {{ log.from_num }}<br>
+                {{ snippets.get(log.id, '') }}
+                {% if log.recording_url %}<br><audio controls preload="none" src="{{ recording_src(log.recording_url) }}"></audio>{% endif %}
+            </div>
+        {% endfor %}
+        {% if next_url %}<a href="{{ next_url }}">More results &rarr;</a>{% endif %}
+    """, results=results, snippets=snippets, args=request.args, next_url=next_url)
 
-@app.route("/answer", methods=["GET", "POST"])
+@bp.route("/answer", methods=["GET", "POST"])
 @csrf.exempt # Nexmo webhooks need CSRF exempt
+@rate_limited('call', _nexmo_caller, lambda: jsonify([]))  # an empty NCCO ends the call
 def nexmo_answer():
     """Initial IVR Greeting"""
     receive_numbers = request.url_root + "language"
@@ -566,8 +3406,9 @@ def nexmo_answer():
         {"action": "input", "maxDigits": 1, "eventUrl": [receive_numbers]}
     ])
 
-@app.route("/language", methods=["POST"])
+@bp.route("/language", methods=["POST"])
 @csrf.exempt
+@rate_limited('call', _nexmo_caller, lambda: jsonify([]))
 def nexmo_pick_language():
     data = request.get_json()
     digits = data.get('dtmf', '1')
@@ -580,12 +3421,21 @@ def nexmo_pick_language():
     else:
         route_url = request.url_root + "voicemail_english"
         language = 'english'
+    to_call = choose_recipient() if schedule.now().open else None
+    if to_call is None:
+        # closed or nobody on shift: record a voicemail rather than ring no one
+        call_state.update(data.get('conversation_uuid'), language=language, caller=them)
+        return jsonify([
+            {"action": "record", "endOnSilence": 3, "beepStart": True,
+             "eventUrl": [request.url_root + "new-recording"]}
+        ])
+    call_state.update(data.get('conversation_uuid'), language=language, caller=them, recipient=to_call)
 
     # Notify staff via SMS (using Nexmo)
     try:
         smsclient.send_message({
             "from": NEXMO_NUMBER,
-            "to": choose_recipient(),
+            "to": to_call,
             "text": f"VFA voter-help call from {them}. Language: {language}"
         })
     except: pass
@@ -596,52 +3446,449 @@ def nexmo_pick_language():
             "eventType": "synchronous",
             "eventUrl": [route_url],
             "from": NEXMO_NUMBER,
-            "endpoint": [{"type":"phone", "number": choose_recipient()}]
+            "endpoint": [{"type":"phone", "number": to_call}]
         }
     ])
 
-@app.route("/new-recording", methods=["POST"])
+@bp.route("/new-recording", methods=["POST"])
 @csrf.exempt
+@idempotent('nexmo-recording', lambda r: (r.get_json(silent=True) or {}).get('recording_uuid'), lambda: ("", 204))
 def nexmo_new_recording():
     data = request.json
     recording_url = data.get('recording_url')
     
     # SAVE TO SHARED POSTGRES
-    new_log = CommunicationLog(
+    log_buffer.add(
         provider='Nexmo',
         comm_type='Call',
         direction='Inbound',
         from_num='Nexmo Voicemail',
         content='New recording received',
-        recording_url=recording_url
+        recording_url=recording_url,
+        provider_sid=data.get('recording_uuid'),
+        receipt=g.webhook_key
     )
-    db_pg.session.add(new_log)
-    db_pg.session.commit()
+
+    prefetch_recording(recording_url)
 
     # ORIGINAL EMAIL LOGIC (Simplified to use your existing send_email)
     subject = "New VFA Nexmo Voicemail"
     html = f"<p>New voicemail recorded.</p><p>Listen here: <a href='{recording_url}'>Recording</a></p>"
-    send_email(FROM_EMAIL, RECIPIENT_EMAILS, subject, html)
+    notify_staff('voicemail', 'Nexmo Voicemail', subject, html)
     
     return "", 204
 
-@app.route("/inbound-sms-nexmo", methods=["POST"])
+def _nexmo_message_id(req):
+    data = req.get_json(silent=True) or {}
+    return data.get('message_uuid') or data.get('messageId')
+
+@bp.route("/inbound-sms-nexmo", methods=["POST"])
 @csrf.exempt
+@idempotent('nexmo-sms', _nexmo_message_id, lambda: ("", 204))
+@rate_limited('sms', _nexmo_caller, lambda: ("", 204))
 def nexmo_inbound_sms():
     data = request.get_json()
     msg = data.get('text', 'No text')
     them = data.get('msisdn', 'Unknown')
 
     # SAVE TO SHARED POSTGRES
-    new_log = CommunicationLog(
+    log_buffer.add(
         provider='Nexmo',
         comm_type='SMS',
         direction='Inbound',
         from_num=them,
-        content=msg
+        content=msg,
+        provider_sid=_nexmo_message_id(request),
+        receipt=g.webhook_key
     )
-    db_pg.session.add(new_log)
+
+    notify_staff('SMS', them, f"Nexmo SMS from {them}", f"Body: {msg}")
+    forward_to_shift(them, msg)
+    return "", 204
+
+
+###################### BROADCASTS ######################
+# Bulk SMS to an uploaded list of volunteers or voters. Numbers go through
+# correct_number(), and duplicates and invalid numbers are dropped at upload.
+# Sending runs as a chain of rq jobs on the 'broadcast' queue. Each job claims
+# BROADCAST_BATCH pending recipients and sends them with BROADCAST_CONCURRENCY
+# threads, then enqueues the next batch. Every provider has a token bucket
+# (shared through Redis) capping its messages per second.
+# Recipients fail over from one provider to the next on provider errors.
+# Errors about the recipient itself (invalid, unsubscribed) are final.
+# All progress is in the database, so a paused or crashed broadcast resumes
+# where it stopped. Every message is logged to CommunicationLog as soon as
+# its provider accepts it, and the delivery callbacks below update its status.
+
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "100"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "3"))
+BROADCAST_PROVIDERS = [p.strip() for p in os.getenv("BROADCAST_PROVIDERS", "twilio,nexmo").split(',') if p.strip()]
+BROADCAST_RATES = {  # messages/seconds per provider account
+    'twilio': os.getenv("BROADCAST_RATE_TWILIO", "10/1"),
+    'nexmo': os.getenv("BROADCAST_RATE_NEXMO", "30/1"),
+}
+BROADCAST_TOKEN_WAIT = float(os.getenv("BROADCAST_TOKEN_WAIT", "30"))  # seconds before trying the next provider
+BROADCAST_BREAKER = 5  # consecutive provider errors before a job stops using that provider
+broadcast_queue = Queue('broadcast', connection=redis_conn) if redis_conn else None
+broadcast_buckets = TokenBuckets(BROADCAST_RATES, 100, redis_conn)
+broadcast_stats = Counter()
+
+# recipient-side errors: failing over to another provider won't help
+TWILIO_RECIPIENT_ERRORS = {21211, 21408, 21610, 21612, 21614}
+NEXMO_RECIPIENT_ERRORS = {'6', '7', '12', '33'}
+
+class SendError(Exception):
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+def sms_status_url(provider):
+    return CALLBACK_URL.rstrip('/') + ('/sms-status' if provider == 'twilio' else '/sms-status-nexmo')
+
+def _provider_available(provider):
+    if provider == 'nexmo':
+        return bool(NEXMO_API_KEY and NEXMO_API_SECRET and NEXMO_NUMBER)
+    return provider == 'twilio'
+
+def send_via(provider, body, number, caller_id):
+    """Send one SMS; returns the provider's message id or raises SendError."""
+    if provider == 'twilio':
+        try:
+            # timed by InstrumentedTwilioHttpClient
+            message = twilio_client.messages.create(body=body, from_=caller_id or CALLER_ID, to=number,
+                                                    status_callback=sms_status_url('twilio'))
+        except TwilioRestException as e:
+            raise SendError(f"Twilio {e.code}: {e.msg}"[:200], permanent=e.code in TWILIO_RECIPIENT_ERRORS)
+        return message.sid
+    with timed('nexmo', 'sms.send'):  # the nexmo client has no timing hook of its own
+        response = smsclient.send_message({'from': NEXMO_NUMBER, 'to': number.lstrip('+'), 'text': body,
+                                           'callback': sms_status_url('nexmo')})
+    result = response['messages'][0]
+    if result.get('status') != '0':
+        raise SendError(f"Nexmo {result.get('status')}: {result.get('error-text')}"[:200],
+                        permanent=result.get('status') in NEXMO_RECIPIENT_ERRORS)
+    return result['message-id']
+
+def _wait_for_token(provider):
+    _, rate = broadcast_buckets.limits[provider]
+    deadline = time.monotonic() + BROADCAST_TOKEN_WAIT
+    while not broadcast_buckets.allow(provider, f"broadcast:{provider}"):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(min(1.0, 1 / rate))
+    return True
+
+def deliver_broadcast_message(body, number, caller_id, breaker):
+    """Try each provider in turn; returns an update dict for the recipient."""
+    error = 'no provider available'
+    for provider in BROADCAST_PROVIDERS:
+        if not _provider_available(provider) or breaker.get(provider, 0) >= BROADCAST_BREAKER:
+            continue
+        if not _wait_for_token(provider):
+            error = f"{provider} rate limit wait exceeded"
+            continue
+        try:
+            sid = send_via(provider, body, number, caller_id)
+        except SendError as e:
+            if e.permanent:
+                return {'status': 'failed', 'provider': provider, 'error': str(e)}
+            error = str(e)
+        except Exception as e:
+            error = f"{provider}: {e}"[:200]
+        else:
+            breaker[provider] = 0
+            return {'status': 'sent', 'provider': provider, 'provider_sid': sid, 'error': None}
+        breaker[provider] = breaker.get(provider, 0) + 1
+    return {'status': 'pending', 'error': error}  # retried in a later batch
+
+def record_broadcast_outcome(body, work, outcome):
+    """Commit one recipient's outcome and log row as soon as its provider answers.
+
+    Delivery callbacks look the message up by provider_sid, so it has to be
+    stored before they arrive rather than at the end of the batch.
+    """
+    recipient_id, number, caller_id, attempts = work
+    if outcome['status'] == 'pending' and attempts >= BROADCAST_MAX_ATTEMPTS:
+        outcome['status'] = 'failed'
+    log_rows = []
+    if outcome['status'] != 'pending':
+        log_rows.append({
+            'provider': (outcome.get('provider') or BROADCAST_PROVIDERS[0]).capitalize(),
+            'comm_type': 'SMS',
+            'direction': 'Outbound',
+            'from_num': caller_id if outcome.get('provider') == 'twilio' else NEXMO_NUMBER,
+            'to_num': number,
+            'content': body,
+            'provider_sid': outcome.get('provider_sid'),
+            'status': 'queued' if outcome['status'] == 'sent' else 'failed',
+            'timestamp': france_now(),
+        })
+    with app.app_context():
+        # only from 'sending', so a final status from a callback is never overwritten
+        BroadcastRecipient.query.filter_by(id=recipient_id, status='sending').update(
+            outcome, synchronize_session=False)
+        write_log_rows(log_rows)  # commits the recipient update too
+    return outcome
+
+def send_broadcast_batch(broadcast_id):
+    """Send the next batch of a broadcast; returns how many recipients it handled."""
+    with app.app_context():
+        broadcast = db_pg.session.get(Broadcast, broadcast_id)
+        if broadcast is None or broadcast.status != 'sending':
+            return 0
+        body = broadcast.body
+        # SKIP LOCKED so two chains for the same broadcast never claim the same rows
+        recipients = (BroadcastRecipient.query
+                      .filter_by(broadcast_id=broadcast_id, status='pending')
+                      .order_by(BroadcastRecipient.id).limit(BROADCAST_BATCH)
+                      .with_for_update(skip_locked=True).all())
+        if not recipients:
+            if not BroadcastRecipient.query.filter_by(broadcast_id=broadcast_id, status='sending').count():
+                broadcast.status = 'done'
+            db_pg.session.commit()
+            return 0
+        work = []
+        for r in recipients:
+            r.status, r.attempts = 'sending', r.attempts + 1
+            work.append((r.id, r.number, r.caller_id, r.attempts))
+        db_pg.session.commit()
+
+    breaker = {}
+    with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix="broadcast") as pool:
+        outcomes = list(pool.map(
+            lambda w: record_broadcast_outcome(body, w, deliver_broadcast_message(body, w[1], w[2], breaker)), work))
+
+    broadcast_stats.update((o.get('provider') or 'none', o['status']) for o in outcomes)
+    print(f"Broadcast {broadcast_id}: " + ", ".join(
+        f"{n} {status}" for status, n in Counter(o['status'] for o in outcomes).items()))
+
+    if broadcast_queue is not None:
+        broadcast_queue.enqueue(send_broadcast_batch, broadcast_id, job_timeout=600)
+    return len(work)
+
+def mark_broadcast_sending(broadcast_id, resend_unknown=False):
+    broadcast = db_pg.session.get(Broadcast, broadcast_id)
+    if broadcast is None:
+        raise ValueError(f"no broadcast {broadcast_id}")
+    # left 'sending' by a worker that died: we can't know if those went out
+    BroadcastRecipient.query.filter_by(broadcast_id=broadcast_id, status='sending').update(
+        {'status': 'pending' if resend_unknown else 'unknown'})
+    broadcast.status = 'sending'
+    db_pg.session.commit()
+
+def start_broadcast(broadcast_id, resend_unknown=False):
+    """Mark a broadcast as sending and queue its first batch for the rq worker."""
+    if broadcast_queue is None:
+        raise RuntimeError("sending a broadcast needs REDIS_URL and the rq worker")
+    mark_broadcast_sending(broadcast_id, resend_unknown)
+    broadcast_queue.enqueue(send_broadcast_batch, broadcast_id, job_timeout=600)
+
+def broadcast_counts(broadcast_ids):
+    """{broadcast id: {status: count}}"""
+    counts = {}
+    rows = (db_pg.session.query(BroadcastRecipient.broadcast_id, BroadcastRecipient.status, db_pg.func.count())
+            .filter(BroadcastRecipient.broadcast_id.in_(broadcast_ids))
+            .group_by(BroadcastRecipient.broadcast_id, BroadcastRecipient.status))
+    for broadcast_id, status, n in rows:
+        counts.setdefault(broadcast_id, {})[status] = n
+    return counts
+
+def parse_recipients(text):
+    """Raw numbers from an uploaded list: CSV with a number/phone column, or one per line."""
+    lines = [l for l in text.splitlines() if l.strip()]
+    if not lines:
+        return []
+    header = [h.strip().lower() for h in next(csv.reader([lines[0]]))]
+    column = next((h for h in ('number', 'phone', 'mobile', 'telephone') if h in header), None)
+    if column is None:
+        return [next(csv.reader([l]))[0] for l in lines]
+    return [row.get(column, '') for row in csv.DictReader(lines, fieldnames=header) if row is not None][1:]
+
+def create_broadcast(name, body, raw_numbers):
+    """Create a draft broadcast; returns (broadcast, invalid inputs)."""
+    broadcast = Broadcast(name=name, body=body, status='draft')
+    db_pg.session.add(broadcast)
+    db_pg.session.flush()
+    recipients, invalid = {}, []
+    for raw, result in zip(raw_numbers, phone_numbers.normalize_many(raw_numbers)):
+        if not result.e164:
+            invalid.append(raw)
+        else:
+            recipients.setdefault(result.e164, result.caller_id)
+    db_pg.session.execute(insert(BroadcastRecipient), [
+        {'broadcast_id': broadcast.id, 'number': number, 'caller_id': caller_id, 'status': 'pending', 'attempts': 0}
+        for number, caller_id in recipients.items()])
+    db_pg.session.commit()
+    return broadcast, invalid
+
+## DELIVERY STATUS ##
+TWILIO_FINAL_STATUS = {'delivered': 'delivered', 'undelivered': 'failed', 'failed': 'failed'}
+NEXMO_FINAL_STATUS = {'delivered': 'delivered', 'failed': 'failed', 'expired': 'failed', 'rejected': 'failed'}
+
+def record_delivery(provider, sid, status, final):
+    if not sid or not status:
+        return
+    db_pg.session.query(CommunicationLog).filter(
+        CommunicationLog.provider == provider, CommunicationLog.provider_sid == sid).update(
+        {'status': status[:20]}, synchronize_session=False)
+    if final:
+        db_pg.session.query(BroadcastRecipient).filter(BroadcastRecipient.provider_sid == sid).update(
+            {'status': final}, synchronize_session=False)
     db_pg.session.commit()
 
-    send_email(FROM_EMAIL, RECIPIENT_EMAILS, f"Nexmo SMS from {them}", f"Body: {msg}")
+@bp.route("/sms-status", methods=["POST"])
+@csrf.exempt
+def twilio_sms_status():
+    status = request.values.get('MessageStatus')
+    record_delivery('Twilio', request.values.get('MessageSid'), status, TWILIO_FINAL_STATUS.get(status))
     return "", 204
+
+@bp.route("/sms-status-nexmo", methods=["GET", "POST"])
+@csrf.exempt
+def nexmo_sms_status():
+    data = request.get_json(silent=True) or request.values
+    status = data.get('status')
+    record_delivery('Nexmo', data.get('messageId'), status, NEXMO_FINAL_STATUS.get(status))
+    return "", 204
+
+## BROADCAST ADMIN ##
+@bp.route("/admin/broadcasts", methods=["GET", "POST"])
+@requires_auth
+def admin_broadcasts():
+    message = None
+    if request.method == 'POST':
+        upload = request.files.get('recipients')
+        text = upload.read().decode('utf-8-sig', 'replace') if upload and upload.filename else request.form.get('numbers', '')
+        name, body = request.form.get('name', '').strip(), request.form.get('body', '').strip()
+        if not name or not body:
+            message = "A broadcast needs a name and a message."
+        else:
+            broadcast, invalid = create_broadcast(name, body, parse_recipients(text))
+            message = f"Created '{broadcast.name}'." + (f" Skipped {len(invalid)} invalid number(s): {', '.join(invalid[:20])}" if invalid else "")
+    broadcasts = Broadcast.query.order_by(Broadcast.id.desc()).limit(50).all()
+    counts = broadcast_counts([b.id for b in broadcasts])
+    return render_template_string("""
+        <h1>Broadcasts</h1>
+        {% for flashed in get_flashed_messages() %}<p><strong>{{ flashed }}</strong></p>{% endfor %}
+        {% if message %}<p><strong>{{ message }}</strong></p>{% endif %}
+        <table border="1" cellpadding="4">
+            <tr><th>Name</th><th>Status</th><th>Recipients</th><th></th></tr>
+            {% for b in broadcasts %}
+            <tr><td>{{ b.name }}<br><small>{{ b.body[:80] }}</small></td><td>{{ b.status }}</td>
+                <td>{% for status, n in counts.get(b.id, {}).items() %}{{ status }}: {{ n }}<br>{% endfor %}</td>
+                <td><form method="post" action="{{ url_for('.admin_broadcast_action', broadcast_id=b.id) }}">
+                    <input type="hidden" name="csrf_token" value="{{ csrf_token() }}">
+                    {% if b.status == 'sending' %}<button name="action" value="pause">Pause</button>
+                    {% elif b.status != 'done' %}<button name="action" value="send">{{ 'Resume' if b.status == 'paused' else 'Send' }}</button>{% endif %}
+                </form></td></tr>
+            {% endfor %}
+        </table>
+        <h2>New broadcast</h2>
+        <form method="post" enctype="multipart/form-data">
+            <input type="hidden" name="csrf_token" value="{{ csrf_token() }}">
+            <p><input name="name" placeholder="Name" size="40"></p>
+            <p><textarea name="body" rows="4" cols="60" placeholder="Message"></textarea></p>
+            <p>Recipients: CSV with a "number" column <input type="file" name="recipients" accept=".csv,.txt"></p>
+            <p>or one number per line:<br><textarea name="numbers" rows="6" cols="30"></textarea></p>
+            <button type="submit">Create draft</button>
+        </form>
+    """, broadcasts=broadcasts, counts=counts, message=message)
+
+@bp.route("/admin/broadcasts/<int:broadcast_id>", methods=["POST"])
+@requires_auth
+def admin_broadcast_action(broadcast_id):
+    broadcast = db_pg.session.get(Broadcast, broadcast_id)
+    if broadcast is None:
+        return Response("No such broadcast", 404)
+    if request.form.get('action') == 'pause':
+        broadcast.status = 'paused'  # the running batch finishes, the chain stops there
+        db_pg.session.commit()
+    elif request.form.get('action') == 'send':
+        if broadcast_queue is None:
+            # never send inline here: pacing 10k messages would outlive the request
+            flash(f"No job queue (REDIS_URL unset): run `flask broadcast send {broadcast_id}` instead.")
+        else:
+            start_broadcast(broadcast_id)
+    return redirect(url_for('.admin_broadcasts'))
+
+broadcast_cli = AppGroup('broadcast', help="Create and send bulk SMS broadcasts.")
+
+@broadcast_cli.command("create")
+@click.argument("recipients", type=click.File('r', encoding='utf-8-sig'))
+@click.option("--name", required=True)
+@click.option("--body", required=True)
+def broadcast_create(recipients, name, body):
+    broadcast, invalid = create_broadcast(name, body, parse_recipients(recipients.read()))
+    count = BroadcastRecipient.query.filter_by(broadcast_id=broadcast.id).count()
+    print(f"Broadcast {broadcast.id}: {count} recipient(s), {len(invalid)} invalid skipped")
+
+@broadcast_cli.command("send")
+@click.argument("broadcast_id", type=int)
+@click.option("--resend-unknown", is_flag=True, help="Also resend messages that were in flight when a worker died.")
+def broadcast_send(broadcast_id, resend_unknown):
+    """Start or resume a broadcast."""
+    if broadcast_queue is not None:
+        start_broadcast(broadcast_id, resend_unknown)
+        print(f"Broadcast {broadcast_id} queued")
+        return
+    # no worker to hand it to: send every batch from this process
+    mark_broadcast_sending(broadcast_id, resend_unknown)
+    while send_broadcast_batch(broadcast_id):
+        pass
+    print(f"Broadcast {broadcast_id} sent")
+
+@broadcast_cli.command("pause")
+@click.argument("broadcast_id", type=int)
+def broadcast_pause(broadcast_id):
+    Broadcast.query.filter_by(id=broadcast_id).update({'status': 'paused'})
+    db_pg.session.commit()
+    print(f"Paused {broadcast_id}")
+
+@broadcast_cli.command("status")
+@click.argument("broadcast_id", type=int)
+def broadcast_status(broadcast_id):
+    broadcast = db_pg.session.get(Broadcast, broadcast_id)
+    counts = broadcast_counts([broadcast_id]).get(broadcast_id, {})
+    print(f"{broadcast.name} ({broadcast.status}): " + ", ".join(f"{n} {s}" for s, n in sorted(counts.items())))
+
+bp.cli.add_command(broadcast_cli)
+
+
+###################### APP FACTORY ######################
+
+AUTO_CREATE_SCHEMA = os.getenv("AUTO_CREATE_SCHEMA", "0") == "1"  # otherwise run `flask init-db`
+
+def create_app(config=None):
+    """Build the Flask app. Provider clients are created on first use."""
+    started = time.perf_counter()
+    app = Flask(__name__)
+    app.secret_key = SECRET_KEY
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if uri and uri.startswith("postgresql"):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_pre_ping': True,
+        }
+    app.config.update(config or {})
+
+    csrf.init_app(app)
+    db_pg.init_app(app)
+    app.register_blueprint(bp)
+
+    if AUTO_CREATE_SCHEMA:
+        schema_started = time.perf_counter()
+        with app.app_context():
+            ensure_schema()
+        boot_timings['schema'] = time.perf_counter() - schema_started
+
+    boot_timings['imports'] = started - _BOOT_STARTED
+    boot_timings['app'] = time.perf_counter() - started
+    print("Startup: " + ", ".join(f"{phase} {seconds * 1000:.0f}ms" for phase, seconds in boot_timings.items())
+          + f" (pid {os.getpid()})")
+    return app
+
+app = create_app()
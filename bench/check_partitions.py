@@ -0,0 +1,209 @@
+"""
+Check the Postgres log partitioning end to end on scratch databases:
+
+    python bench/check_partitions.py postgresql://postgres@localhost/postgres
+
+The URL only has to reach a server where the user may CREATE DATABASE; the
+checks run in throwaway databases that are dropped afterwards. Each step is
+the same `flask` command the Procfile and the rq jobs run:
+
+    fresh       init-db on an empty database partitions communication_log from
+                the first Twilio sync's backfill window to LOG_PARTITIONS_AHEAD
+                months ahead
+    legacy      partition-log converts an unpartitioned table, keeping every
+                row and the id sequence
+    maintain    maintain-log moves rows that landed in the default partition
+                into monthly ones, archives every month before the cutoff
+                (and no empty ones) and drops their partitions
+
+Exits non-zero if any check fails.
+"""
+import argparse, datetime, gzip, os, subprocess, sys, tempfile, uuid
+from zoneinfo import ZoneInfo
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from replay import DUMMY_ENV, ROOT
+
+BACKFILL_DAYS = 7
+AHEAD = 2
+RETENTION = 2
+
+LEGACY_DDL = """
+CREATE TABLE communication_log (
+    id SERIAL PRIMARY KEY,
+    provider VARCHAR(20),
+    comm_type VARCHAR(20),
+    direction VARCHAR(20),
+    from_num VARCHAR(50),
+    to_num VARCHAR(50),
+    content TEXT,
+    recording_url TEXT,
+    timestamp TIMESTAMP WITHOUT TIME ZONE
+);
+CREATE INDEX ix_communication_log_timestamp ON communication_log (timestamp, id);
+"""
+
+failures = []
+
+
+def check(ok, what):
+    print(f"  {'ok  ' if ok else 'FAIL'} {what}")
+    if not ok:
+        failures.append(what)
+
+
+def month_start(moment):
+    return datetime.datetime(moment.year, moment.month, 1)
+
+
+def add_months(month, n):
+    index = month.year * 12 + month.month - 1 + n
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+
+def paris_now():
+    return datetime.datetime.now(ZoneInfo("Europe/Paris")).replace(tzinfo=None)
+
+
+def partitions(conn):
+    return sorted(conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'communication_log'::regclass")).scalars())
+
+
+def insert_rows(conn, timestamps):
+    conn.execute(text("INSERT INTO communication_log (provider, comm_type, direction, content, timestamp) "
+                      "VALUES ('Twilio', 'SMS', 'Inbound', 'check', :ts)"), [{'ts': ts} for ts in timestamps])
+
+
+class Scratch:
+    """A throwaway database on the server `url` points at."""
+
+    def __init__(self, url):
+        self.server = create_engine(url, isolation_level='AUTOCOMMIT')
+        self.name = f"frdem_check_{uuid.uuid4().hex[:12]}"
+        self.url = make_url(url).set(database=self.name)
+
+    def __enter__(self):
+        with self.server.connect() as conn:
+            conn.execute(text(f'CREATE DATABASE "{self.name}"'))
+        self.engine = create_engine(self.url)
+        return self
+
+    def __exit__(self, *exc):
+        self.engine.dispose()
+        with self.server.connect() as conn:
+            conn.execute(text(f'DROP DATABASE IF EXISTS "{self.name}"'))
+        self.server.dispose()
+
+    def flask(self, *args, **env):
+        full_env = dict(DUMMY_ENV, **{k: v for k, v in os.environ.items() if k != 'REDIS_URL'})
+        full_env.update(DATABASE_URL=self.url.render_as_string(hide_password=False),
+                        TWILIO_SYNC_BACKFILL_DAYS=str(BACKFILL_DAYS), LOG_PARTITIONS_AHEAD=str(AHEAD),
+                        LOG_RETENTION_MONTHS=str(RETENTION), **env)
+        result = subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', *args], cwd=ROOT,
+                                env=full_env, capture_output=True, text=True)
+        output = (result.stdout + result.stderr).strip()
+        check(result.returncode == 0, f"flask {' '.join(args)}" + (f"\n{output}" if result.returncode else ''))
+        return output
+
+
+def check_fresh(url):
+    print("fresh: init-db on an empty database")
+    now = paris_now()
+    with Scratch(url) as db:
+        db.flask('init-db')
+        with db.engine.connect() as conn:
+            check(conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('communication_log')"))
+                  .scalar() == 'p', "communication_log is partitioned")
+            names = partitions(conn)
+        first = month_start(now - datetime.timedelta(days=BACKFILL_DAYS))
+        expected, month = [], first
+        while month <= add_months(month_start(now), AHEAD):
+            expected.append(f"communication_log_p{month:%Y%m}")
+            month = add_months(month, 1)
+        check(names == sorted(expected + ['communication_log_default']),
+              f"partitions {first:%Y-%m} through {AHEAD} months ahead, plus the default: {names}")
+
+
+def check_legacy_and_maintain(url):
+    print("legacy: partition-log on an unpartitioned table")
+    now = paris_now()
+    cutoff = add_months(month_start(now), -RETENTION)
+    # a gap two months wide, so an empty month falls before the cutoff
+    timestamps = [now - datetime.timedelta(days=d) for d in (0, 3, 40, 70, 200, 201)]
+    with Scratch(url) as db, tempfile.TemporaryDirectory() as archive_dir:
+        with db.engine.begin() as conn:
+            for stmt in LEGACY_DDL.split(';'):
+                if stmt.strip():
+                    conn.execute(text(stmt))
+            insert_rows(conn, timestamps)
+        db.flask('init-db')
+        db.flask('partition-log')
+        with db.engine.begin() as conn:
+            check(conn.execute(text("SELECT count(*) FROM communication_log")).scalar() == len(timestamps),
+                  f"all {len(timestamps)} rows copied")
+            check(conn.execute(text("SELECT count(*) FROM communication_log_default")).scalar() == 0,
+                  "no rows in the default partition")
+            check(f"communication_log_p{month_start(min(timestamps)):%Y%m}" in partitions(conn),
+                  "partitions start at the oldest row's month")
+            max_id = conn.execute(text("SELECT max(id) FROM communication_log")).scalar()
+            insert_rows(conn, [now])
+            check(conn.execute(text("SELECT max(id) FROM communication_log")).scalar() > max_id,
+                  "new rows continue the id sequence")
+
+            # rows for a month with no partition, e.g. a late sync of old calls
+            stray = month_start(now - datetime.timedelta(days=400)) + datetime.timedelta(days=3)
+            insert_rows(conn, [stray, stray + datetime.timedelta(hours=1)])
+            check(conn.execute(text("SELECT count(*) FROM communication_log_default")).scalar() == 2,
+                  f"rows for {stray:%Y-%m} land in the default partition")
+            total = conn.execute(text("SELECT count(*) FROM communication_log")).scalar()
+            expired = conn.execute(text("SELECT count(*) FROM communication_log WHERE timestamp < :c"),
+                                   {'c': cutoff}).scalar()
+            expired_months = sorted(conn.execute(text(
+                "SELECT DISTINCT date_trunc('month', timestamp) FROM communication_log WHERE timestamp < :c"),
+                {'c': cutoff}).scalars())
+
+        print(f"maintain: maintain-log with a {cutoff:%Y-%m} cutoff")
+        db.flask('maintain-log', LOG_ARCHIVE_DIR=archive_dir)
+        with db.engine.connect() as conn:
+            check(conn.execute(text("SELECT count(*) FROM communication_log_default")).scalar() == 0,
+                  "default partition emptied")
+            check(conn.execute(text("SELECT count(*) FROM communication_log")).scalar() == total - expired,
+                  f"{expired} expired row(s) removed from the table")
+            names = partitions(conn)
+            check(not [n for n in names if n != 'communication_log_default' and n < f"communication_log_p{cutoff:%Y%m}"],
+                  "no partitions left before the cutoff")
+        archives = sorted(os.listdir(archive_dir))
+        check(archives == [f"communication_log-{m:%Y-%m}.ndjson.gz" for m in expired_months],
+              f"one archive per expired month with rows: {archives}")
+        archived = 0
+        for name in archives:
+            with gzip.open(os.path.join(archive_dir, name), 'rt') as f:
+                archived += sum(1 for _ in f)
+        check(archived == expired, f"archives hold all {expired} expired row(s)")
+
+        db.flask('maintain-log', LOG_ARCHIVE_DIR=archive_dir)
+        check(sorted(os.listdir(archive_dir)) == archives, "a second run archives nothing")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('url', help="Postgres URL of a server to create scratch databases on")
+    args = parser.parse_args(argv)
+    if args.url.startswith("postgres://"):  # as app.py accepts it
+        args.url = args.url.replace("postgres://", "postgresql://", 1)
+    if make_url(args.url).get_backend_name() != 'postgresql':
+        raise SystemExit("partitioning is Postgres only")
+    check_fresh(args.url)
+    check_legacy_and_maintain(args.url)
+    if failures:
+        raise SystemExit(f"\n{len(failures)} check(s) failed")
+    print("\nall checks passed")
+
+
+if __name__ == '__main__':
+    main()
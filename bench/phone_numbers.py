@@ -0,0 +1,153 @@
+"""
+Micro-benchmark: phone.py's Normalizer against the regex + if-chain
+clean_number/correct_number it replaced in app.py.
+
+    python bench/phone_numbers.py --count 100000 --distinct 5000
+
+The corpus mixes the formats we actually see (Twilio E.164, Nexmo msisdn,
+hand-typed French and US numbers, other countries), drawn from --distinct
+callers so repeat callers hit the cache the way they do in production.
+Before timing anything, the CASES below must normalize as listed; the run
+stops with an error otherwise (--check-only stops there either way).
+"""
+import argparse, os, random, re, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from phone import Normalizer
+
+CALLER_ID, CALLER_ID_US = '+33100000000', '+12125550000'
+
+
+# the implementation from app.py before phone.py, kept verbatim as the baseline
+def legacy_clean_number(s):
+    sdigitsonly = re.sub('[^0-9]+', '', s)
+    return "+"+sdigitsonly
+
+def legacy_correct_number(s):
+    if len(s) == 11 and s[1] == '0':
+        return ("+33"+s[2:], CALLER_ID)
+    elif len(s) == 11 and int(s[1]) >= 2:
+        return ("+1"+s[1:], CALLER_ID_US)
+    elif len(s) == 12 and s[0:3] == '+33':
+        return (s, CALLER_ID)
+    elif len(s) == 12 and s[0:4] == '+330':
+        return ('+33'+s[4:], CALLER_ID)
+    elif len(s) == 12 and s[0:2] == '+1':
+        return (s, CALLER_ID_US)
+    elif len(s) >= 12 and len(s) <= 15:
+        return (s, CALLER_ID)
+    else:
+        return ('invalid', CALLER_ID)
+
+
+# settled answers, each once a bug or a format we had to support
+CASES = {
+    '+33612345678': '+33612345678',
+    '33612345678': '+33612345678',            # Nexmo msisdn
+    '06 12 34 56 78': '+33612345678',
+    '612345678': '+33612345678',              # trunk 0 left off, not Australian +61
+    '+33 (0)6 12 34 56 78': '+33612345678',
+    '0033 6 12 34 56 78': '+33612345678',
+    '01 23 45 67 89': '+33123456789',
+    '0262 12 34 56': '+33262123456',
+    '(212) 555-0100': '+12125550100',
+    '+1 212 555 0100': '+12125550100',
+    '011 44 7911 123456': '+447911123456',
+    '+44 7911 123456': '+447911123456',
+    '00 32 470 12 34 56': '+32470123456',
+    '+61 412 345 678': '+61412345678',
+    '447911123456': '+447911123456',
+    '12': None,
+    'not a number': None,
+}
+
+def check_cases():
+    """[(input, expected, got)] for every CASES entry that comes out wrong."""
+    normalize = Normalizer('FR', {'1': CALLER_ID_US}, CALLER_ID).normalize
+    return [(raw, e164, normalize(raw).e164) for raw, e164 in CASES.items() if normalize(raw).e164 != e164]
+
+
+def _digits(n):
+    return ''.join(random.choice('0123456789') for _ in range(n))
+
+FORMATS = [
+    lambda: f"+336{_digits(8)}",                                       # Twilio, French mobile
+    lambda: f"337{_digits(8)}",                                        # Nexmo msisdn
+    lambda: "06 " + " ".join(_digits(2) for _ in range(4)),            # typed French
+    lambda: f"+33 (0)6 {_digits(2)} {_digits(2)} {_digits(2)} {_digits(2)}",
+    lambda: f"({random.randint(201, 989)}) {_digits(3)}-{_digits(4)}",  # typed US
+    lambda: f"+1{random.randint(201, 989)}{_digits(7)}",
+    lambda: f"+44 7{_digits(3)} {_digits(6)}",
+    lambda: f"+49 30 {_digits(7)}",
+    lambda: f"00 32 4{_digits(8)}",
+]
+
+def corpus(count, distinct, seed=1):
+    random.seed(seed)
+    callers = [random.choice(FORMATS)() for _ in range(distinct)]
+    return [random.choice(callers) for _ in range(count)]
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - started, result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=100_000)
+    parser.add_argument('--distinct', type=int, default=5_000)
+    parser.add_argument('--check-only', action='store_true', help="check CASES and skip the timing")
+    args = parser.parse_args(argv)
+    wrong = check_cases()
+    for raw, expected, got in wrong:
+        print(f"  {raw!r:32} expected {expected}, got {got}")
+    if wrong:
+        raise SystemExit(f"{len(wrong)} of {len(CASES)} known numbers normalize wrongly")
+    print(f"{len(CASES)} known numbers normalize as expected")
+    if args.check_only:
+        return
+    numbers = corpus(args.count, args.distinct)
+
+    def legacy(values):
+        return [legacy_correct_number(legacy_clean_number(v)) for v in values]
+
+    def single(normalizer, values):
+        normalize = normalizer.normalize
+        return [normalize(v) for v in values]
+
+    def uncached(values):
+        parse = Normalizer('FR', {'1': CALLER_ID_US}, CALLER_ID)._normalize
+        return [parse(v) for v in values]
+
+    runs = [
+        ("legacy clean+correct", lambda: legacy(numbers)),
+        ("normalize, no cache", lambda: uncached(numbers)),
+        ("normalize, cold cache", lambda: single(Normalizer('FR', {'1': CALLER_ID_US}, CALLER_ID), numbers)),
+        ("normalize_many", lambda: Normalizer('FR', {'1': CALLER_ID_US}, CALLER_ID).normalize_many(numbers)),
+    ]
+    warm = Normalizer('FR', {'1': CALLER_ID_US}, CALLER_ID)
+    warm.normalize_many(numbers)
+    runs.append(("normalize, warm cache", lambda: single(warm, numbers)))
+
+    print(f"{args.count} numbers, {args.distinct} distinct")
+    print(f"{'':24}{'total ms':>10}{'ns/number':>12}")
+    results = {}
+    for label, run in runs:
+        seconds, results[label] = timed(run)
+        print(f"{label:24}{seconds * 1000:10.1f}{seconds / args.count * 1e9:12.0f}")
+
+    # where the two disagree on the E.164 form, the legacy answer was a guess
+    legacy_e164 = [e for e, _ in results["legacy clean+correct"]]
+    new_e164 = [r.e164 or 'invalid' for r in results["normalize_many"]]
+    differ = sum(a != b for a, b in zip(legacy_e164, new_e164))
+    print(f"\n{differ} of {args.count} results differ from the legacy functions, e.g.:")
+    shown = set()
+    for raw, old, new in zip(numbers, legacy_e164, new_e164):
+        if old != new and raw not in shown and len(shown) < 5:
+            shown.add(raw)
+            print(f"  {raw!r:32} legacy {old:16} now {new}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""
+Replay realistic Twilio/Nexmo webhook traffic against app.py and report
+per-route latency percentiles and throughput.
+
+By default this starts the provider stubs from bench/stubs.py, boots
+`gunicorn app:app` (same command as the Procfile) pointed at them, and
+drives it with a pool of concurrent "callers":
+
+    python bench/replay.py --workers 3 --concurrency 20 --duration 30 \\
+        --latency-ms twilio=150 --latency-ms resend=300
+
+Add --worker-class gevent to measure the event-loop serving mode set up in
+gunicorn.conf.py. Use --target http://host:port to hit an already running
+server instead.
+Every run is saved under bench/results/ and compared with the previous one
+(or --compare FILE).
+After a local run, `flask check-rollups` confirms the hourly rollups the
+webhooks kept match a backfill over the rows they logged.
+
+Scenarios (weights set with --mix):
+    sms             Twilio inbound SMS (/receive_sms)
+    call            full IVR flow: /receive_call -> /intro -> /route ->
+                    /end_call (dial action) -> /postscript -> /send_transcription
+    nexmo_sms       Nexmo inbound SMS (/inbound-sms-nexmo)
+    nexmo_recording Nexmo recording callback (/new-recording)
+    nexmo_call      Nexmo IVR: /answer -> /language
+    repeat_caller   /receive_call -> /route from a handful of numbers, so the
+                    per-caller rate limits kick in (throttled answers are 2xx)
+    recording       admin playback through the recording cache (/admin/recording),
+                    over RECORDINGS distinct voicemails, so early plays miss and
+                    later ones hit; provider_requests counts the misses
+"""
+import argparse, datetime, glob, json, os, random, signal, socket, subprocess, sys, tempfile, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stubs import start_stubs, stub_env, PROVIDERS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# everything app.py refuses to start without
+DUMMY_ENV = {
+    'TWILIO_ACCT': 'AC' + '0' * 32, 'TWILIO_SECRET': 'bench',
+    'RECIPIENT1': '+33600000001', 'RECIPIENT2': '+33600000002',
+    'RECIPIENT3': '+33600000003', 'RECIPIENT4': '+33600000004',
+    'RECIPIENT_MEDIA': '+33600000005', 'RECIPIENT_DEBUGGING': '+33600000006',
+    'CALLER_ID': '+33100000000', 'CALLER_ID_US': '+12025550100',
+    'FROM_EMAIL': 'bench@example.org', 'RESPONSE_LIST': 'response@example.org', 'TECH_LIST': 'tech@example.org',
+    'SECRET_KEY': 'bench', 'CALLBACK_URL': 'http://127.0.0.1/',
+    'ENGLISH_URL': 'https://example.org/en.mp3', 'FRENCH_URL': 'https://example.org/fr.mp3',
+    'VOICEMAIL_ENGLISH_URL': 'https://example.org/vm-en.mp3', 'VOICEMAIL_FRENCH_URL': 'https://example.org/vm-fr.mp3',
+    'INTRO_URL': 'https://example.org/intro.mp3', 'FDR_URL': 'https://example.org/fdr.mp3',
+    'NEXMO_NUMBER': '33100000001',
+    'ADMIN_PASS': 'bench',
+}
+RECORDINGS = 50  # distinct voicemails the call and recording scenarios share
+
+
+def _recording_url():
+    sid = f"RE{random.randrange(RECORDINGS):032d}"
+    return f"https://api.twilio.com/2010-04-01/Accounts/{DUMMY_ENV['TWILIO_ACCT']}/Recordings/{sid}"
+
+
+def _number():
+    return f"+336{random.randint(10000000, 99999999)}"
+
+
+def scenario_sms(session, base, timed):
+    timed('/receive_sms', session.post, f"{base}/receive_sms", data={
+        'MessageSid': 'SM' + uuid.uuid4().hex, 'From': _number(), 'To': DUMMY_ENV['CALLER_ID'],
+        'Body': random.choice(["Bonjour, où est mon bureau de vote ?", "How do I request a ballot?", "STOP"]),
+    })
+
+
+def scenario_call(session, base, timed):
+    call = {'CallSid': 'CA' + uuid.uuid4().hex, 'From': _number(), 'To': DUMMY_ENV['CALLER_ID']}
+    timed('/receive_call', session.post, f"{base}/receive_call", data=call)
+    timed('/intro', session.post, f"{base}/intro", data=dict(call, Digits=random.choice('12')))
+    timed('/route', session.post, f"{base}/route", data=dict(call, Digits=random.choice('123')))
+    timed('/end_call', session.post, f"{base}/end_call",
+          data=dict(call, DialCallStatus=random.choice(['completed', 'no-answer', 'busy'])))
+    url = _recording_url()
+    recording = {'RecordingSid': url.rsplit('/', 1)[1], 'RecordingUrl': url}
+    timed('/postscript', session.post, f"{base}/postscript", data=dict(call, **recording))
+    timed('/send_transcription', session.post, f"{base}/send_transcription",
+          data=dict(call, TranscriptionText="Bonjour, j'ai une question sur mon inscription.", **recording))
+
+
+def scenario_nexmo_sms(session, base, timed):
+    timed('/inbound-sms-nexmo', session.post, f"{base}/inbound-sms-nexmo", json={
+        'msisdn': _number().lstrip('+'), 'to': DUMMY_ENV['NEXMO_NUMBER'],
+        'messageId': uuid.uuid4().hex, 'text': "Where do I vote?",
+    })
+
+
+def scenario_nexmo_recording(session, base, timed):
+    timed('/new-recording', session.post, f"{base}/new-recording", json={
+        'recording_uuid': str(uuid.uuid4()), 'conversation_uuid': 'CON-' + str(uuid.uuid4()),
+        'recording_url': 'https://api.nexmo.com/v1/files/' + str(uuid.uuid4()),
+    })
+
+
+def scenario_nexmo_call(session, base, timed):
+    call = {'from': _number().lstrip('+'), 'to': DUMMY_ENV['NEXMO_NUMBER'], 'conversation_uuid': 'CON-' + str(uuid.uuid4())}
+    timed('/answer', session.get, f"{base}/answer", params=call)
+    timed('/language', session.post, f"{base}/language", json=dict(call, dtmf=random.choice('12')))
+
+
+REPEAT_CALLERS = [f"+3361000000{i}" for i in range(5)]
+
+
+def scenario_repeat_caller(session, base, timed):
+    call = {'CallSid': 'CA' + uuid.uuid4().hex, 'From': random.choice(REPEAT_CALLERS), 'To': DUMMY_ENV['CALLER_ID']}
+    timed('/receive_call (repeat)', session.post, f"{base}/receive_call", data=call)
+    timed('/route (repeat)', session.post, f"{base}/route", data=dict(call, Digits=random.choice('123')))
+
+
+def scenario_recording(session, base, timed):
+    timed('/admin/recording', session.get, f"{base}/admin/recording", params={'url': _recording_url()},
+          auth=('admin', DUMMY_ENV['ADMIN_PASS']))
+
+
+SCENARIOS = {
+    'sms': scenario_sms,
+    'call': scenario_call,
+    'nexmo_sms': scenario_nexmo_sms,
+    'nexmo_recording': scenario_nexmo_recording,
+    'nexmo_call': scenario_nexmo_call,
+    'repeat_caller': scenario_repeat_caller,
+    'recording': scenario_recording,
+}
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def timed(self, route, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            ok = fn(*args, timeout=60, **kwargs).status_code < 500
+        except requests.RequestException:
+            ok = False
+        elapsed = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self.samples.setdefault(route, []).append(elapsed)
+            if not ok:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(recorder, elapsed):
+    routes = {}
+    for route, values in sorted(recorder.samples.items()):
+        values = sorted(values)
+        routes[route] = {
+            'count': len(values),
+            'errors': recorder.errors.get(route, 0),
+            'rps': len(values) / elapsed,
+            'p50_ms': percentile(values, 50),
+            'p95_ms': percentile(values, 95),
+            'p99_ms': percentile(values, 99),
+            'max_ms': values[-1],
+        }
+    return routes
+
+
+def run_load(base, mix, concurrency, duration=None, iterations=None):
+    recorder = Recorder()
+    names, weights = zip(*mix.items())
+    stop_at = time.monotonic() + duration if duration else None
+    remaining = [iterations] if iterations else None
+    lock = threading.Lock()
+
+    def caller():
+        with requests.Session() as session:
+            while True:
+                if stop_at and time.monotonic() >= stop_at:
+                    return
+                if remaining is not None:
+                    with lock:
+                        if remaining[0] <= 0:
+                            return
+                        remaining[0] -= 1
+                SCENARIOS[random.choices(names, weights)[0]](session, base, recorder.timed)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(caller)
+    return recorder, time.perf_counter() - start
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def spawn_app(env, workers, worker_class):
+    # same as the Procfile's release step; the app doesn't create tables on boot
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], cwd=ROOT, env=env, check=True)
+    port = _free_port()
+    cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f"127.0.0.1:{port}",
+           '--workers', str(workers), '--worker-class', worker_class, '--log-level', 'warning']
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"gunicorn exited with {proc.returncode}")
+        try:
+            requests.get(f"{base}/receive_call", timeout=1)
+            return proc, base
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.terminate()
+    raise SystemExit("gunicorn did not come up within 30s")
+
+
+def print_report(routes, previous=None):
+    header = f"{'route':<22}{'count':>7}{'err':>5}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print('-' * len(header))
+    for route, r in routes.items():
+        line = (f"{route:<22}{r['count']:>7}{r['errors']:>5}{r['rps']:>9.1f}"
+                f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}")
+        before = (previous or {}).get(route)
+        if before and before.get('p95_ms'):
+            line += f"   p95 {100 * (r['p95_ms'] - before['p95_ms']) / before['p95_ms']:+.0f}% vs previous"
+        print(line)
+
+
+def save_results(result):
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{result['started'].replace(':', '')}.json")
+    with open(path, 'w') as f:
+        json.dump(result, f, indent=2)
+    return path
+
+
+def latest_result(exclude=None):
+    runs = sorted(p for p in glob.glob(os.path.join(RESULTS_DIR, '*.json')) if p != exclude)
+    return runs[-1] if runs else None
+
+
+def parse_latency(values):
+    latency = {p: 0.0 for p in PROVIDERS}
+    for value in values:
+        if '=' in value:
+            provider, ms = value.split('=', 1)
+            latency[provider] = float(ms)
+        else:
+            latency = {p: float(value) for p in PROVIDERS}
+    return latency
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"unknown scenario {name!r}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', help="base URL of a running app (skips stubs and gunicorn)")
+    parser.add_argument('--workers', type=int, default=1, help="gunicorn workers (Procfile default: 1)")
+    parser.add_argument('--worker-class', default='sync')
+    parser.add_argument('--concurrency', type=int, default=10, help="simultaneous callers")
+    parser.add_argument('--duration', type=float, default=20, help="seconds to run")
+    parser.add_argument('--iterations', type=int, help="stop after this many scenarios instead")
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('sms=3,call=2,nexmo_sms=1,nexmo_recording=1,nexmo_call=1,repeat_caller=1,recording=1'))
+    parser.add_argument('--latency-ms', action='append', default=[],
+                        help="injected provider latency: MS for all, or PROVIDER=MS (repeatable)")
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--compare', help="results file to compare against (default: previous run)")
+    parser.add_argument('--label', default='')
+    args = parser.parse_args(argv)
+
+    latency = parse_latency(args.latency_ms)
+    stubs, proc = {}, None
+    base = args.target
+    if not base:
+        stubs = start_stubs(latency, args.jitter_ms)
+        env = dict(DUMMY_ENV)
+        env.update({k: v for k, v in os.environ.items()})
+        env.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(RESULTS_DIR, 'bench.sqlite')}")
+        env.setdefault('RECORDING_CACHE_DIR', tempfile.mkdtemp(prefix='bench-recordings-'))  # start cold
+        env.update(stub_env(stubs))
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        proc, base = spawn_app(env, args.workers, args.worker_class)
+
+    started = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds')
+    try:
+        recorder, elapsed = run_load(base, args.mix, args.concurrency,
+                                     None if args.iterations else args.duration, args.iterations)
+    finally:
+        if proc:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(timeout=30)
+        for stub in stubs.values():
+            stub.stop()
+
+    result = {
+        'started': started,
+        'label': args.label,
+        'target': args.target or f"gunicorn x{args.workers} ({args.worker_class})",
+        'concurrency': args.concurrency,
+        'elapsed_s': elapsed,
+        'mix': args.mix,
+        'provider_latency_ms': latency,
+        'provider_requests': {name: stub.requests for name, stub in stubs.items()},
+        'total_rps': sum(len(v) for v in recorder.samples.values()) / elapsed,
+        'routes': summarize(recorder, elapsed),
+    }
+    path = save_results(result)
+    previous_path = args.compare or latest_result(exclude=path)
+    previous = None
+    if previous_path:
+        with open(previous_path) as f:
+            previous = json.load(f)['routes']
+
+    print(f"{result['target']}, {args.concurrency} callers, {elapsed:.1f}s, {result['total_rps']:.1f} req/s total")
+    print_report(result['routes'], previous)
+    plays = result['routes'].get('/admin/recording', {}).get('count')
+    if plays:
+        fetches = sum(n for requests_by_path in result['provider_requests'].values()
+                      for path, n in requests_by_path.items() if path.endswith('*'))
+        print(f"\nrecordings: {plays} plays, {fetches} provider fetches (cache misses and prefetches)")
+    if proc:
+        # the rollups bumped by the live paths must match a backfill over the same rows
+        print()
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'check-rollups'], cwd=ROOT, env=env)
+    print(f"\nsaved {os.path.relpath(path, ROOT)}" + (f" (compared with {os.path.relpath(previous_path, ROOT)})" if previous else ""))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+"""
+Local stand-ins for the Twilio REST API, Nexmo and Resend.
+
+Each stub answers the handful of endpoints app.py uses with a canned
+response after an injected delay (recordings get a fixed-size fake audio
+body with Content-Length and ETag), so the app can be load-tested without
+touching (or paying) the real providers. Point the app at them with:
+
+    TWILIO_API_BASE=http://127.0.0.1:<port>
+    NEXMO_API_BASE=http://127.0.0.1:<port>
+    RESEND_API_URL=http://127.0.0.1:<port>
+
+Run standalone with `python bench/stubs.py --latency-ms 150`.
+"""
+import argparse, hashlib, json, random, re, threading, time, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+RECORDING_BYTES = 256 * 1024  # about 16s of 128kbps mp3
+
+
+def _sid(prefix):
+    return prefix + uuid.uuid4().hex
+
+
+def recording_body(path):
+    """Fake audio for a recording path; the same path always gets the same bytes."""
+    seed = hashlib.sha256(path.encode()).digest()
+    return (seed * (RECORDING_BYTES // len(seed) + 1))[:RECORDING_BYTES]
+
+
+def twilio_response(method, path):
+    """Minimal JSON bodies for the Twilio resources app.py touches."""
+    if re.match(r'^/2010-04-01/Accounts/\w+/Recordings/\w+\.(mp3|wav)$', path):
+        return 200, recording_body(path)
+    m = re.match(r'^/2010-04-01/Accounts/(\w+)/(\w+)(?:/(\w+))?\.json', path)
+    if not m:
+        return 404, {"message": "not stubbed", "status": 404}
+    account, resource, sid = m.groups()
+    if method == 'POST' and resource == 'Messages':
+        return 201, {"sid": _sid("SM"), "account_sid": account, "status": "queued"}
+    if method == 'GET' and sid:
+        return 200, {"sid": sid, "account_sid": account, "from": "+33100000000",
+                     "to": "+33600000000", "status": "completed"}
+    if method == 'GET':
+        key = re.sub(r'(?<!^)([A-Z])', r'_\1', resource).lower()
+        return 200, {key: [], "next_page_uri": None, "page": 0, "page_size": 50}
+    return 404, {"message": "not stubbed", "status": 404}
+
+
+def nexmo_response(method, path):
+    if path.startswith('/v1/files/'):
+        return 200, recording_body(path)
+    if path.startswith('/sms/json'):
+        return 200, {"message-count": "1", "messages": [{"status": "0", "message-id": _sid("")}]}
+    return 200, {}
+
+
+def resend_response(method, path):
+    if method == 'POST' and path.startswith('/emails'):
+        return 200, {"id": str(uuid.uuid4())}
+    return 404, {"message": "not stubbed"}
+
+
+PROVIDERS = {
+    'twilio': twilio_response,
+    'nexmo': nexmo_response,
+    'resend': resend_response,
+}
+
+
+class StubServer:
+    """One provider stub on its own port and thread.
+
+    `latency_ms` is the mean injected delay; `jitter_ms` spreads it uniformly.
+    `requests` counts calls per (method, path prefix) for the run report.
+    """
+
+    def __init__(self, provider, latency_ms=0, jitter_ms=0, host='127.0.0.1', port=0):
+        self.provider = provider
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.requests = {}
+        self._lock = threading.Lock()
+        respond = PROVIDERS[provider]
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                delay = stub.latency_ms + random.uniform(-stub.jitter_ms, stub.jitter_ms)
+                if delay > 0:
+                    time.sleep(delay / 1000)
+                path = self.path.split('?', 1)[0]
+                with stub._lock:
+                    # one counter for all recordings, so fetches (cache misses) add up
+                    key = self.command + ' ' + re.sub(r'/(Recordings/RE|files/)[^/]+$', r'/\1*', path)
+                    stub.requests[key] = stub.requests.get(key, 0) + 1
+                status, body = respond(self.command, path)
+                if isinstance(body, bytes):
+                    raw, content_type = body, 'audio/mpeg'
+                else:
+                    raw, content_type = json.dumps(body).encode(), 'application/json'
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(raw)))
+                if content_type == 'audio/mpeg':
+                    self.send_header('ETag', f'"{hashlib.md5(raw).hexdigest()}"')
+                self.end_headers()
+                self.wfile.write(raw)
+
+            do_GET = do_POST = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def start_stubs(latency_ms=None, jitter_ms=0):
+    """Start one stub per provider; `latency_ms` maps provider -> delay."""
+    latency_ms = latency_ms or {}
+    return {name: StubServer(name, latency_ms.get(name, 0), jitter_ms).start() for name in PROVIDERS}
+
+
+def throwaway_private_key():
+    """A fresh RSA key in PEM form, so the Nexmo client can sign its JWTs."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                             serialization.NoEncryption()).decode()
+
+
+def stub_env(stubs):
+    """Environment variables that send app.py's provider traffic to `stubs`."""
+    return {
+        'TWILIO_API_BASE': stubs['twilio'].url,
+        'NEXMO_API_BASE': stubs['nexmo'].url,
+        'NEXMO_APPLICATION_ID': 'bench-application',
+        'NEXMO_PRIVATE_KEY': throwaway_private_key(),  # PEM text, not a path
+        'NEXMO_API_KEY': 'bench',
+        'NEXMO_API_SECRET': 'bench',
+        'RESEND_API_URL': stubs['resend'].url,
+        'RESEND_API_KEY': 're_stub',
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    args = parser.parse_args()
+    stubs = start_stubs({p: args.latency_ms for p in PROVIDERS}, args.jitter_ms)
+    for k, v in stub_env(stubs).items():
+        print(f"export {k}={v}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for s in stubs.values():
+            s.stop()
@@ -0,0 +1,24 @@
+"""
+Gunicorn settings. Gunicorn reads this file automatically, so the Procfile
+stays `gunicorn app:app`; everything here can be overridden per deploy with
+environment variables (or on the command line, e.g. by bench/replay.py).
+
+GUNICORN_WORKER_CLASS=gevent serves requests from an event loop instead of
+one request per sync worker: requests, redis-py and (through psycogreen)
+psycopg2 all yield while they wait on the network, so a worker blocked on
+Twilio, Resend or Postgres keeps answering other webhooks. Each worker then
+holds up to GUNICORN_WORKER_CONNECTIONS requests in flight.
+"""
+import os
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+
+
+def post_fork(server, worker):
+    if server.cfg.worker_class_str == 'gevent':
+        # psycopg2 is a C extension gevent can't patch; make it wait cooperatively
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
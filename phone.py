@@ -0,0 +1,179 @@
+"""
+Phone number normalization for app.py.
+
+Numbers arrive as Twilio E.164 (+33612345678), Nexmo msisdn (33612345678),
+hand-typed national numbers (06 12 34 56 78, (212) 555-0100) and whatever is
+in an imported spreadsheet. normalize() turns any of them into E.164 plus the
+caller ID we should dial out with, using a prefix trie of ITU country calling
+codes and per-country national rules instead of guessing from the length.
+Results are memoized, and normalize_many() handles a whole list at once.
+"""
+import re
+from functools import lru_cache
+from typing import NamedTuple
+
+
+# ITU-T E.164 country calling codes -> ISO region (first region for shared codes)
+COUNTRY_CODES = {
+    '1': 'US', '7': 'RU', '20': 'EG', '27': 'ZA', '30': 'GR', '31': 'NL', '32': 'BE', '33': 'FR',
+    '34': 'ES', '36': 'HU', '39': 'IT', '40': 'RO', '41': 'CH', '43': 'AT', '44': 'GB', '45': 'DK',
+    '46': 'SE', '47': 'NO', '48': 'PL', '49': 'DE', '51': 'PE', '52': 'MX', '53': 'CU', '54': 'AR',
+    '55': 'BR', '56': 'CL', '57': 'CO', '58': 'VE', '60': 'MY', '61': 'AU', '62': 'ID', '63': 'PH',
+    '64': 'NZ', '65': 'SG', '66': 'TH', '81': 'JP', '82': 'KR', '84': 'VN', '86': 'CN', '90': 'TR',
+    '91': 'IN', '92': 'PK', '93': 'AF', '94': 'LK', '95': 'MM', '98': 'IR',
+    '211': 'SS', '212': 'MA', '213': 'DZ', '216': 'TN', '218': 'LY', '220': 'GM', '221': 'SN',
+    '222': 'MR', '223': 'ML', '224': 'GN', '225': 'CI', '226': 'BF', '227': 'NE', '228': 'TG',
+    '229': 'BJ', '230': 'MU', '231': 'LR', '232': 'SL', '233': 'GH', '234': 'NG', '235': 'TD',
+    '236': 'CF', '237': 'CM', '238': 'CV', '239': 'ST', '240': 'GQ', '241': 'GA', '242': 'CG',
+    '243': 'CD', '244': 'AO', '245': 'GW', '246': 'IO', '248': 'SC', '249': 'SD', '250': 'RW',
+    '251': 'ET', '252': 'SO', '253': 'DJ', '254': 'KE', '255': 'TZ', '256': 'UG', '257': 'BI',
+    '258': 'MZ', '260': 'ZM', '261': 'MG', '262': 'RE', '263': 'ZW', '264': 'NA', '265': 'MW',
+    '266': 'LS', '267': 'BW', '268': 'SZ', '269': 'KM', '290': 'SH', '291': 'ER', '297': 'AW',
+    '298': 'FO', '299': 'GL', '350': 'GI', '351': 'PT', '352': 'LU', '353': 'IE', '354': 'IS',
+    '355': 'AL', '356': 'MT', '357': 'CY', '358': 'FI', '359': 'BG', '370': 'LT', '371': 'LV',
+    '372': 'EE', '373': 'MD', '374': 'AM', '375': 'BY', '376': 'AD', '377': 'MC', '378': 'SM',
+    '380': 'UA', '381': 'RS', '382': 'ME', '383': 'XK', '385': 'HR', '386': 'SI', '387': 'BA',
+    '389': 'MK', '420': 'CZ', '421': 'SK', '423': 'LI', '500': 'FK', '501': 'BZ', '502': 'GT',
+    '503': 'SV', '504': 'HN', '505': 'NI', '506': 'CR', '507': 'PA', '508': 'PM', '509': 'HT',
+    '590': 'GP', '591': 'BO', '592': 'GY', '593': 'EC', '594': 'GF', '595': 'PY', '596': 'MQ',
+    '597': 'SR', '598': 'UY', '599': 'CW', '670': 'TL', '672': 'NF', '673': 'BN', '674': 'NR',
+    '675': 'PG', '676': 'TO', '677': 'SB', '678': 'VU', '679': 'FJ', '680': 'PW', '681': 'WF',
+    '682': 'CK', '683': 'NU', '685': 'WS', '686': 'KI', '687': 'NC', '688': 'TV', '689': 'PF',
+    '690': 'TK', '691': 'FM', '692': 'MH', '850': 'KP', '852': 'HK', '853': 'MO', '855': 'KH',
+    '856': 'LA', '880': 'BD', '886': 'TW', '960': 'MV', '961': 'LB', '962': 'JO', '963': 'SY',
+    '964': 'IQ', '965': 'KW', '966': 'SA', '967': 'YE', '968': 'OM', '970': 'PS', '971': 'AE',
+    '972': 'IL', '973': 'BH', '974': 'QA', '975': 'BT', '976': 'MN', '977': 'NP', '992': 'TJ',
+    '993': 'TM', '994': 'AZ', '995': 'GE', '996': 'KG', '998': 'UZ',
+}
+
+class NationalRule(NamedTuple):
+    trunk: str         # national prefix dropped in international format ('' if none)
+    lengths: tuple     # allowed national significant number lengths
+    international: str = '00'  # prefix for dialing out of the country
+
+# Countries our callers and volunteers actually use; others get DEFAULT_RULE.
+NATIONAL_RULES = {
+    'FR': NationalRule('0', (9,)),
+    'US': NationalRule('1', (10,), '011'),
+    'GB': NationalRule('0', (9, 10)),
+    'DE': NationalRule('0', tuple(range(6, 14))),
+    'BE': NationalRule('0', (8, 9)),
+    'NL': NationalRule('0', (9,)),
+    'CH': NationalRule('0', (9,)),
+    'ES': NationalRule('', (9,)),
+    'IT': NationalRule('', tuple(range(6, 12))),  # Italian numbers keep their leading 0
+    'IE': NationalRule('0', (7, 8, 9)),
+    'PT': NationalRule('', (9,)),
+    # French overseas departments
+    'RE': NationalRule('0', (9,)), 'GP': NationalRule('0', (9,)),
+    'GF': NationalRule('0', (9,)), 'MQ': NationalRule('0', (9,)),
+}
+DEFAULT_RULE = NationalRule('', tuple(range(4, 15)))
+
+_NON_DIGITS = re.compile(r'[^0-9]+')
+
+
+def _build_trie(codes):
+    root = {}
+    for code, region in codes.items():
+        node = root
+        for digit in code:
+            node = node.setdefault(digit, {})
+        node[None] = (code, region)
+    return root
+
+COUNTRY_TRIE = _build_trie(COUNTRY_CODES)
+
+def match_country_code(digits):
+    """(code, region) for the country code `digits` starts with, or None.
+
+    Calling codes are prefix-free, so the first terminal node on the walk is
+    the only possible match.
+    """
+    node = COUNTRY_TRIE
+    for digit in digits[:3]:
+        node = node.get(digit)
+        if node is None:
+            return None
+        if None in node:
+            return node[None]
+    return None
+
+def rule_for(region):
+    return NATIONAL_RULES.get(region, DEFAULT_RULE)
+
+
+class Normalized(NamedTuple):
+    e164: str          # '+33612345678', or None if the input can't be a phone number
+    region: str        # ISO region of the country code, e.g. 'FR'
+    caller_id: str     # the number to dial out with
+
+
+class Normalizer:
+    """Turns raw numbers into Normalized results.
+
+    `default_region` decides how national-format numbers (no + or 00) are
+    read; `caller_ids` maps calling codes to the caller ID used for them,
+    falling back to `default_caller_id`.
+    """
+
+    def __init__(self, default_region='FR', caller_ids=None, default_caller_id=None, cache_size=4096):
+        self.default_region = default_region
+        self.default_code = next(code for code, region in COUNTRY_CODES.items() if region == default_region)
+        self.caller_ids = caller_ids or {}
+        self.default_caller_id = default_caller_id
+        self._home = rule_for(default_region)
+        self._exit_prefixes = tuple(dict.fromkeys((self._home.international, '00', '011')))
+        self._invalid = Normalized(None, None, default_caller_id)
+        # bound per instance so each Normalizer has its own cache and settings
+        self.normalize = lru_cache(maxsize=cache_size)(self._normalize)
+
+    def _result(self, code, region, national):
+        rule = rule_for(region)
+        if rule.trunk and national.startswith(rule.trunk) and len(national) - len(rule.trunk) in rule.lengths:
+            national = national[len(rule.trunk):]  # '+33 (0)6 ...'
+        if len(national) not in rule.lengths or len(code) + len(national) > 15:
+            return None
+        return Normalized(f"+{code}{national}", region, self.caller_ids.get(code, self.default_caller_id))
+
+    def _international(self, digits):
+        match = match_country_code(digits)
+        if match is None:
+            return None
+        code, region = match
+        return self._result(code, region, digits[len(code):])
+
+    def _normalize(self, raw):
+        raw = (raw or '').strip()
+        digits = _NON_DIGITS.sub('', raw)
+        invalid = self._invalid
+        if not digits:
+            return invalid
+        if raw.startswith('+') and digits[0] != '0':
+            return self._international(digits) or invalid
+        for prefix in self._exit_prefixes:
+            if digits.startswith(prefix) and (result := self._international(digits[len(prefix):])):
+                return result
+        # national format in the home country: 06 12 34 56 78
+        home = self._home
+        if home.trunk and digits.startswith(home.trunk):
+            result = self._result(self.default_code, self.default_region, digits)
+            if result:
+                return result
+        # national format with the trunk 0 left off: 6 12 34 56 78
+        elif result := self._result(self.default_code, self.default_region, digits):
+            return result
+        # a bare 10-digit number with a valid area code is almost always North American
+        if len(digits) == 10 and digits[0] in '23456789':
+            return self._result('1', 'US', digits) or invalid
+        # E.164 without the '+', as Nexmo sends it
+        return self._international(digits) or invalid
+
+    def normalize_many(self, raws):
+        """Normalize a whole list; each distinct input is parsed once."""
+        normalize = self.normalize
+        unique = {raw: normalize(raw) for raw in dict.fromkeys(raws)}
+        return [unique[raw] for raw in raws]
+
+    def cache_info(self):
+        return self.normalize.cache_info()
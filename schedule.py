@@ -0,0 +1,156 @@
+"""
+Hotline schedule for app.py.
+
+The calendar is a list of Rules: weekly opening hours, dated overrides such
+as extended election-day hours, closures (holidays) and volunteer shifts.
+compile_schedule() expands them over a window of days into one sorted list
+of boundaries, where each segment records whether the line is open and who
+is on duty. Looking up "now" is then a bisect instead of re-evaluating every
+rule on each call.
+"""
+import datetime
+from bisect import bisect_right
+from typing import NamedTuple
+
+
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+KINDS = ('open', 'closed', 'shift')
+
+
+class Rule(NamedTuple):
+    kind: str                   # 'open', 'closed' or 'shift'
+    days: frozenset             # weekdays 0-6; empty means every day
+    start: datetime.time
+    end: datetime.time          # end <= start runs past midnight; start == end is the whole day
+    date_from: datetime.date = None
+    date_to: datetime.date = None
+    number: str = None          # the volunteer on a 'shift'
+
+
+class Coverage(NamedTuple):
+    open: bool
+    on_duty: frozenset          # numbers on shift, or None when no shifts are scheduled
+    until: float                # epoch seconds this answer holds until
+
+
+def parse_days(text):
+    """'mon-fri', 'sat,sun', 'daily' or '' -> frozenset of weekday numbers."""
+    days = set()
+    for part in (text or '').lower().replace(' ', '').split(','):
+        if part in ('', 'daily', 'all', '*'):
+            continue
+        first, _, last = part.partition('-')
+        if first not in DAY_NAMES or (last and last not in DAY_NAMES):
+            raise ValueError(f"unknown day {part!r}")
+        i, j = DAY_NAMES.index(first), DAY_NAMES.index(last or first)
+        days.update(DAY_NAMES.index(d) % 7 for d in (DAY_NAMES * 2)[i:i + (j - i) % 7 + 1])
+    return frozenset(days)
+
+def format_days(days):
+    return ','.join(DAY_NAMES[d] for d in sorted(days)) or 'daily'
+
+def parse_window(text):
+    """'10:00-22:00' -> (time(10), time(22)); '24:00' is accepted as an end."""
+    start, _, end = (text or '').replace(' ', '').partition('-')
+    if not end:
+        raise ValueError(f"expected HH:MM-HH:MM, got {text!r}")
+    parse = lambda t: datetime.time(0) if t == '24:00' else datetime.time.fromisoformat(t)
+    return parse(start), parse(end)
+
+def _applies(rule, day):
+    if rule.date_from and day < rule.date_from:
+        return False
+    if rule.date_to and day > rule.date_to:
+        return False
+    return not rule.days or day.weekday() in rule.days
+
+def _interval(rule, day, tz):
+    start = datetime.datetime.combine(day, rule.start, tzinfo=tz)
+    end_day = day if rule.end > rule.start else day + datetime.timedelta(days=1)
+    end = datetime.datetime.combine(end_day, rule.end, tzinfo=tz)
+    return start.timestamp(), end.timestamp()
+
+def _subtract(intervals, holes):
+    """Remove the (sorted, merged) `holes` from each interval."""
+    result = []
+    for start, end, *rest in intervals:
+        for h_start, h_end in holes:
+            if h_end <= start or h_start >= end:
+                continue
+            if h_start > start:
+                result.append((start, h_start, *rest))
+            start = max(start, h_end)
+            if start >= end:
+                break
+        if start < end:
+            result.append((start, end, *rest))
+    return result
+
+def _merge(intervals):
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class CompiledSchedule:
+    """Coverage segments for [start, end); look them up with at(ts)."""
+
+    def __init__(self, bounds, segments, start, end, has_shifts):
+        self.bounds = bounds        # sorted segment start times
+        self.segments = segments    # (open, on_duty) for [bounds[i], bounds[i+1])
+        self.start, self.end = start, end
+        self.has_shifts = has_shifts
+
+    def covers(self, ts):
+        return self.start <= ts < self.end
+
+    def at(self, ts):
+        i = bisect_right(self.bounds, ts) - 1
+        until = self.bounds[i + 1] if i + 1 < len(self.bounds) else self.end
+        if i < 0:
+            return Coverage(False, frozenset() if self.has_shifts else None, self.bounds[0] if self.bounds else self.end)
+        is_open, on_duty = self.segments[i]
+        return Coverage(is_open, on_duty if self.has_shifts else None, until)
+
+    def changes(self):
+        """(ts, Coverage) at every boundary, for display."""
+        return [(ts, self.at(ts)) for ts in self.bounds]
+
+
+def compile_schedule(rules, first_day, days, tz):
+    """Expand `rules` over `days` days from `first_day` (a date in `tz`)."""
+    window = [first_day + datetime.timedelta(days=i) for i in range(days)]
+    start = datetime.datetime.combine(window[0], datetime.time(0), tzinfo=tz).timestamp()
+    end = datetime.datetime.combine(window[-1] + datetime.timedelta(days=1), datetime.time(0), tzinfo=tz).timestamp()
+
+    opening, closed, shifts = [], [], []
+    for day in window:
+        # dated opening hours (election day) replace the weekly ones for that day
+        todays = [r for r in rules if r.kind == 'open' and _applies(r, day)]
+        dated = [r for r in todays if r.date_from or r.date_to]
+        opening += [_interval(r, day, tz) for r in (dated or todays)]
+        closed += [_interval(r, day, tz) for r in rules if r.kind == 'closed' and _applies(r, day)]
+        shifts += [_interval(r, day, tz) + (r.number,) for r in rules if r.kind == 'shift' and _applies(r, day)]
+    closed = _merge(closed)
+    opening = _subtract(_merge(opening), closed)
+    shifts = _subtract(sorted(shifts), closed)
+
+    # sweep the interval edges into disjoint segments
+    edges = sorted({start, end} | {t for s, e in opening for t in (s, e)} | {t for s, e, _ in shifts for t in (s, e)})
+    edges = [t for t in edges if start <= t <= end]
+    bounds, segments = [], []
+    oi = 0
+    for seg_start, seg_end in zip(edges, edges[1:]):
+        while oi < len(opening) and opening[oi][1] <= seg_start:
+            oi += 1
+        is_open = oi < len(opening) and opening[oi][0] <= seg_start
+        on_duty = frozenset(n for s, e, n in shifts if s <= seg_start and e >= seg_end) if is_open else frozenset()
+        if segments and segments[-1] == (is_open, on_duty):
+            continue  # same coverage as the previous segment
+        bounds.append(seg_start)
+        segments.append((is_open, on_duty))
+    return CompiledSchedule(bounds, segments, start, end, any(r.kind == 'shift' for r in rules))